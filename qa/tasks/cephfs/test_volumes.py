@@ -5,6 +5,8 @@ import random
 import logging
 import collections
 
+import gevent
+
 from tasks.cephfs.cephfs_test_case import CephFSTestCase
 from teuthology.exceptions import CommandFailedError
 
@@ -1262,3 +1264,62 @@ class TestVolumes(CephFSTestCase):
 
         # verify trash dir is clean
         self._wait_for_trash_empty()
+
+    def test_subvolume_concurrent_ops(self):
+        """
+        That operations on independent subvolumes (in various groups) can be
+        issued concurrently, interleaved with group snapshot operations.
+        """
+        groups = self._generate_random_group_name(2)
+        subvolumes = self._generate_random_subvolume_name(24)
+        osize = self.DEFAULT_FILE_SIZE*1024*1024
+
+        # create groups
+        for group in groups:
+            self._fs_cmd("subvolumegroup", "create", self.volname, group)
+
+        def subvolume_ops(subvolume, group):
+            group_args = [group] if group else []
+
+            # create, getpath, resize, snapshot and remove the subvolume
+            args = ["subvolume", "create", self.volname, subvolume, "--size", str(osize)]
+            if group:
+                args.extend(["--group_name", group])
+            self._fs_cmd(*args)
+            subvolpath = self._get_subvolume_path(self.volname, subvolume, group_name=group)
+            self.assertNotEqual(subvolpath, None)
+            self._fs_cmd("subvolume", "resize", self.volname, subvolume, str(osize*2), *group_args)
+            snapshot = "{0}_snap".format(subvolume)
+            self._fs_cmd("subvolume", "snapshot", "create", self.volname, subvolume, snapshot, *group_args)
+            self._fs_cmd("subvolume", "snapshot", "rm", self.volname, subvolume, snapshot, *group_args)
+            self._fs_cmd("subvolume", "rm", self.volname, subvolume, *group_args)
+
+        def group_snapshot_ops(group):
+            for i in range(4):
+                snapshot = "{0}_snap_{1}".format(group, i)
+                self._fs_cmd("subvolumegroup", "snapshot", "create", self.volname, group, snapshot)
+                self._fs_cmd("subvolumegroup", "snapshot", "rm", self.volname, group, snapshot)
+
+        # spread subvolumes across the groups (and the default group)
+        placement = groups + [None]
+        workers = [gevent.spawn(subvolume_ops, subvolume, placement[i % len(placement)])
+                   for i, subvolume in enumerate(subvolumes)]
+        workers.append(gevent.spawn(group_snapshot_ops, groups[0]))
+        gevent.joinall(workers)
+        # raise any failure
+        for worker in workers:
+            worker.get()
+
+        # verify no subvolumes are left behind
+        for group in placement:
+            args = ["subvolume", "ls", self.volname]
+            if group:
+                args.append(group)
+            self.assertEqual(len(json.loads(self._fs_cmd(*args))), 0)
+
+        # verify trash dir is clean
+        self._wait_for_trash_empty()
+
+        # remove groups
+        for group in groups:
+            self._fs_cmd("subvolumegroup", "rm", self.volname, group)
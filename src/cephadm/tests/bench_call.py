@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+Benchmark cephadm's call() against a command with a large output.
+
+    python tests/bench_call.py [megabytes] [runs]
+
+Set CEPHADM to the path of another version of the script to compare.
+"""
+import logging
+import os
+import sys
+import time
+
+CEPHADM = os.environ.get('CEPHADM', 'cephadm')
+
+if sys.version_info >= (3, 3):
+    from importlib.machinery import SourceFileLoader
+    cd = SourceFileLoader('cephadm', CEPHADM).load_module()
+else:
+    import imp
+    cd = imp.load_source('cephadm', CEPHADM)
+
+# a fake command writing (about) `megabytes` of 80 column lines
+FAKE_COMMAND = '''
+import sys
+block = ("x" * 79 + "\\n").encode("utf-8") * 13107
+out = getattr(sys.stdout, "buffer", sys.stdout)
+for _ in range(%d):
+    out.write(block)
+'''
+
+
+def bench(name, megabytes, runs, **kwargs):
+    command = [sys.executable, '-c', FAKE_COMMAND % megabytes]
+    best = None
+    for _ in range(runs):
+        start = time.time()
+        out, err, code = cd.call(command, timeout=600, **kwargs)
+        elapsed = time.time() - start
+        assert code == 0, err
+        best = elapsed if best is None else min(best, elapsed)
+    print('%-10s %6.3fs %8.1f MB/s' % (name, best, megabytes / best))
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    cd.logger = logging.getLogger('cephadm')
+
+    print('%d MB of output, best of %d runs' % (megabytes, runs))
+    bench('capture', megabytes, runs)
+    bench('callback', megabytes, runs, callback=lambda name, text: None)
+    # log every line (to a discarding handler)
+    cd.logger.propagate = False
+    cd.logger.addHandler(logging.NullHandler())
+    bench('verbose', megabytes, runs, verbose=True)
+
+
+if __name__ == '__main__':
+    main()
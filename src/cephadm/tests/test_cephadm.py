@@ -1,4 +1,5 @@
 import argparse
+import logging
 import mock
 import os
 import sys
@@ -46,3 +47,35 @@ class TestCephAdm(object):
         with pytest.raises(ValueError) as res:
             cd._parse_podman_version('podman version inval.id')
         assert 'inval' in str(res.value)
+
+    @mock.patch('cephadm.call')
+    def test_check_units(self, _call):
+        _call.return_value = (
+            'UnitFileState=enabled\nActiveState=active\n\n'
+            'UnitFileState=disabled\nActiveState=activating\n\n'
+            'UnitFileState=static\nActiveState=failed\n',
+            '', 0)
+        # same as check_unit(), which maps the `systemctl is-active` output
+        assert cd.check_units(['a', 'b', 'c']) == {
+            'a': (True, 'running'),
+            'b': (False, 'unknown'),
+            'c': (True, 'error'),
+        }
+        assert _call.call_count == 1
+
+    @mock.patch.object(cd, 'logger', logging.getLogger('cephadm'), create=True)
+    def test_call_large_output(self):
+        # multi-byte characters end up split across reads
+        script = 'import sys; sys.stdout.write(u"\\u00e9x\\n" * 100000); sys.stderr.write("err")'
+        env = dict(os.environ, PYTHONIOENCODING='utf-8')
+        out, err, code = cd.call([sys.executable, '-c', script], timeout=30, env=env)
+        assert code == 0
+        assert out == u'\u00e9x\n' * 100000
+        assert err == 'err'
+
+        chunks = []
+        out, err, code = cd.call([sys.executable, '-c', script], timeout=30, env=env,
+                                 callback=lambda name, text: chunks.append((name, text)))
+        assert (out, err, code) == ('', '', 0)
+        assert ''.join(t for n, t in chunks if n == 'stdout') == u'\u00e9x\n' * 100000
+        assert ''.join(t for n, t in chunks if n == 'stderr') == 'err'
@@ -826,6 +826,145 @@ PyObject* ActivePyModules::get_perf_schema_python(
   return f.get();
 }
 
+PyObject* ActivePyModules::get_perf_counters_python(
+    const std::vector<std::string> &svc_types,
+    int prio_limit)
+{
+  PyThreadState *tstate = PyEval_SaveThread();
+  std::lock_guard l(lock);
+  PyEval_RestoreThread(tstate);
+
+  PyFormatter f;
+  std::vector<std::pair<const PerfCounterType*,
+                        const PerfCounterInstance*>> counters;
+  for (const auto& svc_type : svc_types) {
+    auto daemons = daemon_state.get_by_service(svc_type);
+    for (auto& [key, state] : daemons) {
+      std::lock_guard l(state->lock);
+      counters.clear();
+      for (const auto& [path, instance] : state->perf_counters.instances) {
+        auto type = state->perf_counters.types.find(path);
+        if (type == state->perf_counters.types.end() ||
+            type->second.priority < prio_limit) {
+          continue;
+        }
+        counters.emplace_back(&type->second, &instance);
+      }
+
+      // one column per schema field / value, so that the python side
+      // can walk a daemon's counters without a dict per counter
+      f.open_object_section(ceph::to_string(key).c_str());
+      f.open_array_section("path");
+      for (auto& [type, instance] : counters) {
+        f.dump_string("path", type->path);
+      }
+      f.close_section();
+      f.open_array_section("description");
+      for (auto& [type, instance] : counters) {
+        f.dump_string("description", type->description);
+      }
+      f.close_section();
+      f.open_array_section("nick");
+      for (auto& [type, instance] : counters) {
+        f.dump_string("nick", type->nick);
+      }
+      f.close_section();
+      f.open_array_section("type");
+      for (auto& [type, instance] : counters) {
+        f.dump_unsigned("type", type->type);
+      }
+      f.close_section();
+      f.open_array_section("priority");
+      for (auto& [type, instance] : counters) {
+        f.dump_unsigned("priority", type->priority);
+      }
+      f.close_section();
+      f.open_array_section("units");
+      for (auto& [type, instance] : counters) {
+        f.dump_unsigned("units", type->unit);
+      }
+      f.close_section();
+      f.open_array_section("value");
+      for (auto& [type, instance] : counters) {
+        if (type->type & PERFCOUNTER_LONGRUNAVG) {
+          const auto &data = instance->get_data_avg();
+          f.dump_unsigned("value", data.empty() ? 0 : data.back().s);
+        } else {
+          const auto &data = instance->get_data();
+          f.dump_unsigned("value", data.empty() ? 0 : data.back().v);
+        }
+      }
+      f.close_section();
+      f.open_array_section("count");
+      for (auto& [type, instance] : counters) {
+        if (type->type & PERFCOUNTER_LONGRUNAVG) {
+          const auto &data = instance->get_data_avg();
+          f.dump_unsigned("count", data.empty() ? 0 : data.back().c);
+        } else {
+          f.dump_unsigned("count", 0);
+        }
+      }
+      f.close_section();
+      f.close_section();
+    }
+  }
+  return f.get();
+}
+
+PyObject* ActivePyModules::get_pg_stats_python(
+    const std::optional<std::vector<std::string>> &pgids,
+    epoch_t since_epoch)
+{
+  PyFormatter f;
+  PyThreadState *tstate = PyEval_SaveThread();
+  cluster_state.with_pgmap([&](const PGMap &pg_map) {
+    PyEval_RestoreThread(tstate);
+    f.dump_unsigned("version", pg_map.version);
+    f.dump_unsigned("last_osdmap_epoch", pg_map.last_osdmap_epoch);
+    // only the fields needed to track recovery, rather than the
+    // whole pg_stat_t of every PG as in "pg_dump"
+    auto dump_pg = [&f, since_epoch](const pg_t &pgid, const pg_stat_t &s) {
+      if (s.reported_epoch < since_epoch) {
+        return;
+      }
+      f.open_object_section(stringify(pgid).c_str());
+      f.dump_string("state", pg_state_string(s.state));
+      f.dump_unsigned("reported_epoch", s.reported_epoch);
+      f.dump_int("num_bytes", s.stats.sum.num_bytes);
+      f.dump_int("num_bytes_recovered", s.stats.sum.num_bytes_recovered);
+      f.close_section();
+    };
+    std::vector<std::string> missing;
+    f.open_object_section("pg_stats");
+    if (pgids) {
+      for (const auto &pgid_str : *pgids) {
+        pg_t pgid;
+        if (!pgid.parse(pgid_str.c_str())) {
+          missing.push_back(pgid_str);
+          continue;
+        }
+        auto p = pg_map.pg_stat.find(pgid);
+        if (p == pg_map.pg_stat.end()) {
+          missing.push_back(pgid_str);
+          continue;
+        }
+        dump_pg(p->first, p->second);
+      }
+    } else {
+      for (const auto &[pgid, s] : pg_map.pg_stat) {
+        dump_pg(pgid, s);
+      }
+    }
+    f.close_section();
+    f.open_array_section("missing");
+    for (const auto &pgid_str : missing) {
+      f.dump_string("pgid", pgid_str);
+    }
+    f.close_section();
+  });
+  return f.get();
+}
+
 PyObject *ActivePyModules::get_context()
 {
   PyThreadState *tstate = PyEval_SaveThread();
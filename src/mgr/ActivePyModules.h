@@ -13,6 +13,8 @@
 
 #pragma once
 
+#include <optional>
+
 #include "ActivePyModule.h"
 
 #include "common/Finisher.h"
@@ -90,6 +92,12 @@ public:
   PyObject *get_perf_schema_python(
      const std::string &svc_type,
      const std::string &svc_id);
+  PyObject *get_perf_counters_python(
+     const std::vector<std::string> &svc_types,
+     int prio_limit);
+  PyObject *get_pg_stats_python(
+     const std::optional<std::vector<std::string>> &pgids,
+     epoch_t since_epoch);
   PyObject *get_context();
   PyObject *get_osdmap();
   PyObject *with_perf_counters(
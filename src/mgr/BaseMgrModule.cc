@@ -637,6 +637,68 @@ get_perf_schema(BaseMgrModule *self, PyObject *args)
   return self->py_modules->get_perf_schema_python(type_str, svc_id);
 }
 
+static PyObject*
+get_perf_counters(BaseMgrModule *self, PyObject *args)
+{
+  PyObject *svc_types_obj = nullptr;
+  int prio_limit = 0;
+  if (!PyArg_ParseTuple(args, "Oi:get_perf_counters", &svc_types_obj,
+                                                      &prio_limit)) {
+    return nullptr;
+  }
+  PyObject *seq = PySequence_Fast(svc_types_obj,
+                                  "svc_types must be a sequence of str");
+  if (seq == nullptr) {
+    return nullptr;
+  }
+  std::vector<std::string> svc_types;
+  const auto n = PySequence_Fast_GET_SIZE(seq);
+  for (Py_ssize_t i = 0; i < n; ++i) {
+    PyObject *item = PySequence_Fast_GET_ITEM(seq, i);
+    const char *svc_type = PyUnicode_AsUTF8(item);
+    if (svc_type == nullptr) {
+      Py_DECREF(seq);
+      return nullptr;
+    }
+    svc_types.emplace_back(svc_type);
+  }
+  Py_DECREF(seq);
+
+  return self->py_modules->get_perf_counters_python(svc_types, prio_limit);
+}
+
+static PyObject*
+get_pg_stats(BaseMgrModule *self, PyObject *args)
+{
+  PyObject *pgids_obj = nullptr;
+  unsigned int since_epoch = 0;
+  if (!PyArg_ParseTuple(args, "OI:get_pg_stats", &pgids_obj, &since_epoch)) {
+    return nullptr;
+  }
+  std::optional<std::vector<std::string>> pgids;
+  if (pgids_obj != Py_None) {
+    PyObject *seq = PySequence_Fast(pgids_obj,
+                                    "pgids must be None or a sequence of str");
+    if (seq == nullptr) {
+      return nullptr;
+    }
+    pgids.emplace();
+    const auto n = PySequence_Fast_GET_SIZE(seq);
+    for (Py_ssize_t i = 0; i < n; ++i) {
+      PyObject *item = PySequence_Fast_GET_ITEM(seq, i);
+      const char *pgid = PyUnicode_AsUTF8(item);
+      if (pgid == nullptr) {
+        Py_DECREF(seq);
+        return nullptr;
+      }
+      pgids->emplace_back(pgid);
+    }
+    Py_DECREF(seq);
+  }
+
+  return self->py_modules->get_pg_stats_python(pgids, since_epoch);
+}
+
 static PyObject *
 ceph_get_osdmap(BaseMgrModule *self, PyObject *args)
 {
@@ -1137,6 +1199,12 @@ PyMethodDef BaseMgrModule_methods[] = {
   {"_ceph_get_perf_schema", (PyCFunction)get_perf_schema, METH_VARARGS,
     "Get the performance counter schema"},
 
+  {"_ceph_get_perf_counters", (PyCFunction)get_perf_counters, METH_VARARGS,
+    "Get the schema and latest value of all performance counters"},
+
+  {"_ceph_get_pg_stats", (PyCFunction)get_pg_stats, METH_VARARGS,
+    "Get the recovery related stats of a set of PGs"},
+
   {"_ceph_log", (PyCFunction)ceph_log, METH_VARARGS,
    "Emit a (local) log message"},
 
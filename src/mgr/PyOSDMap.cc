@@ -185,6 +185,68 @@ static PyObject *osdmap_map_pool_pgs_up(BasePyOSDMap* self, PyObject *args)
   return f.get();
 }
 
+static PyObject *osdmap_map_pgs_acting_diff(BasePyOSDMap* self,
+                                             PyObject *args)
+{
+  BasePyOSDMap *other;
+  int osd = -1;
+  if (!PyArg_ParseTuple(args, "O!i:map_pgs_acting_diff",
+			&BasePyOSDMapType, &other, &osd)) {
+    return nullptr;
+  }
+  struct pg_diff_t {
+    pg_t pgid;
+    vector<int> old_acting;
+    vector<int> new_acting;
+  };
+  vector<pg_diff_t> diffs;
+  // map every PG of this map's pools on both maps without the GIL, then
+  // only pythonize the ones that moved
+  PyThreadState *tstate = PyEval_SaveThread();
+  {
+    vector<int> old_acting, new_acting;
+    for (auto& [poolid, pool] : self->osdmap->get_pools()) {
+      for (unsigned ps = 0; ps < pool.get_pg_num(); ++ps) {
+        pg_t pgid(ps, poolid);
+        self->osdmap->pg_to_acting_osds(pgid, &old_acting, nullptr);
+        other->osdmap->pg_to_acting_osds(pgid, &new_acting, nullptr);
+        if (old_acting == new_acting) {
+          continue;
+        }
+        if (osd >= 0 &&
+            std::find(old_acting.begin(), old_acting.end(), osd) ==
+              old_acting.end() &&
+            std::find(new_acting.begin(), new_acting.end(), osd) ==
+              new_acting.end()) {
+          continue;
+        }
+        diffs.push_back({pgid, old_acting, new_acting});
+      }
+    }
+  }
+  PyEval_RestoreThread(tstate);
+  dout(10) << __func__ << " " << diffs.size() << " PGs differ" << dendl;
+
+  PyFormatter f;
+  for (const auto& diff : diffs) {
+    f.open_object_section(stringify(diff.pgid).c_str());
+    f.dump_int("pool", diff.pgid.pool());
+    f.dump_unsigned("ps", diff.pgid.ps());
+    f.open_array_section("old_acting");
+    for (auto o : diff.old_acting) {
+      f.dump_int("osd", o);
+    }
+    f.close_section();
+    f.open_array_section("new_acting");
+    for (auto o : diff.new_acting) {
+      f.dump_int("osd", o);
+    }
+    f.close_section();
+    f.close_section();
+  }
+  return f.get();
+}
+
 static int
 BasePyOSDMap_init(BasePyOSDMap *self, PyObject *args, PyObject *kwds)
 {
@@ -289,6 +351,8 @@ PyMethodDef BasePyOSDMap_methods[] = {
    "Calculate new pg-upmap values"},
   {"_map_pool_pgs_up", (PyCFunction)osdmap_map_pool_pgs_up, METH_VARARGS,
    "Calculate up set mappings for all PGs in a pool"},
+  {"_map_pgs_acting_diff", (PyCFunction)osdmap_map_pgs_acting_diff, METH_VARARGS,
+   "Get the PGs whose acting sets differ between two OSDMaps"},
   {"_pg_to_up_acting_osds", (PyCFunction)osdmap_pg_to_up_acting_osds, METH_VARARGS,
     "Calculate up+acting OSDs for a PG ID"},
   {"_pool_raw_used_rate", (PyCFunction)osdmap_pool_raw_used_rate, METH_VARARGS,
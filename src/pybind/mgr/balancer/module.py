@@ -3,6 +3,7 @@
 Balance PG distribution across OSDs.
 """
 
+from array import array
 import copy
 import errno
 import json
@@ -17,32 +18,237 @@ import datetime
 
 TIME_FORMAT = '%Y-%m-%d_%H:%M:%S'
 
+def _crush_subtree(buckets, root):
+    # ids of root and all buckets below it
+    ids = set()
+    stack = [root]
+    while stack:
+        bucket_id = stack.pop()
+        if bucket_id in ids:
+            continue
+        ids.add(bucket_id)
+        for item in buckets.get(bucket_id, {}).get('items', []):
+            if item['id'] < 0:
+                stack.append(item['id'])
+    return ids
+
+
+def _crush_changed_buckets(old, new):
+    """
+    Compare two CRUSH map dumps.
+
+    :return: the ids of the buckets whose items, weights or weight-set
+        weights differ, or None if something that affects every
+        mapping (rules, tunables, devices or types) changed.
+    """
+    for k in ('devices', 'types', 'rules', 'tunables'):
+        if old.get(k) != new.get(k):
+            return None
+    old_buckets = {b['id']: b for b in old.get('buckets', [])}
+    new_buckets = {b['id']: b for b in new.get('buckets', [])}
+    changed = set(
+        i for i in set(old_buckets) | set(new_buckets)
+        if old_buckets.get(i) != new_buckets.get(i)
+    )
+    old_args = old.get('choose_args', {})
+    new_args = new.get('choose_args', {})
+    for key in set(old_args) | set(new_args):
+        old_ws = {a['bucket_id']: a for a in old_args.get(key, [])}
+        new_ws = {a['bucket_id']: a for a in new_args.get(key, [])}
+        changed.update(
+            i for i in set(old_ws) | set(new_ws)
+            if old_ws.get(i) != new_ws.get(i)
+        )
+    return changed
+
+
 class MappingState:
+    """
+    The up set of every PG of the balanced pools, plus per-PG object
+    and byte counts.
+
+    Besides the pgid -> up dicts, the PGs of each pool are kept as
+    columns for calc_eval(): pg_ids_by_poolid, pg_up_sets_by_poolid,
+    and pg_objects_by_poolid/pg_bytes_by_poolid as int64 arrays, all in
+    the same order.
+
+    A state can also be derived from a parent state and an incremental
+    with from_incremental(), which only re-maps what the incremental
+    touched.
+    """
     def __init__(self, osdmap, pg_dump, desc=''):
         self.desc = desc
         self.osdmap = osdmap
-        self.osdmap_dump = self.osdmap.dump()
+        self._osdmap_dump = self.osdmap.dump()
         self.crush = osdmap.get_crush()
-        self.crush_dump = self.crush.dump()
+        self._crush_dump = None
         self.pg_dump = pg_dump
         self.pg_stat = {
             i['pgid']: i['stat_sum'] for i in pg_dump.get('pg_stats', [])
         }
+        # the state this one was derived from, and the pgids that were
+        # re-mapped for it; see from_incremental()
+        self.parent = None
+        self.remapped = None
         osd_poolids = [p['pool'] for p in self.osdmap_dump.get('pools', [])]
         pg_poolids = [p['poolid'] for p in pg_dump.get('pool_stats', [])]
         self.poolids = set(osd_poolids) & set(pg_poolids)
         self.pg_up = {}
         self.pg_up_by_poolid = {}
+        self.pg_ids_by_poolid = {}
+        self.pg_up_sets_by_poolid = {}
+        self.pg_objects_by_poolid = {}
+        self.pg_bytes_by_poolid = {}
         for poolid in self.poolids:
             self.pg_up_by_poolid[poolid] = osdmap.map_pool_pgs_up(poolid)
             for a,b in six.iteritems(self.pg_up_by_poolid[poolid]):
                 self.pg_up[a] = b
+            self._build_pool_columns(poolid)
+
+    @property
+    def osdmap_dump(self):
+        if self._osdmap_dump is None:
+            self._osdmap_dump = self.osdmap.dump()
+        return self._osdmap_dump
+
+    @property
+    def crush_dump(self):
+        if self._crush_dump is None:
+            self._crush_dump = self.crush.dump()
+        return self._crush_dump
+
+    @classmethod
+    def from_incremental(cls, parent, inc, desc=''):
+        """
+        Build the state of parent.osdmap with inc applied, re-mapping
+        only the pools and PGs the incremental can have moved: pools
+        whose definition changed or that sit under a CRUSH root with a
+        reweighted, (re)started or stopped OSD or with changed bucket
+        or weight-set weights, and PGs whose upmaps changed.  Anything
+        that may affect every mapping makes it re-map everything.
+        """
+        osdmap = parent.osdmap.apply_incremental(inc)
+        incdump = inc.dump()
+        if incdump.get('full_map') or incdump.get('old_pools') or \
+           incdump.get('new_max_osd', -1) >= 0:
+            return cls(osdmap, parent.pg_dump, desc)
+
+        ms = cls.__new__(cls)
+        ms.desc = desc
+        ms.osdmap = osdmap
+        ms._osdmap_dump = None
+        ms.pg_dump = parent.pg_dump
+        ms.pg_stat = parent.pg_stat
+        ms.parent = parent
+
+        # pools to re-map
+        remap_pools = set(p['pool'] for p in incdump.get('new_pools', []))
+        changed_buckets = set()
+        if 'crush' in incdump:
+            ms.crush = osdmap.get_crush()
+            ms._crush_dump = incdump['crush']
+            changed_buckets = _crush_changed_buckets(parent.crush_dump,
+                                                     ms._crush_dump)
+            if changed_buckets is None:
+                return cls(osdmap, parent.pg_dump, desc)
+        else:
+            ms.crush = parent.crush
+            ms._crush_dump = parent._crush_dump
+        changed_osds = set()
+        for k in ('new_weight', 'osd_state_xor', 'new_up_osds'):
+            changed_osds.update(o['osd'] for o in incdump.get(k, []))
+        if changed_osds or changed_buckets:
+            old_buckets = {b['id']: b for b in
+                           parent.crush_dump.get('buckets', [])}
+            new_buckets = {b['id']: b for b in
+                           ms.crush_dump.get('buckets', [])}
+            for rootid in ms.crush.find_takes():
+                osds = set(ms.crush.get_take_weight_osd_map(rootid)) | \
+                    set(parent.crush.get_take_weight_osd_map(rootid))
+                if changed_osds & osds or \
+                   changed_buckets & (_crush_subtree(old_buckets, rootid) |
+                                      _crush_subtree(new_buckets, rootid)):
+                    remap_pools.update(osdmap.get_pools_by_take(rootid))
+
+        # PGs to re-map
+        remap_pgs = {}
+        for k in ('new_pg_upmap', 'new_pg_upmap_items'):
+            for i in incdump.get(k, []):
+                pool, ps = i['pgid'].split('.')
+                remap_pgs.setdefault(int(pool), set()).add(i['pgid'])
+        for k in ('old_pg_upmap', 'old_pg_upmap_items'):
+            for pgid in incdump.get(k, []):
+                pool, ps = pgid.split('.')
+                remap_pgs.setdefault(int(pool), set()).add(pgid)
+
+        pg_poolids = set(p['poolid'] for p in
+                         parent.pg_dump.get('pool_stats', []))
+        ms.poolids = parent.poolids | (remap_pools & pg_poolids)
+        ms.pg_up = dict(parent.pg_up)
+        ms.pg_up_by_poolid = dict(parent.pg_up_by_poolid)
+        ms.pg_ids_by_poolid = dict(parent.pg_ids_by_poolid)
+        ms.pg_up_sets_by_poolid = dict(parent.pg_up_sets_by_poolid)
+        ms.pg_objects_by_poolid = dict(parent.pg_objects_by_poolid)
+        ms.pg_bytes_by_poolid = dict(parent.pg_bytes_by_poolid)
+        ms.remapped = set()
+        for poolid in ms.poolids:
+            if poolid in remap_pools:
+                pm = osdmap.map_pool_pgs_up(poolid)
+                for pgid in parent.pg_up_by_poolid.get(poolid, {}):
+                    if pgid not in pm:
+                        del ms.pg_up[pgid]
+                ms.pg_up.update(pm)
+                ms.pg_up_by_poolid[poolid] = pm
+                ms._build_pool_columns(poolid)
+                ms.remapped.update(pm)
+                ms.remapped.update(parent.pg_up_by_poolid.get(poolid, {}))
+            elif poolid in remap_pgs:
+                pm = dict(parent.pg_up_by_poolid[poolid])
+                up_sets = list(parent.pg_up_sets_by_poolid[poolid])
+                index = {pgid: i for i, pgid in
+                         enumerate(parent.pg_ids_by_poolid[poolid])}
+                for pgid in remap_pgs[poolid]:
+                    if pgid not in pm:
+                        continue
+                    pool, ps = pgid.split('.')
+                    up = osdmap.pg_to_up_acting_osds(poolid, int(ps, 16))['up']
+                    pm[pgid] = up
+                    ms.pg_up[pgid] = up
+                    up_sets[index[pgid]] = tuple(
+                        osd for osd in up if osd != CRUSHMap.ITEM_NONE)
+                    ms.remapped.add(pgid)
+                ms.pg_up_by_poolid[poolid] = pm
+                ms.pg_up_sets_by_poolid[poolid] = up_sets
+        return ms
+
+    def _build_pool_columns(self, poolid):
+        pm = self.pg_up_by_poolid[poolid]
+        pgids = list(pm)
+        objects = array('q')
+        bytes = array('q')
+        for pgid in pgids:
+            stat = self.pg_stat.get(pgid)
+            objects.append(stat['num_objects'] if stat else 0)
+            bytes.append(stat['num_bytes'] if stat else 0)
+        self.pg_ids_by_poolid[poolid] = pgids
+        self.pg_up_sets_by_poolid[poolid] = [
+            tuple(int(osd) for osd in pm[pgid]
+                  if int(osd) != CRUSHMap.ITEM_NONE)
+            for pgid in pgids
+        ]
+        self.pg_objects_by_poolid[poolid] = objects
+        self.pg_bytes_by_poolid[poolid] = bytes
 
     def calc_misplaced_from(self, other_ms):
         num = len(other_ms.pg_up)
         misplaced = 0
-        for pgid, before in six.iteritems(other_ms.pg_up):
-            if before != self.pg_up.get(pgid, []):
+        if self.parent is other_ms:
+            # only the re-mapped PGs can have moved
+            pgids = (pgid for pgid in self.remapped if pgid in other_ms.pg_up)
+        else:
+            pgids = six.iterkeys(other_ms.pg_up)
+        for pgid in pgids:
+            if other_ms.pg_up[pgid] != self.pg_up.get(pgid, []):
                 misplaced += 1
         if num > 0:
             return float(misplaced) / float(num)
@@ -71,9 +277,8 @@ class MsPlan(Plan):
     def final_state(self):
         self.inc.set_osd_reweights(self.osd_weights)
         self.inc.set_crush_compat_weight_set_weights(self.compat_ws)
-        return MappingState(self.initial.osdmap.apply_incremental(self.inc),
-                            self.initial.pg_dump,
-                            'plan %s final' % self.name)
+        return MappingState.from_incremental(self.initial, self.inc,
+                                             'plan %s final' % self.name)
 
     def dump(self):
         return json.dumps(self.inc.dump(), indent=4, sort_keys=True)
@@ -784,54 +989,59 @@ class Module(MgrModule):
         # pool and root actual
         for pool, pi in six.iteritems(pool_info):
             poolid = pi['pool']
-            pm = ms.pg_up_by_poolid[poolid]
-            pgs = 0
-            objects = 0
-            bytes = 0
             pgs_by_osd = {}
             objects_by_osd = {}
             bytes_by_osd = {}
+            # pick a root to associate each pg instance with: the first
+            # of the pool's roots the osd is under.
+            # note that this is imprecise if the roots have
+            # overlapping children.
+            # FIXME: divide bytes by k for EC pools.
+            osd_root = {}
             for root in pe.pool_roots[pool]:
                 for osd in pe.target_by_root[root]:
                     pgs_by_osd[osd] = 0
                     objects_by_osd[osd] = 0
                     bytes_by_osd[osd] = 0
-            for pgid, up in six.iteritems(pm):
-                for osd in [int(osd) for osd in up]:
-                    if osd == CRUSHMap.ITEM_NONE:
-                        continue
+                    osd_root.setdefault(osd, root)
+            root_pgs = {root: actual_by_root[root]['pgs']
+                        for root in pe.pool_roots[pool]}
+            root_objects = {root: actual_by_root[root]['objects']
+                            for root in pe.pool_roots[pool]}
+            root_bytes = {root: actual_by_root[root]['bytes']
+                          for root in pe.pool_roots[pool]}
+            pgs_in_root = dict.fromkeys(pe.pool_roots[pool], 0)
+            objects_in_root = dict.fromkeys(pe.pool_roots[pool], 0)
+            bytes_in_root = dict.fromkeys(pe.pool_roots[pool], 0)
+
+            for up, pg_objects, pg_bytes in zip(
+                    ms.pg_up_sets_by_poolid[poolid],
+                    ms.pg_objects_by_poolid[poolid],
+                    ms.pg_bytes_by_poolid[poolid]):
+                for osd in up:
                     pgs_by_osd[osd] += 1
-                    objects_by_osd[osd] += ms.pg_stat[pgid]['num_objects']
-                    bytes_by_osd[osd] += ms.pg_stat[pgid]['num_bytes']
-                    # pick a root to associate this pg instance with.
-                    # note that this is imprecise if the roots have
-                    # overlapping children.
-                    # FIXME: divide bytes by k for EC pools.
-                    for root in pe.pool_roots[pool]:
-                        if osd in pe.target_by_root[root]:
-                            actual_by_root[root]['pgs'][osd] += 1
-                            actual_by_root[root]['objects'][osd] += ms.pg_stat[pgid]['num_objects']
-                            actual_by_root[root]['bytes'][osd] += ms.pg_stat[pgid]['num_bytes']
-                            pgs += 1
-                            objects += ms.pg_stat[pgid]['num_objects']
-                            bytes += ms.pg_stat[pgid]['num_bytes']
-                            pe.total_by_root[root]['pgs'] += 1
-                            pe.total_by_root[root]['objects'] += ms.pg_stat[pgid]['num_objects']
-                            pe.total_by_root[root]['bytes'] += ms.pg_stat[pgid]['num_bytes']
-                            break
+                    objects_by_osd[osd] += pg_objects
+                    bytes_by_osd[osd] += pg_bytes
+                    root = osd_root.get(osd)
+                    if root is not None:
+                        root_pgs[root][osd] += 1
+                        root_objects[root][osd] += pg_objects
+                        root_bytes[root][osd] += pg_bytes
+                        pgs_in_root[root] += 1
+                        objects_in_root[root] += pg_objects
+                        bytes_in_root[root] += pg_bytes
+
+            pgs = sum(pgs_in_root.values())
+            objects = sum(objects_in_root.values())
+            bytes = sum(bytes_in_root.values())
+            for root in pe.pool_roots[pool]:
+                pe.total_by_root[root]['pgs'] += pgs_in_root[root]
+                pe.total_by_root[root]['objects'] += objects_in_root[root]
+                pe.total_by_root[root]['bytes'] += bytes_in_root[root]
             pe.count_by_pool[pool] = {
-                'pgs': {
-                    k: v
-                    for k, v in six.iteritems(pgs_by_osd)
-                },
-                'objects': {
-                    k: v
-                    for k, v in six.iteritems(objects_by_osd)
-                },
-                'bytes': {
-                    k: v
-                    for k, v in six.iteritems(bytes_by_osd)
-                },
+                'pgs': dict(pgs_by_osd),
+                'objects': dict(objects_by_osd),
+                'bytes': dict(bytes_by_osd),
             }
             pe.actual_by_pool[pool] = {
                 'pgs': {
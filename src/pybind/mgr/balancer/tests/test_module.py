@@ -0,0 +1,218 @@
+import copy
+import zlib
+
+import pytest
+
+from tests import mock
+
+from ..module import MappingState
+
+ITEM_NONE = 0x7fffffff
+
+
+class FakeCRUSH(object):
+    """
+    One bucket per root, holding its OSDs directly. Weight-sets (in
+    choose_args) override the bucket weights.
+    """
+    def __init__(self, crush_dump):
+        self._dump = crush_dump
+
+    def dump(self):
+        return self._dump
+
+    def find_takes(self):
+        return [b['id'] for b in self._dump['buckets']]
+
+    def get_take_weight_osd_map(self, root):
+        [bucket] = [b for b in self._dump['buckets'] if b['id'] == root]
+        weights = dict((i['id'], i['weight']) for i in bucket['items'])
+        for args in self._dump.get('choose_args', {}).values():
+            for arg in args:
+                if arg['bucket_id'] == root:
+                    weights = dict(zip([i['id'] for i in bucket['items']],
+                                       arg['weight_set'][0]))
+        return weights
+
+
+class FakeIncremental(object):
+    def __init__(self, **changes):
+        self.changes = changes
+
+    def dump(self):
+        return self.changes
+
+
+class FakeOSDMap(object):
+    """
+    Maps the PGs of a pool to `size` of the OSDs under the pool's root
+    by weighted random sampling, then applies the pg_upmap_items.
+    """
+    def __init__(self, pools, crush_dump, reweights=None, down=(), upmap_items=None):
+        self.pools = pools
+        self.crush_dump = crush_dump
+        self.reweights = reweights or {}
+        self.down = set(down)
+        self.upmap_items = upmap_items or {}
+
+    def dump(self):
+        return {'pools': [{'pool': p} for p in sorted(self.pools)]}
+
+    def get_crush(self):
+        return FakeCRUSH(self.crush_dump)
+
+    def get_pools_by_take(self, root):
+        return [p for p, pool in self.pools.items() if pool['root'] == root]
+
+    def pg_to_up_acting_osds(self, poolid, ps):
+        pool = self.pools[poolid]
+        weights = self.get_crush().get_take_weight_osd_map(pool['root'])
+
+        def key(osd):
+            weight = weights[osd] * self.reweights.get(osd, 1.0)
+            draw = (zlib.crc32('{}.{}.{}'.format(poolid, ps, osd).encode('utf-8')) &
+                    0xffffffff) + 1
+            return (float(draw) / 2 ** 32) ** (1.0 / weight)
+        candidates = [osd for osd in weights
+                      if osd not in self.down and weights[osd] * self.reweights.get(osd, 1.0) > 0]
+        up = sorted(candidates, key=key, reverse=True)[:pool['size']]
+        up += [ITEM_NONE] * (pool['size'] - len(up))
+        pgid = '{}.{:x}'.format(poolid, ps)
+        for m in self.upmap_items.get(pgid, []):
+            if m['to'] not in up:
+                up = [m['to'] if osd == m['from'] else osd for osd in up]
+        return {'up': up, 'acting': up}
+
+    def map_pool_pgs_up(self, poolid):
+        return dict(('{}.{:x}'.format(poolid, ps), self.pg_to_up_acting_osds(poolid, ps)['up'])
+                    for ps in range(self.pools[poolid]['pg_num']))
+
+    def apply_incremental(self, inc):
+        c = inc.changes
+        if c.get('full_map'):
+            return c['full_map']
+        pools = copy.deepcopy(self.pools)
+        for pool in c.get('new_pools', []):
+            pools[pool['pool']] = dict((k, v) for k, v in pool.items() if k != 'pool')
+        for poolid in c.get('old_pools', []):
+            del pools[poolid]
+        reweights = dict(self.reweights)
+        for w in c.get('new_weight', []):
+            reweights[w['osd']] = w['weight']
+        down = set(self.down) ^ set(s['osd'] for s in c.get('osd_state_xor', []))
+        upmap_items = dict(self.upmap_items)
+        for pgid in c.get('old_pg_upmap_items', []):
+            upmap_items.pop(pgid, None)
+        for i in c.get('new_pg_upmap_items', []):
+            upmap_items[i['pgid']] = i['mappings']
+        return FakeOSDMap(pools, c.get('crush', self.crush_dump), reweights, down,
+                          upmap_items)
+
+
+def crush_dump(weights_by_root, weight_sets=None):
+    dump = {
+        'devices': [{'id': o} for ws in weights_by_root.values() for o in ws],
+        'types': [],
+        'rules': [],
+        'tunables': {},
+        'buckets': [{'id': root, 'items': [{'id': o, 'weight': w}
+                                           for o, w in sorted(ws.items())]}
+                    for root, ws in sorted(weights_by_root.items())],
+    }
+    if weight_sets:
+        dump['choose_args'] = {'-1': [{'bucket_id': root, 'weight_set': [ws]}
+                                      for root, ws in sorted(weight_sets.items())]}
+    return dump
+
+
+ROOTS = {
+    -1: dict((o, 1.0) for o in range(0, 6)),
+    -2: dict((o, 1.0) for o in range(6, 10)),
+}
+
+
+def initial_state():
+    osdmap = FakeOSDMap(
+        pools={1: {'root': -1, 'size': 3, 'pg_num': 64},
+               2: {'root': -1, 'size': 2, 'pg_num': 32},
+               3: {'root': -2, 'size': 2, 'pg_num': 32}},
+        crush_dump=crush_dump(ROOTS),
+        upmap_items={'1.3': [{'from': 0, 'to': 5}]})
+    pg_dump = {
+        'pg_stats': [{'pgid': pgid, 'stat_sum': {'num_objects': i, 'num_bytes': i * 4096}}
+                     for poolid in (1, 2, 3)
+                     for i, pgid in enumerate(sorted(osdmap.map_pool_pgs_up(poolid)))],
+        'pool_stats': [{'poolid': p} for p in (1, 2, 3)],
+    }
+    return MappingState(osdmap, pg_dump, 'initial')
+
+
+def columns(ms, poolid):
+    return sorted(zip(ms.pg_ids_by_poolid[poolid], ms.pg_up_sets_by_poolid[poolid],
+                      ms.pg_objects_by_poolid[poolid], ms.pg_bytes_by_poolid[poolid]))
+
+
+INCREMENTALS = {
+    'reweight': dict(new_weight=[{'osd': 1, 'weight': 0.5}, {'osd': 7, 'weight': 0.0}]),
+    'osd down': dict(osd_state_xor=[{'osd': 2, 'state': ['up']}]),
+    'upmap': dict(new_pg_upmap_items=[{'pgid': '2.5', 'mappings': [{'from': 0, 'to': 4}]},
+                                      {'pgid': '3.1', 'mappings': [{'from': 6, 'to': 9}]}],
+                  old_pg_upmap_items=['1.3']),
+    'weight-set': dict(crush=crush_dump(ROOTS, {-2: [1.0, 0.5, 1.0, 2.0]})),
+    'bucket weight': dict(crush=crush_dump({-1: dict(list(ROOTS[-1].items()) + [(3, 3.0)]), -2: ROOTS[-2]})),
+    'pool': dict(new_pools=[{'pool': 2, 'root': -1, 'size': 3, 'pg_num': 32}]),
+    'mixed': dict(new_weight=[{'osd': 4, 'weight': 0.8}],
+                  new_pg_upmap_items=[{'pgid': '3.2', 'mappings': [{'from': 7, 'to': 8}]}]),
+    'rules': dict(crush=dict(crush_dump(ROOTS), rules=[{'rule_id': 1}])),
+    'old pool': dict(old_pools=[2]),
+}
+
+
+class TestMappingState(object):
+
+    @pytest.fixture(autouse=True)
+    def crushmap(self):
+        with mock.patch('balancer.module.CRUSHMap') as crushmap:
+            crushmap.ITEM_NONE = ITEM_NONE
+            yield
+
+    @pytest.mark.parametrize('name', sorted(INCREMENTALS))
+    def test_from_incremental(self, name):
+        parent = initial_state()
+        inc = FakeIncremental(**INCREMENTALS[name])
+
+        ms = MappingState.from_incremental(parent, inc, 'incremental')
+        full = MappingState(parent.osdmap.apply_incremental(inc), parent.pg_dump, 'full')
+
+        assert ms.pg_up == full.pg_up
+        assert ms.poolids == full.poolids
+        for poolid in full.poolids:
+            assert ms.pg_up_by_poolid[poolid] == full.pg_up_by_poolid[poolid]
+            assert columns(ms, poolid) == columns(full, poolid)
+        assert ms.calc_misplaced_from(parent) == full.calc_misplaced_from(parent)
+
+    def test_incremental_remaps_only_affected_pools(self):
+        parent = initial_state()
+        # only the pool under the root of the OSD
+        inc = FakeIncremental(new_weight=[{'osd': 7, 'weight': 0.0}])
+        with mock.patch.object(FakeOSDMap, 'map_pool_pgs_up',
+                               side_effect=FakeOSDMap.map_pool_pgs_up,
+                               autospec=True) as map_pool_pgs_up:
+            ms = MappingState.from_incremental(parent, inc)
+        assert ms.parent is parent
+        assert [c[0][1] for c in map_pool_pgs_up.call_args_list] == [3]
+        assert ms.pg_up_sets_by_poolid[1] is parent.pg_up_sets_by_poolid[1]
+
+        inc = FakeIncremental(**INCREMENTALS['upmap'])
+        with mock.patch.object(FakeOSDMap, 'map_pool_pgs_up') as map_pool_pgs_up:
+            ms = MappingState.from_incremental(parent, inc)
+        assert not map_pool_pgs_up.called
+        assert ms.remapped == {'1.3', '2.5', '3.1'}
+        assert ms.calc_misplaced_from(parent) > 0
+
+    def test_unchanged(self):
+        parent = initial_state()
+        ms = MappingState.from_incremental(parent, FakeIncremental())
+        assert ms.pg_up == parent.pg_up
+        assert ms.remapped == set()
+        assert ms.calc_misplaced_from(parent) == 0.0
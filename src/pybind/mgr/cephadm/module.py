@@ -2,7 +2,7 @@ import json
 import errno
 import logging
 import time
-from threading import Event
+from threading import Event, Lock
 from functools import wraps
 
 import string
@@ -13,6 +13,7 @@ except ImportError:
 
 
 import datetime
+import hashlib
 import six
 import os
 import random
@@ -50,6 +51,13 @@ DEFAULT_SSH_CONFIG = ('Host *\n'
 
 DATEFMT = '%Y-%m-%dT%H:%M:%S.%f'
 
+# where (content hashed) copies of the cephadm script are staged on hosts
+CEPHADM_STAGING_DIR = '/var/lib/ceph/cephadm'
+
+# seconds between checks of the config database version, which invalidate
+# the cached container images when changed
+CONFIG_VERSION_CHECK_INTERVAL = 10
+
 # for py2 compat
 try:
     from tempfile import TemporaryDirectory # py3
@@ -149,12 +157,16 @@ class AsyncCompletion(orchestrator.Completion):
                 if not value:
                     logger.info('calling map_async without values')
                     callback([])
+                # one item per task, so that a slow host does not hold up
+                # the other hosts of its chunk
                 if six.PY3:
                     CephadmOrchestrator.instance._worker_pool.map_async(do_work, value,
+                                                                    chunksize=1,
                                                                     callback=callback,
                                                                     error_callback=error_callback)
                 else:
                     CephadmOrchestrator.instance._worker_pool.map_async(do_work, value,
+                                                                    chunksize=1,
                                                                     callback=callback)
             else:
                 if six.PY3:
@@ -268,6 +280,68 @@ def with_services(service_type=None,
         return wrapper
     return decorator
 
+class HostConnection(object):
+    """
+    A long-lived SSH connection to a managed host, together with the
+    latency of the commands run over it.
+    """
+
+    # weight of the latest command in the average latency
+    LATENCY_WEIGHT = 0.2
+
+    def __init__(self, host, conn, remote):
+        self.host = host
+        self.conn = conn
+        self.remote = remote
+        # commands are run one at a time over a connection
+        self.lock = Lock()
+        self.created = time.time()
+        self.last_used = self.created
+        self.commands = 0
+        self.last_latency = None  # type: Optional[float]
+        self.avg_latency = None  # type: Optional[float]
+        # python interpreter and staged cephadm script (root mode)
+        self.python = None  # type: Optional[str]
+        self.cephadm_path = None  # type: Optional[str]
+
+    def is_healthy(self):
+        # type: () -> bool
+        gateway = getattr(self.conn, 'gateway', None)
+        if gateway is None:
+            return False
+        try:
+            return gateway.hasreceiver()
+        except Exception:
+            return False
+
+    def record(self, latency):
+        # type: (float) -> None
+        self.commands += 1
+        self.last_used = time.time()
+        self.last_latency = latency
+        if self.avg_latency is None:
+            self.avg_latency = latency
+        else:
+            self.avg_latency += self.LATENCY_WEIGHT * (latency - self.avg_latency)
+
+    def close(self):
+        try:
+            self.conn.exit()
+        except Exception:
+            pass
+
+    def to_json(self):
+        # type: () -> Dict[str, Any]
+        return {
+            'connected': True,
+            'age': time.time() - self.created,
+            'idle': time.time() - self.last_used,
+            'commands': self.commands,
+            'last_latency': self.last_latency,
+            'avg_latency': self.avg_latency,
+        }
+
+
 class CephadmOrchestrator(MgrModule, orchestrator.OrchestratorClientMixin):
 
     _STORE_HOST_PREFIX = "host"
@@ -294,6 +368,19 @@ class CephadmOrchestrator(MgrModule, orchestrator.OrchestratorClientMixin):
             'default': 60,
             'desc': 'seconds to cache service (daemon) inventory',
         },
+        {
+            'name': 'max_concurrent_hosts',
+            'type': 'int',
+            'default': 10,
+            'desc': 'maximum number of hosts to run commands on in parallel '
+                    '(e.g. to refresh services or inventory, or deploy daemons)',
+        },
+        {
+            'name': 'ssh_connection_idle_timeout',
+            'type': 'secs',
+            'default': 10 * 60,
+            'desc': 'seconds after which idle SSH connections to hosts are closed',
+        },
         {
             'name': 'mode',
             'type': 'str',
@@ -331,6 +418,17 @@ class CephadmOrchestrator(MgrModule, orchestrator.OrchestratorClientMixin):
         self.run = True
         self.event = Event()
 
+        # long-lived connections to hosts, by host name
+        self._cons = {}  # type: Dict[str, HostConnection]
+        self._cons_lock = Lock()
+        self._worker_pool = None  # type: Optional[multiprocessing.pool.ThreadPool]
+
+        # container image by entity name, valid for the config db version
+        self._container_images = {}  # type: Dict[str, str]
+        self._container_images_lock = Lock()
+        self._config_version = None  # type: Optional[int]
+        self._config_version_checked = 0.0
+
         self.config_notify()
 
         path = self.get_ceph_option('cephadm_path')
@@ -340,8 +438,9 @@ class CephadmOrchestrator(MgrModule, orchestrator.OrchestratorClientMixin):
         except (IOError, TypeError) as e:
             raise RuntimeError("unable to read cephadm at '%s': %s" % (
                 path, str(e)))
-
-        self._worker_pool = multiprocessing.pool.ThreadPool(1)
+        self._cephadm_path = os.path.join(
+            CEPHADM_STAGING_DIR,
+            'cephadm.' + hashlib.sha256(self._cephadm.encode('utf-8')).hexdigest())
 
         self._reconfig_ssh()
 
@@ -369,11 +468,12 @@ class CephadmOrchestrator(MgrModule, orchestrator.OrchestratorClientMixin):
         # cache is invalidated by
         # 1. timeout
         # 2. refresh parameter
+        # They are kept in memory, too, and loaded from the store once.
         self.inventory_cache = orchestrator.OutdatablePersistentDict(
-            self, self._STORE_HOST_PREFIX + '.devices')
+            self, self._STORE_HOST_PREFIX + '.devices', cached=True)
 
         self.service_cache = orchestrator.OutdatablePersistentDict(
-            self, self._STORE_HOST_PREFIX + '.services')
+            self, self._STORE_HOST_PREFIX + '.services', cached=True)
 
         # ensure the host lists are in sync
         for h in self.inventory.keys():
@@ -394,6 +494,7 @@ class CephadmOrchestrator(MgrModule, orchestrator.OrchestratorClientMixin):
         self.log.info('shutdown')
         self._worker_pool.close()
         self._worker_pool.join()
+        self._reset_cons()
         self.run = False
         self.event.set()
 
@@ -485,6 +586,7 @@ class CephadmOrchestrator(MgrModule, orchestrator.OrchestratorClientMixin):
                     'value': target_name,
                     'who': daemon_type + '.' + d.service_instance,
                 })
+                self._invalidate_container_images()
                 return self._service_action([(
                     d.service_type,
                     d.service_instance,
@@ -551,6 +653,7 @@ class CephadmOrchestrator(MgrModule, orchestrator.OrchestratorClientMixin):
                     'value': target_name,
                     'who': daemon_type,
                 })
+                self._invalidate_container_images()
             to_clean = []
             for section in image_settings.keys():
                 if section.startswith(daemon_type + '.'):
@@ -564,6 +667,7 @@ class CephadmOrchestrator(MgrModule, orchestrator.OrchestratorClientMixin):
                         'name': 'container_image',
                         'who': section,
                     })
+                    self._invalidate_container_images()
             self.log.info('Upgrade: All %s daemons are up to date.' %
                           daemon_type)
 
@@ -575,12 +679,14 @@ class CephadmOrchestrator(MgrModule, orchestrator.OrchestratorClientMixin):
             'value': target_name,
             'who': 'global',
         })
+        self._invalidate_container_images()
         for daemon_type in ['mgr', 'mon', 'osd', 'rgw', 'mds']:
             ret, image, err = self.mon_command({
                 'prefix': 'config rm',
                 'name': 'container_image',
                 'who': daemon_type,
             })
+            self._invalidate_container_images()
 
         self.log.info('Upgrade: Complete!')
         self.upgrade_state = None
@@ -664,6 +770,7 @@ class CephadmOrchestrator(MgrModule, orchestrator.OrchestratorClientMixin):
                 self.log.debug('did _do_upgrade')
 
             self._check_for_strays()
+            self._expire_idle_cons()
 
             sleep_interval = 600
             self.log.debug('Sleeping for %d seconds', sleep_interval)
@@ -686,8 +793,26 @@ class CephadmOrchestrator(MgrModule, orchestrator.OrchestratorClientMixin):
                     opt,  # type: ignore
                     self.get_ceph_option(opt))
             self.log.debug(' native option %s = %s', opt, getattr(self, opt))  # type: ignore
+        self._resize_worker_pool()
+        # the (global) container image may have changed, too
+        self._invalidate_container_images()
         self.event.set()
 
+    def _resize_worker_pool(self):
+        """
+        (Re)create the worker pool running the async completions if its
+        size does not match the max_concurrent_hosts option.
+        """
+        size = max(1, self.max_concurrent_hosts)  # type: ignore
+        if self._worker_pool is not None and self._worker_pool_size == size:
+            return
+        old_pool = self._worker_pool
+        self._worker_pool = multiprocessing.pool.ThreadPool(size)
+        self._worker_pool_size = size
+        if old_pool is not None:
+            # let the queued work finish on the old pool
+            old_pool.close()
+
     def notify(self, notify_type, notify_id):
         self.event.set()
 
@@ -769,6 +894,9 @@ class CephadmOrchestrator(MgrModule, orchestrator.OrchestratorClientMixin):
         elif self.mode == 'cephadm-package':
             self.ssh_user = 'cephadm'
 
+        # reconnect with the new settings
+        self._reset_cons()
+
     @staticmethod
     def can_run():
         if remoto is not None:
@@ -898,8 +1026,22 @@ class CephadmOrchestrator(MgrModule, orchestrator.OrchestratorClientMixin):
 
     def _get_connection(self, host):
         """
-        Setup a connection for running commands on remote host.
+        Get a (pooled) connection for running commands on remote host.
         """
+        hc = self._get_host_connection(host)
+        return hc.conn, hc.remote
+
+    def _get_host_connection(self, host):
+        # type: (str) -> HostConnection
+        self._expire_idle_cons()
+        with self._cons_lock:
+            hc = self._cons.get(host)
+        if hc and hc.is_healthy():
+            return hc
+        if hc:
+            self.log.info('Connection to {} is no longer healthy'.format(host))
+            self._reset_con(host)
+
         n = self.ssh_user + '@' + host
         self.log.info("Opening connection to {} with ssh options '{}'".format(
             n, self._ssh_options))
@@ -909,8 +1051,54 @@ class CephadmOrchestrator(MgrModule, orchestrator.OrchestratorClientMixin):
             ssh_options=self._ssh_options)
 
         r = conn.import_module(remotes)
-
-        return conn, r
+        hc = HostConnection(host, conn, r)
+        with self._cons_lock:
+            old = self._cons.get(host)
+            self._cons[host] = hc
+        if old:
+            # another thread connected to the host meanwhile
+            old.close()
+        return hc
+
+    def _reset_con(self, host):
+        with self._cons_lock:
+            hc = self._cons.pop(host, None)
+        if hc:
+            self.log.debug('Closing connection to %s' % host)
+            hc.close()
+
+    def _reset_cons(self):
+        with self._cons_lock:
+            cons = list(self._cons.values())
+            self._cons = {}
+        for hc in cons:
+            hc.close()
+
+    def _expire_idle_cons(self):
+        """
+        Close the connections which have not been used for a while.
+        """
+        cutoff = time.time() - self.ssh_connection_idle_timeout  # type: ignore
+        with self._cons_lock:
+            idle = [hc for hc in self._cons.values()
+                    if hc.last_used < cutoff and not hc.lock.locked()]
+            for hc in idle:
+                del self._cons[hc.host]
+        for hc in idle:
+            self.log.debug('Closing idle connection to %s' % hc.host)
+            hc.close()
+
+    def get_host_latency(self):
+        """
+        Report the latency of the commands run on each host.
+        """
+        with self._cons_lock:
+            cons = dict(self._cons)
+        latency = {}
+        for host in self.inventory:
+            hc = cons.get(host)
+            latency[host] = hc.to_json() if hc else {'connected': False}
+        return latency
 
     def _executable_path(self, conn, executable):
         """
@@ -936,70 +1124,143 @@ class CephadmOrchestrator(MgrModule, orchestrator.OrchestratorClientMixin):
         """
         Run cephadm on the remote host with the given command + args
         """
-        conn, connr = self._get_connection(host)
-
+        hc = self._get_host_connection(host)
         try:
-            if not image:
-                # get container image
-                ret, image, err = self.mon_command({
-                    'prefix': 'config get',
-                    'who': _name_to_entity_name(entity),
-                    'key': 'container_image',
-                })
-                image = image.strip()
-            self.log.debug('%s container image %s' % (entity, image))
-
-            final_args = [
-                '--image', image,
-                command
-            ]
-            if not no_fsid:
-                final_args += ['--fsid', self._cluster_fsid]
-            final_args += args
-
-            if self.mode == 'root':
-                self.log.debug('args: %s' % (' '.join(final_args)))
-                self.log.debug('stdin: %s' % stdin)
-                script = 'injected_argv = ' + json.dumps(final_args) + '\n'
-                if stdin:
-                    script += 'injected_stdin = ' + json.dumps(stdin) + '\n'
-                script += self._cephadm
-                python = connr.choose_python()
-                if not python:
-                    raise RuntimeError(
-                        'unable to find python on %s (tried %s in %s)' % (
-                            host, remotes.PYTHONS, remotes.PATH))
-                try:
-                    out, err, code = remoto.process.check(
-                        conn,
-                        [python, '-u'],
-                        stdin=script.encode('utf-8'))
-                except RuntimeError as e:
-                    if error_ok:
-                        return '', str(e), 1
-                    raise
-            elif self.mode == 'cephadm-package':
-                try:
-                    out, err, code = remoto.process.check(
-                        conn,
-                        ['sudo', '/usr/bin/cephadm'] + final_args,
-                        stdin=stdin)
-                except RuntimeError as e:
-                    if error_ok:
-                        return '', str(e), 1
-                    raise
-            if code and not error_ok:
-                raise RuntimeError(
-                    'cephadm exited with an error code: %d, stderr:%s' % (
-                        code, '\n'.join(err)))
-            return out, err, code
-
+            with hc.lock:
+                return self._run_cephadm_on(hc, entity, command, args,
+                                            stdin, no_fsid, error_ok, image)
         except Exception as ex:
+            # anything but a command failure is a connection failure
+            if not isinstance(ex, RuntimeError):
+                self._reset_con(host)
             self.log.exception(ex)
             raise
 
-        finally:
-            conn.exit()
+    def _run_cephadm_on(self, hc, entity, command, args,
+                        stdin, no_fsid, error_ok, image):
+        host = hc.host
+        conn = hc.conn
+        connr = hc.remote
+        if not image:
+            image = self._get_container_image(entity)
+        self.log.debug('%s container image %s' % (entity, image))
+
+        final_args = [
+            '--image', image,
+            command
+        ]
+        if not no_fsid:
+            final_args += ['--fsid', self._cluster_fsid]
+        final_args += args
+
+        if self.mode == 'root':
+            self.log.debug('args: %s' % (' '.join(final_args)))
+            self.log.debug('stdin: %s' % stdin)
+            if not hc.python:
+                hc.python = connr.choose_python()
+            if not hc.python:
+                raise RuntimeError(
+                    'unable to find python on %s (tried %s in %s)' % (
+                        host, remotes.PYTHONS, remotes.PATH))
+            try:
+                for attempt in range(2):
+                    path = self._stage_cephadm(hc)
+                    start = time.time()
+                    out, err, code = remoto.process.check(
+                        conn,
+                        [hc.python, '-u', path] + final_args,
+                        stdin=stdin.encode('utf-8') if stdin else None)
+                    hc.record(time.time() - start)
+                    if code and any("can't open file" in line for line in err):
+                        # the staged copy went away: stage it again
+                        hc.cephadm_path = None
+                        continue
+                    break
+            except RuntimeError as e:
+                if error_ok:
+                    return '', str(e), 1
+                raise
+        elif self.mode == 'cephadm-package':
+            try:
+                start = time.time()
+                out, err, code = remoto.process.check(
+                    conn,
+                    ['sudo', '/usr/bin/cephadm'] + final_args,
+                    stdin=stdin)
+                hc.record(time.time() - start)
+            except RuntimeError as e:
+                if error_ok:
+                    return '', str(e), 1
+                raise
+        if code and not error_ok:
+            raise RuntimeError(
+                'cephadm exited with an error code: %d, stderr:%s' % (
+                    code, '\n'.join(err)))
+        return out, err, code
+
+    def _invalidate_container_images(self):
+        with self._container_images_lock:
+            self._container_images = {}
+            self._config_version = None
+
+    def _check_config_version(self):
+        """
+        Invalidate the cached container images if the config database
+        changed since it was last checked.
+        """
+        now = time.time()
+        if now - self._config_version_checked < CONFIG_VERSION_CHECK_INTERVAL:
+            return
+        self._config_version_checked = now
+        ret, out, err = self.mon_command({
+            'prefix': 'config log',
+            'num': 1,
+            'format': 'json',
+        })
+        try:
+            version = json.loads(out)[0]['version']
+        except (ValueError, IndexError, KeyError, TypeError):
+            version = None
+        with self._container_images_lock:
+            if version is None or version != self._config_version:
+                self._container_images = {}
+            self._config_version = version
+
+    def _get_container_image(self, entity):
+        # type: (str) -> str
+        self._check_config_version()
+        who = _name_to_entity_name(entity)
+        with self._container_images_lock:
+            image = self._container_images.get(who)
+            container_images = self._container_images
+        if image is not None:
+            return image
+
+        ret, image, err = self.mon_command({
+            'prefix': 'config get',
+            'who': who,
+            'key': 'container_image',
+        })
+        image = image.strip()
+        with self._container_images_lock:
+            # unless invalidated meanwhile
+            if container_images is self._container_images:
+                self._container_images[who] = image
+        return image
+
+    def _stage_cephadm(self, hc):
+        # type: (HostConnection) -> str
+        """
+        Make sure the host has a copy of (this version of) the cephadm
+        script, and return its path.
+        """
+        if hc.cephadm_path != self._cephadm_path:
+            if not hc.remote.file_exists(self._cephadm_path):
+                self.log.info('Staging %s on %s' % (self._cephadm_path, hc.host))
+                hc.remote.write_file(self._cephadm_path, self._cephadm, 0o700,
+                                     'cephadm.')
+            hc.cephadm_path = self._cephadm_path
+        return self._cephadm_path
 
     def _get_hosts(self, wanted=None):
         return self.inventory_cache.items_filtered(wanted)
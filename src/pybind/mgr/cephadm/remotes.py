@@ -22,6 +22,30 @@ def choose_python():
                 return p
     return None
 
+def file_exists(path):
+    return os.path.isfile(path)
+
+def write_file(path, content, mode, stale_prefix=None):
+    """
+    Atomically write a file, optionally removing the files with the given
+    name prefix (e.g. older versions) next to it.
+    """
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname, 0o755)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(path))
+    try:
+        os.fchmod(fd, mode)
+        os.write(fd, content.encode('utf-8'))
+    finally:
+        os.close(fd)
+    os.rename(tmp, path)
+    if stale_prefix:
+        for name in os.listdir(dirname):
+            p = os.path.join(dirname, name)
+            if name.startswith(stale_prefix) and p != path:
+                os.unlink(p)
+
 if __name__ == '__channelexec__':
     for item in channel:  # type: ignore
         channel.send(eval(item))  # type: ignore
@@ -30,9 +30,17 @@ def get_store_prefix(self, prefix):
 def get_ceph_option(_, key):
     return __file__
 
+
+def get_module_option(self, key, default=None):
+    for opt in self.MODULE_OPTIONS:
+        if opt['name'] == key:
+            return opt.get('default', default)
+    return default
+
 @pytest.yield_fixture()
 def cephadm_module():
     with mock.patch("cephadm.module.CephadmOrchestrator.get_ceph_option", get_ceph_option),\
+            mock.patch("cephadm.module.CephadmOrchestrator.get_module_option", get_module_option),\
             mock.patch("cephadm.module.CephadmOrchestrator._configure_logging", lambda *args: None),\
             mock.patch("cephadm.module.CephadmOrchestrator.remote"),\
             mock.patch("cephadm.module.CephadmOrchestrator.set_store", set_store),\
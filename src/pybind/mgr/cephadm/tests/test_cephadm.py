@@ -57,6 +57,66 @@ class TestCephadm(object):
         c = cephadm_module.get_hosts()
         assert wait(cephadm_module, c) == []
 
+    @mock.patch("cephadm.module.remoto")
+    def test_connection_pool(self, _remoto, cephadm_module):
+        _remoto.process.check.return_value = (['[]'], [], 0)
+        with mock.patch("cephadm.module.CephadmOrchestrator.mon_command", mon_command):
+            cephadm_module.inventory['test'] = {}
+            for _ in range(3):
+                cephadm_module._run_cephadm('test', 'mon', 'ls', [], no_fsid=True)
+            # the connection is reused
+            assert _remoto.Connection.call_count == 1
+            latency = cephadm_module.get_host_latency()['test']
+            assert latency['connected']
+            assert latency['commands'] == 3
+
+            # unhealthy connections are replaced
+            conn = _remoto.Connection.return_value
+            conn.gateway.hasreceiver.return_value = False
+            cephadm_module._run_cephadm('test', 'mon', 'ls', [], no_fsid=True)
+            assert _remoto.Connection.call_count == 2
+            conn.gateway.hasreceiver.return_value = True
+
+            # idle connections are closed
+            cephadm_module.ssh_connection_idle_timeout = -1
+            cephadm_module._expire_idle_cons()
+            assert cephadm_module.get_host_latency() == {'test': {'connected': False}}
+            del cephadm_module.inventory['test']
+
+    @mock.patch("cephadm.module.remoto")
+    def test_staged_cephadm(self, _remoto, cephadm_module):
+        _remoto.process.check.return_value = (['[]'], [], 0)
+        remote = _remoto.Connection.return_value.import_module.return_value
+        remote.choose_python.return_value = 'python3'
+        remote.file_exists.return_value = False
+
+        def mon_command(cmd):
+            if cmd['prefix'] == 'config log':
+                return 0, json.dumps([{'version': 1}]), ''
+            return 0, 'image\n', ''
+
+        with mock.patch("cephadm.module.CephadmOrchestrator.mon_command") as _mon_command:
+            _mon_command.side_effect = mon_command
+            cephadm_module.inventory['test'] = {}
+            for _ in range(2):
+                cephadm_module._run_cephadm('test', 'mon', 'ls', [], no_fsid=True)
+            # the script is staged once, and run from there
+            assert remote.write_file.call_count == 1
+            path = remote.write_file.call_args[0][0]
+            assert _remoto.process.check.call_args[0][1][:3] == ['python3', '-u', path]
+            # the container image is looked up once
+            gets = [c for c in _mon_command.call_args_list
+                    if c[0][0]['prefix'] == 'config get']
+            assert len(gets) == 1
+
+            cephadm_module._invalidate_container_images()
+            cephadm_module._run_cephadm('test', 'mon', 'ls', [], no_fsid=True)
+            gets = [c for c in _mon_command.call_args_list
+                    if c[0][0]['prefix'] == 'config get']
+            assert len(gets) == 2
+            del cephadm_module.inventory['test']
+            cephadm_module._reset_cons()
+
     @mock.patch("cephadm.module.CephadmOrchestrator._run_cephadm", _run_cephadm('[]'))
     def test_service_ls(self, cephadm_module):
         with self._with_host(cephadm_module, 'test'):
@@ -98,6 +98,48 @@ class Rbd(RESTController):
     def list(self, pool_name=None):
         return self._rbd_list(pool_name)
 
+    @RESTController.Collection('GET', query_params=['pool_name', 'namespace', 'offset',
+                                                    'limit', 'sort', 'search', 'fields'])
+    @handle_rbd_error()
+    @handle_rados_error('pool')
+    def page(self, pool_name=None, namespace=None, offset=0, limit=10, sort='name',
+             search=None, fields=None):
+        """
+        List a page of images, sorted and filtered by name.
+
+        :param sort: the key to sort by (name, id, pool_name or namespace),
+                     prefixed with '-' for a descending order
+        :param search: only list the images with this in their name
+        :param fields: the comma separated list of expensive fields to get
+                       (snapshots, disk_usage and/or configuration)
+        """
+        offset = int(offset)
+        limit = int(limit)
+        if offset < 0 or limit < 0:
+            raise DashboardException(msg='Invalid offset or limit',
+                                     code='invalid_page', component='rbd')
+        if sort.lstrip('-') not in RbdService.IMAGE_SORT_KEYS:
+            raise DashboardException(msg='Invalid sort key: {}'.format(sort),
+                                     code='invalid_sort_key', component='rbd')
+        fields = [f for f in fields.split(',') if f] if fields else []
+        for field in fields:
+            if field not in RbdService.EXPENSIVE_IMAGE_FIELDS:
+                raise DashboardException(msg='Invalid field: {}'.format(field),
+                                         code='invalid_field', component='rbd')
+
+        if pool_name:
+            pools = [pool_name]
+        else:
+            pools = [p['pool_name'] for p in CephService.get_pool_list('rbd')]
+        total, images = RbdService.rbd_pool_list_page(
+            pools, namespace, offset, limit, sort, search, fields)
+        return {
+            'total': total,
+            'offset': offset,
+            'limit': limit,
+            'images': images,
+        }
+
     @handle_rbd_error()
     @handle_rados_error('pool')
     def get(self, image_spec):
@@ -6,6 +6,7 @@ from __future__ import absolute_import
 
 import collections
 import errno
+import json
 import logging
 import os
 import socket
@@ -14,7 +15,8 @@ import threading
 import time
 from uuid import uuid4
 from OpenSSL import crypto
-from mgr_module import MgrModule, MgrStandbyModule, Option, CLIWriteCommand
+from mgr_module import MgrModule, MgrStandbyModule, Option, CLIReadCommand, \
+    CLIWriteCommand
 from mgr_util import get_default_addr, ServerConfigException, verify_tls_files
 
 try:
@@ -44,11 +46,12 @@ from . import mgr
 from .controllers import generate_routes, json_error_page
 from .grafana import push_local_dashboards
 from .tools import NotificationQueue, RequestLoggingTool, TaskManager, \
-                   prepare_url_prefix, str_to_bool
+                   ViewCache, prepare_url_prefix, str_to_bool
 from .services.auth import AuthManager, AuthManagerTool, JwtManager
 from .services.sso import SSO_COMMANDS, \
                           handle_sso_command
 from .services.exception import dashboard_exception_handler
+from .services.rbd import RbdUsageIndex
 from .settings import options_command_list, options_schema_list, \
                       handle_option_command
 
@@ -324,6 +327,7 @@ class Module(MgrModule, CherryPyConfig):
         cherrypy.engine.start()
         NotificationQueue.start_queue()
         TaskManager.init()
+        RbdUsageIndex.start_indexer()
         logger.info('Engine started.')
         update_dashboards = str_to_bool(
             self.get_module_option('GRAFANA_UPDATE_DASHBOARDS', 'False'))
@@ -338,6 +342,7 @@ class Module(MgrModule, CherryPyConfig):
         # wait for the shutdown event
         self.shutdown_event.wait()
         self.shutdown_event.clear()
+        RbdUsageIndex.stop()
         NotificationQueue.stop()
         cherrypy.engine.stop()
         logger.info('Engine stopped')
@@ -372,6 +377,17 @@ class Module(MgrModule, CherryPyConfig):
             self.set_store('key', inbuf)
         return 0, 'SSL certificate key updated', ''
 
+    @CLIReadCommand("dashboard rbd-usage",
+                    "name=pool_name,type=CephString,req=false",
+                    "Show the bytes provisioned by the RBD images, as indexed")
+    def rbd_usage(self, pool_name=None):
+        return 0, json.dumps(RbdUsageIndex.report(pool_name), indent=2), ''
+
+    @CLIReadCommand("dashboard view-cache-stats",
+                    desc="Show the hits, misses and fetch times of the cached views")
+    def view_cache_stats(self):
+        return 0, json.dumps(ViewCache.views_stats(), indent=2, sort_keys=True), ''
+
     def handle_command(self, inbuf, cmd):
         # pylint: disable=too-many-return-statements
         res = handle_option_command(cmd)
@@ -1,15 +1,25 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 
+import collections
+import logging
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
 import six
 
 import rbd
 
 from .. import mgr
+from ..settings import Settings
 from ..tools import ViewCache
 from .ceph_service import CephService
 
 
+logger = logging.getLogger('rbd')
+
+
 RBD_FEATURES_NAME_MAPPING = {
     rbd.RBD_FEATURE_LAYERING: "layering",
     rbd.RBD_FEATURE_STRIPINGV2: "striping",
@@ -184,8 +194,22 @@ class RbdConfiguration(object):
 
 class RbdService(object):
 
+    # fields of the images which are expensive to get: the image listing
+    # only gets them on request
+    EXPENSIVE_IMAGE_FIELDS = ('snapshots', 'disk_usage', 'configuration')
+
+    # keys the image listing can be sorted by
+    IMAGE_SORT_KEYS = ('name', 'id', 'pool_name', 'namespace')
+
+    # images which are read at once when listing images
+    MAX_CONCURRENT_IMAGES = 8
+
     @classmethod
-    def _rbd_disk_usage(cls, image, snaps, whole_object=True):
+    def _rbd_snap_disk_usage(cls, image, name, size, prev_snap, whole_object=True):
+        """
+        The bytes provisioned by a snapshot (or the HEAD, for name=None)
+        since the previous one.
+        """
         class DUCallback(object):
             def __init__(self):
                 self.used_size = 0
@@ -194,22 +218,52 @@ class RbdService(object):
                 if exists:
                     self.used_size += length
 
+        image.set_snap(name)
+        du_callb = DUCallback()
+        image.diff_iterate(0, size, prev_snap, du_callb,
+                           whole_object=whole_object)
+        return du_callb.used_size
+
+    @classmethod
+    def _rbd_disk_usage(cls, image, snaps, whole_object=True):
         snap_map = {}
         prev_snap = None
         total_used_size = 0
         for _, size, name in snaps:
-            image.set_snap(name)
-            du_callb = DUCallback()
-            image.diff_iterate(0, size, prev_snap, du_callb,
-                               whole_object=whole_object)
-            snap_map[name] = du_callb.used_size
-            total_used_size += du_callb.used_size
+            snap_map[name] = cls._rbd_snap_disk_usage(image, name, size, prev_snap,
+                                                      whole_object)
+            total_used_size += snap_map[name]
             prev_snap = name
 
         return total_used_size, snap_map
 
     @classmethod
-    def rbd_image(cls, ioctx, pool_name, namespace, image_name):
+    def _rbd_image_snapshots(cls, img, children=True):
+        snapshots = []
+        for snap in img.list_snaps():
+            snap['timestamp'] = "{}Z".format(
+                img.get_snap_timestamp(snap['id']).isoformat())
+            snap['is_protected'] = img.is_protected_snap(snap['name'])
+            snap['used_bytes'] = None
+            if children:
+                snap['children'] = []
+                img.set_snap(snap['name'])
+                for child_pool_name, child_image_name in img.list_children():
+                    snap['children'].append({
+                        'pool_name': child_pool_name,
+                        'image_name': child_image_name
+                    })
+            snapshots.append(snap)
+        return snapshots
+
+    @classmethod
+    def rbd_image(cls, ioctx, pool_name, namespace, image_name, fields=None):
+        """
+        :param fields: the expensive fields (see EXPENSIVE_IMAGE_FIELDS) to
+                       get, all of them by default.
+        """
+        if fields is None:
+            fields = cls.EXPENSIVE_IMAGE_FIELDS
         with rbd.Image(ioctx, image_name) as img:
 
             stat = img.stat()
@@ -244,45 +298,38 @@ class RbdService(object):
                 stat['parent'] = None
 
             # snapshots
-            stat['snapshots'] = []
-            for snap in img.list_snaps():
-                snap['timestamp'] = "{}Z".format(
-                    img.get_snap_timestamp(snap['id']).isoformat())
-                snap['is_protected'] = img.is_protected_snap(snap['name'])
-                snap['used_bytes'] = None
-                snap['children'] = []
-                img.set_snap(snap['name'])
-                for child_pool_name, child_image_name in img.list_children():
-                    snap['children'].append({
-                        'pool_name': child_pool_name,
-                        'image_name': child_image_name
-                    })
-                stat['snapshots'].append(snap)
+            if 'snapshots' in fields or 'disk_usage' in fields:
+                snapshots = cls._rbd_image_snapshots(
+                    img, children='snapshots' in fields)
+            if 'snapshots' in fields:
+                stat['snapshots'] = snapshots
 
             # disk usage
-            img_flags = img.flags()
-            if 'fast-diff' in stat['features_name'] and \
-                    not rbd.RBD_FLAG_FAST_DIFF_INVALID & img_flags:
-                snaps = [(s['id'], s['size'], s['name'])
-                         for s in stat['snapshots']]
-                snaps.sort(key=lambda s: s[0])
-                snaps += [(snaps[-1][0] + 1 if snaps else 0, stat['size'], None)]
-                total_prov_bytes, snaps_prov_bytes = cls._rbd_disk_usage(
-                    img, snaps, True)
-                stat['total_disk_usage'] = total_prov_bytes
-                for snap, prov_bytes in snaps_prov_bytes.items():
-                    if snap is None:
-                        stat['disk_usage'] = prov_bytes
-                        continue
-                    for ss in stat['snapshots']:
-                        if ss['name'] == snap:
-                            ss['disk_usage'] = prov_bytes
-                            break
-            else:
-                stat['total_disk_usage'] = None
-                stat['disk_usage'] = None
+            if 'disk_usage' in fields:
+                img_flags = img.flags()
+                if 'fast-diff' in stat['features_name'] and \
+                        not rbd.RBD_FLAG_FAST_DIFF_INVALID & img_flags:
+                    snaps = [(s['id'], s['size'], s['name'])
+                             for s in snapshots]
+                    snaps.sort(key=lambda s: s[0])
+                    snaps += [(snaps[-1][0] + 1 if snaps else 0, stat['size'], None)]
+                    total_prov_bytes, snaps_prov_bytes = RbdUsageIndex.disk_usage(
+                        img, pool_name, namespace, stat['id'], image_name, snaps)
+                    stat['total_disk_usage'] = total_prov_bytes
+                    for snap, prov_bytes in snaps_prov_bytes.items():
+                        if snap is None:
+                            stat['disk_usage'] = prov_bytes
+                            continue
+                        for ss in snapshots:
+                            if ss['name'] == snap:
+                                ss['disk_usage'] = prov_bytes
+                                break
+                else:
+                    stat['total_disk_usage'] = None
+                    stat['disk_usage'] = None
 
-            stat['configuration'] = RbdConfiguration(pool_ioctx=ioctx, image_name=image_name).list()
+            if 'configuration' in fields:
+                stat['configuration'] = list(img.config_list())
 
             return stat
 
@@ -310,6 +357,7 @@ class RbdService(object):
             for current_namespace in namespaces:
                 ioctx.set_namespace(current_namespace)
                 names = cls._rbd_image_names(ioctx)
+                image_ids = []
                 for name in names:
                     try:
                         stat = cls._rbd_image_stat(ioctx, pool_name, current_namespace, name)
@@ -317,4 +365,313 @@ class RbdService(object):
                         # may have been removed in the meanwhile
                         continue
                     result.append(stat)
+                    image_ids.append(stat['id'])
+                RbdUsageIndex.prune(pool_name, current_namespace, image_ids)
             return result
+
+    @classmethod
+    def rbd_image_refs(cls, pool_names, namespace=None):
+        """
+        List the images of the pools (and namespaces), without opening them.
+        """
+        rbd_inst = rbd.RBD()
+        result = []
+        for pool_name in pool_names:
+            with mgr.rados.open_ioctx(pool_name) as ioctx:
+                if namespace:
+                    namespaces = [namespace]
+                else:
+                    namespaces = rbd_inst.namespace_list(ioctx)
+                    # images without namespace
+                    namespaces.append('')
+                for current_namespace in namespaces:
+                    ioctx.set_namespace(current_namespace)
+                    images = rbd_inst.list2(ioctx)
+                    for image in images:
+                        result.append({
+                            'pool_name': pool_name,
+                            'namespace': current_namespace,
+                            'name': image['name'],
+                            'id': image['id'],
+                        })
+                    RbdUsageIndex.prune(pool_name, current_namespace,
+                                        [image['id'] for image in images])
+        return result
+
+    @classmethod
+    def rbd_images(cls, refs, fields=()):
+        """
+        Get the images, a few of them at once.
+
+        :param refs: images, as returned by rbd_image_refs()
+        :param fields: the expensive fields (see EXPENSIVE_IMAGE_FIELDS) to get
+        """
+        ioctxs = {}
+        try:
+            for ref in refs:
+                key = (ref['pool_name'], ref['namespace'])
+                if key not in ioctxs:
+                    ioctxs[key] = mgr.rados.open_ioctx(ref['pool_name'])
+                    ioctxs[key].set_namespace(ref['namespace'])
+
+            def _image(ref):
+                try:
+                    return cls.rbd_image(ioctxs[(ref['pool_name'], ref['namespace'])],
+                                         ref['pool_name'], ref['namespace'], ref['name'],
+                                         fields)
+                except rbd.ImageNotFound:
+                    # may have been removed in the meanwhile
+                    return None
+
+            if len(refs) > 1:
+                pool = ThreadPool(min(len(refs), cls.MAX_CONCURRENT_IMAGES))
+                try:
+                    images = pool.map(_image, refs)
+                finally:
+                    pool.terminate()
+            else:
+                images = [_image(ref) for ref in refs]
+        finally:
+            for ioctx in ioctxs.values():
+                ioctx.close()
+        return [image for image in images if image is not None]
+
+    @classmethod
+    def rbd_pool_list_page(cls, pool_names, namespace=None, offset=0, limit=None,
+                           sort='name', search=None, fields=()):
+        """
+        List a page of the images of the pools.
+
+        The images are filtered and sorted by the fields known without opening
+        them, so that only the images of the page are opened.
+
+        :param sort: one of IMAGE_SORT_KEYS, prefixed with '-' for a
+                     descending order
+        :param search: only list the images with this in their name (ignoring
+                       the case)
+        :param fields: the expensive fields (see EXPENSIVE_IMAGE_FIELDS) to get
+        :return: the number of images found, and the images of the page
+        """
+        reverse = sort.startswith('-')
+        sort_key = sort.lstrip('-')
+        assert sort_key in cls.IMAGE_SORT_KEYS
+
+        refs = cls.rbd_image_refs(pool_names, namespace)
+        if search:
+            search = search.lower()
+            refs = [ref for ref in refs if search in ref['name'].lower()]
+        refs.sort(key=lambda ref: (ref[sort_key], ref['pool_name'], ref['namespace'],
+                                   ref['name']),
+                  reverse=reverse)
+        end = offset + limit if limit is not None else None
+        return len(refs), cls.rbd_images(refs[offset:end], fields)
+
+
+class RbdUsageIndex(threading.Thread):
+    """
+    Index of the bytes provisioned by the RBD images and their snapshots.
+
+    Snapshots don't change, so the bytes a snapshot provisions (since the
+    previous snapshot) are computed once, and kept by image and snapshot
+    id. The bytes provisioned by the HEAD of an image (since its last
+    snapshot) are computed again once older than the
+    RBD_USAGE_REFRESH_INTERVAL setting. A thread refreshes the index at
+    that interval, so that requests rarely need to scan an image.
+
+    The images removed are forgotten when their pool is listed, by the
+    thread or by a request. The images found by the thread are all kept
+    until then. Of the images only indexed by requests (e.g. while the
+    thread is disabled), at most MAX_IMAGES are kept, those used least
+    recently are dropped first.
+    """
+    MAX_IMAGES = 10000
+
+    _lock = threading.Lock()
+    _stopping = threading.Event()
+    _instance = None
+
+    # (pool_name, namespace, image_id) -> usage of the image:
+    # {'name': ..., 'snaps': {(snap_id, prev_snap_id): bytes},
+    #  'head': (prev_snap_id, bytes, timestamp)}
+    # of the images found by the thread
+    _indexed = {}
+    # of the other images, least recently used first
+    _images = collections.OrderedDict()
+
+    @classmethod
+    def start_indexer(cls):
+        with cls._lock:
+            if cls._instance:
+                return
+            cls._stopping.clear()
+            cls._instance = RbdUsageIndex()
+            cls._instance.daemon = True
+        cls._instance.start()
+
+    @classmethod
+    def stop(cls):
+        with cls._lock:
+            instance = cls._instance
+            cls._instance = None
+        if instance:
+            cls._stopping.set()
+            instance.join()
+
+    @classmethod
+    def disk_usage(cls, image, pool_name, namespace, image_id, image_name, snaps,
+                   max_age=None, indexed=False):
+        """
+        Like RbdService._rbd_disk_usage(), using (and updating) the index.
+
+        :param snaps: (id, size, name) of the snapshots, ordered by id, and
+                      then of the HEAD (with name=None)
+        :param max_age: recompute the bytes provisioned by the HEAD if older
+                        than this (in seconds), RBD_USAGE_REFRESH_INTERVAL
+                        by default
+        :param indexed: whether the image was found by the thread
+        """
+        if max_age is None:
+            max_age = Settings.RBD_USAGE_REFRESH_INTERVAL
+        key = (pool_name, namespace or '', image_id)
+        with cls._lock:
+            usage = cls._indexed.get(key) or cls._images.get(key) or \
+                {'snaps': {}, 'head': None}
+            snap_usage = dict(usage['snaps'])
+            head = usage['head']
+
+        snap_map = {}
+        new_snap_usage = {}
+        prev_snap = None
+        prev_snap_id = None
+        total_used_size = 0
+        for snap_id, size, name in snaps:
+            if name is None:
+                if head and head[0] == prev_snap_id and time.time() - head[2] < max_age:
+                    used_size = head[1]
+                else:
+                    used_size = RbdService._rbd_snap_disk_usage(
+                        image, name, size, prev_snap)
+                    head = (prev_snap_id, used_size, time.time())
+            else:
+                used_size = snap_usage.get((snap_id, prev_snap_id))
+                if used_size is None:
+                    used_size = RbdService._rbd_snap_disk_usage(
+                        image, name, size, prev_snap)
+                # the snapshots removed since are dropped
+                new_snap_usage[(snap_id, prev_snap_id)] = used_size
+            snap_map[name] = used_size
+            total_used_size += used_size
+            prev_snap = name
+            prev_snap_id = snap_id
+
+        usage = {
+            'name': image_name,
+            'snaps': new_snap_usage,
+            'head': head,
+            'total': total_used_size,
+        }
+        with cls._lock:
+            cls._images.pop(key, None)
+            if indexed or key in cls._indexed:
+                cls._indexed[key] = usage
+            else:
+                cls._images[key] = usage
+                while len(cls._images) > cls.MAX_IMAGES:
+                    cls._images.popitem(last=False)
+        return total_used_size, snap_map
+
+    @classmethod
+    def prune(cls, pool_name, namespace, image_ids):
+        """
+        Forget the images of the pool (and namespace) but `image_ids`, as
+        they have been removed.
+        """
+        image_ids = set(image_ids)
+        with cls._lock:
+            for images in (cls._indexed, cls._images):
+                for key in list(images):
+                    if key[:2] == (pool_name, namespace or '') and key[2] not in image_ids:
+                        del images[key]
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._indexed.clear()
+            cls._images.clear()
+
+    @classmethod
+    def report(cls, pool_name=None):
+        """
+        :return: the indexed images, with the bytes they provision
+        """
+        now = time.time()
+        with cls._lock:
+            images = sorted(list(cls._indexed.items()) + list(cls._images.items()))
+        return [{
+            'pool_name': image_pool_name,
+            'namespace': namespace,
+            'id': image_id,
+            'name': usage['name'],
+            'disk_usage': usage['head'][1] if usage['head'] else None,
+            'total_disk_usage': usage['total'],
+            'snapshots': len(usage['snaps']),
+            'age': now - usage['head'][2] if usage['head'] else None,
+        } for (image_pool_name, namespace, image_id), usage in images
+                if pool_name is None or pool_name == image_pool_name]
+
+    @classmethod
+    def _index_image(cls, ioctx, pool_name, namespace, image_id, image_name):
+        with rbd.Image(ioctx, image_id=image_id, read_only=True) as img:
+            if not img.features() & rbd.RBD_FEATURE_FAST_DIFF or \
+                    rbd.RBD_FLAG_FAST_DIFF_INVALID & img.flags():
+                return
+            snaps = sorted((s['id'], s['size'], s['name']) for s in img.list_snaps())
+            snaps += [(snaps[-1][0] + 1 if snaps else 0, img.size(), None)]
+            cls.disk_usage(img, pool_name, namespace, image_id, image_name, snaps,
+                           indexed=True)
+
+    @classmethod
+    def _index_pool(cls, pool_name):
+        rbd_inst = rbd.RBD()
+        found = set()
+        with mgr.rados.open_ioctx(pool_name) as ioctx:
+            namespaces = rbd_inst.namespace_list(ioctx)
+            # images without namespace
+            namespaces.append('')
+            for namespace in namespaces:
+                ioctx.set_namespace(namespace)
+                for image in rbd_inst.list2(ioctx):
+                    if cls._stopping.is_set():
+                        return found
+                    found.add((pool_name, namespace, image['id']))
+                    try:
+                        cls._index_image(ioctx, pool_name, namespace, image['id'],
+                                         image['name'])
+                    except rbd.ImageNotFound:
+                        # may have been removed in the meanwhile
+                        found.discard((pool_name, namespace, image['id']))
+        return found
+
+    @classmethod
+    def _index_pools(cls):
+        found = set()
+        for pool in CephService.get_pool_list('rbd'):
+            found |= cls._index_pool(pool['pool_name'])
+        if not cls._stopping.is_set():
+            # forget the removed images
+            with cls._lock:
+                for images in (cls._indexed, cls._images):
+                    for key in set(images) - found:
+                        del images[key]
+
+    def run(self):
+        logger.info('starting RBD usage indexer')
+        while not self._stopping.is_set():
+            interval = Settings.RBD_USAGE_REFRESH_INTERVAL
+            if interval > 0:
+                try:
+                    self._index_pools()
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception('failed to index the RBD usage')
+            self._stopping.wait(interval if interval > 0 else 60)
+        logger.info('RBD usage indexer stopped')
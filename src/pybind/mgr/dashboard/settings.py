@@ -49,6 +49,12 @@ class Options(object):
     PROMETHEUS_API_HOST = ('', str)
     ALERTMANAGER_API_HOST = ('', str)
 
+    # RBD settings
+    # Seconds after which the bytes provisioned by (the HEAD of) RBD images
+    # are computed again, and interval of the RBD usage indexer. '0'
+    # disables the indexer, and the HEAD usage is always computed.
+    RBD_USAGE_REFRESH_INTERVAL = (300, int)
+
     # iSCSI management settings
     ISCSI_API_SSL_VERIFICATION = (True, bool)
 
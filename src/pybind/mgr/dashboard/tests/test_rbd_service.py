@@ -4,10 +4,17 @@ from __future__ import absolute_import
 
 import unittest
 
-from ..services.rbd import get_image_spec, parse_image_spec
+try:
+    import mock
+except ImportError:
+    import unittest.mock as mock
 
+from . import KVStoreMockMixin
+from ..services.rbd import get_image_spec, parse_image_spec, RbdService, RbdUsageIndex
+from ..settings import Settings
 
-class RbdServiceTest(unittest.TestCase):
+
+class RbdServiceTest(unittest.TestCase, KVStoreMockMixin):
 
     def test_compose_image_spec(self):
         self.assertEqual(get_image_spec('mypool', 'myns', 'myimage'), 'mypool/myns/myimage')
@@ -16,3 +23,113 @@ class RbdServiceTest(unittest.TestCase):
     def test_parse_image_spec(self):
         self.assertEqual(parse_image_spec('mypool/myns/myimage'), ('mypool', 'myns', 'myimage'))
         self.assertEqual(parse_image_spec('mypool/myimage'), ('mypool', None, 'myimage'))
+
+    @mock.patch('dashboard.services.rbd.mgr')
+    @mock.patch.object(RbdService, 'rbd_image')
+    @mock.patch.object(RbdService, 'rbd_image_refs')
+    def test_rbd_pool_list_page(self, rbd_image_refs, rbd_image, _mgr):
+        rbd_image_refs.return_value = [
+            {'pool_name': 'rbd', 'namespace': ns, 'name': name, 'id': image_id}
+            for ns, name, image_id in [('', 'img1', 'c'), ('', 'IMG2', 'b'),
+                                       ('ns', 'img3', 'a'), ('', 'other', 'd')]
+        ]
+        rbd_image.side_effect = \
+            lambda ioctx, pool_name, namespace, image_name, fields: {'name': image_name}
+
+        total, images = RbdService.rbd_pool_list_page(['rbd'], search='img', sort='-name',
+                                                      limit=2)
+        self.assertEqual(total, 3)
+        self.assertEqual(images, [{'name': 'img3'}, {'name': 'img1'}])
+
+        total, images = RbdService.rbd_pool_list_page(['rbd'], sort='id', offset=1,
+                                                      fields=('disk_usage',))
+        self.assertEqual(total, 4)
+        self.assertEqual([i['name'] for i in images], ['IMG2', 'img1', 'other'])
+        # only the images of the page are opened
+        self.assertEqual(rbd_image.call_count, 5)
+        self.assertEqual(rbd_image.call_args[0][4], ('disk_usage',))
+
+    @mock.patch.object(RbdService, '_rbd_snap_disk_usage')
+    def test_rbd_usage_index(self, snap_disk_usage):
+        snap_disk_usage.side_effect = lambda image, name, size, prev_snap: size
+        snaps = [(1, 10, 'snap1'), (2, 20, 'snap2'), (3, 30, None)]
+        RbdUsageIndex.clear()
+        self.addCleanup(RbdUsageIndex.clear)
+
+        usage = RbdUsageIndex.disk_usage(None, 'rbd', '', 'id', 'img', snaps, max_age=60)
+        self.assertEqual(usage, (60, {'snap1': 10, 'snap2': 20, None: 30}))
+        self.assertEqual(snap_disk_usage.call_count, 3)
+
+        # nothing is scanned again, until the HEAD is outdated
+        usage = RbdUsageIndex.disk_usage(None, 'rbd', '', 'id', 'img', snaps, max_age=60)
+        self.assertEqual(usage, (60, {'snap1': 10, 'snap2': 20, None: 30}))
+        self.assertEqual(snap_disk_usage.call_count, 3)
+        RbdUsageIndex.disk_usage(None, 'rbd', '', 'id', 'img', snaps, max_age=0)
+        self.assertEqual(snap_disk_usage.call_count, 4)
+
+        # snap2 now provisions the data of the removed snap1, too
+        snaps = [(2, 20, 'snap2'), (3, 30, None)]
+        usage = RbdUsageIndex.disk_usage(None, 'rbd', '', 'id', 'img', snaps, max_age=60)
+        self.assertEqual(usage, (50, {'snap2': 20, None: 30}))
+        self.assertEqual(snap_disk_usage.call_count, 5)
+
+        [report] = RbdUsageIndex.report('rbd')
+        self.assertEqual((report['name'], report['disk_usage'], report['total_disk_usage'],
+                          report['snapshots']), ('img', 30, 50, 1))
+        self.assertEqual(RbdUsageIndex.report('other'), [])
+
+    @mock.patch.object(RbdService, '_rbd_snap_disk_usage')
+    def test_rbd_usage_index_prune(self, snap_disk_usage):
+        snap_disk_usage.side_effect = lambda image, name, size, prev_snap: size
+        RbdUsageIndex.clear()
+        self.addCleanup(RbdUsageIndex.clear)
+        for pool_name, namespace, image_id in [('rbd', '', 'a'), ('rbd', '', 'b'),
+                                               ('rbd', 'ns', 'c'), ('other', '', 'd')]:
+            RbdUsageIndex.disk_usage(None, pool_name, namespace, image_id, image_id,
+                                     [(0, 10, None)], max_age=60)
+
+        RbdUsageIndex.prune('rbd', '', ['b'])
+        self.assertEqual([r['id'] for r in RbdUsageIndex.report()], ['d', 'b', 'c'])
+
+        with mock.patch.object(RbdUsageIndex, 'MAX_IMAGES', 2):
+            RbdUsageIndex.disk_usage(None, 'rbd', '', 'e', 'e', [(0, 10, None)], max_age=60)
+        # the least recently indexed images are dropped
+        self.assertEqual([r['id'] for r in RbdUsageIndex.report()], ['d', 'e'])
+
+    @mock.patch('dashboard.services.rbd.mgr')
+    @mock.patch('dashboard.services.rbd.rbd')
+    @mock.patch('dashboard.services.rbd.CephService.get_pool_list')
+    @mock.patch.object(RbdService, '_rbd_snap_disk_usage')
+    def test_rbd_usage_indexer(self, snap_disk_usage, get_pool_list, rbd, _mgr):
+        snap_disk_usage.side_effect = lambda image, name, size, prev_snap: size
+        get_pool_list.return_value = [{'pool_name': 'rbd'}]
+        rbd.RBD_FEATURE_FAST_DIFF = 1
+        rbd.RBD_FLAG_FAST_DIFF_INVALID = 1
+        images = ['img{}'.format(i) for i in range(5)]
+        rbd.RBD.return_value.namespace_list.return_value = []
+        rbd.RBD.return_value.list2.side_effect = \
+            lambda ioctx: [{'id': image_id, 'name': image_id} for image_id in images]
+        img = rbd.Image.return_value.__enter__.return_value
+        img.features.return_value = 1
+        img.flags.return_value = 0
+        img.size.return_value = 30
+        img.list_snaps.return_value = [{'id': 1, 'size': 10, 'name': 'snap1'},
+                                       {'id': 2, 'size': 20, 'name': 'snap2'}]
+        self.mock_kv_store()
+        Settings.RBD_USAGE_REFRESH_INTERVAL = 60
+        RbdUsageIndex.clear()
+        self.addCleanup(RbdUsageIndex.clear)
+
+        with mock.patch.object(RbdUsageIndex, 'MAX_IMAGES', 2):
+            RbdUsageIndex._index_pools()
+            self.assertEqual(snap_disk_usage.call_count, 15)
+            self.assertEqual(len(RbdUsageIndex.report()), 5)
+
+            # the images found by the thread aren't dropped, nor scanned again
+            RbdUsageIndex._index_pools()
+            self.assertEqual(snap_disk_usage.call_count, 15)
+
+            images.remove('img2')
+            RbdUsageIndex._index_pools()
+            self.assertEqual([r['id'] for r in RbdUsageIndex.report()],
+                             ['img0', 'img1', 'img3', 'img4'])
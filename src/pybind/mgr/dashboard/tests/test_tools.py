@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 
+import threading
+import time
 import unittest
 
 import cherrypy
@@ -11,10 +13,12 @@ except ImportError:
     from unittest.mock import patch
 
 from . import ControllerTestCase
+from ..exceptions import ViewCacheNoDataException
 from ..services.exception import handle_rados_error
 from ..controllers import RESTController, ApiController, Controller, \
                           BaseController, Proxy
-from ..tools import dict_contains_path, json_str_to_object, partial_dict, RequestLoggingTool
+from ..tools import dict_contains_path, json_str_to_object, partial_dict, RequestLoggingTool, \
+    ViewCache
 
 
 # pylint: disable=W0613
@@ -196,3 +200,112 @@ class TestFunctions(unittest.TestCase):
         self.assertRaises(KeyError, partial_dict, {'a': 1, 'b': 2, 'c': 3}, ['d'])
         self.assertRaises(TypeError, partial_dict, None, ['a'])
         self.assertRaises(TypeError, partial_dict, {'a': 1, 'b': 2, 'c': 3}, None)
+
+
+class ViewCacheTest(unittest.TestCase):
+
+    def test_evict_least_recently_used(self):
+        view = ViewCache(max_size=2)
+
+        @view
+        def _square(x):
+            return x * x
+
+        self.assertEqual(_square(1), (ViewCache.VALUE_OK, 1))
+        self.assertEqual(_square(2), (ViewCache.VALUE_OK, 4))
+        self.assertEqual(_square(1), (ViewCache.VALUE_OK, 1))
+        self.assertEqual(_square(3), (ViewCache.VALUE_OK, 9))
+        self.assertEqual(list(view.cache_by_args), [(1,), (3,)])
+        self.assertEqual(view.stats.evictions, 1)
+
+    def test_evict_expired(self):
+        view = ViewCache(ttl=60)
+
+        @view
+        def _square(x):
+            return x * x
+
+        _square(1)
+        _square(2)
+        view.cache_by_args[(1,)].last_used -= 120
+        _square(2)
+        self.assertEqual(list(view.cache_by_args), [(2,)])
+        self.assertEqual(view.stats.evictions, 1)
+
+    def test_stats(self):
+        view = ViewCache()
+
+        @view
+        def _answer():
+            return 42
+
+        _answer()
+        _answer()
+        stats = ViewCache.views_stats()['{}._answer'.format(__name__)]
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['fetches'], 1)
+        self.assertEqual(stats['errors'], 0)
+        self.assertEqual(stats['size'], 1)
+
+    def test_executor_starts_workers_for_queued_getters(self):
+        executor = ViewCache.Executor(max_workers=2)
+        started = []
+        release = threading.Event()
+
+        class _Getter(object):
+            def run(self):
+                started.append(self)
+                release.wait(5)
+
+        def _wait_for(predicate):
+            deadline = time.time() + 5
+            while not predicate() and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertTrue(predicate())
+
+        executor.submit(_Getter())
+        _wait_for(lambda: len(started) == 1)
+        release.set()
+        # let the worker go idle, then queue two getters at once
+        _wait_for(lambda: executor.idle == 1)
+        release.clear()
+        executor.submit(_Getter())
+        executor.submit(_Getter())
+        _wait_for(lambda: len(started) == 3)
+        self.assertEqual(executor.workers, 2)
+        release.set()
+
+    def test_slow_view_does_not_delay_others(self):
+        release = threading.Event()
+
+        @ViewCache(timeout=0)
+        def _slow(x):
+            release.wait(5)
+
+        @ViewCache(timeout=5)
+        def _fast():
+            return 42
+
+        try:
+            for x in range(ViewCache.MAX_WORKERS + 1):
+                self.assertRaises(ViewCacheNoDataException, _slow, x)
+            self.assertEqual(_fast(), (ViewCache.VALUE_OK, 42))
+        finally:
+            release.set()
+
+    def test_nested_views_run_inline(self):
+        threads = []
+
+        @ViewCache()
+        def _inner():
+            threads.append(threading.current_thread())
+            return 1
+
+        @ViewCache()
+        def _outer():
+            threads.append(threading.current_thread())
+            return _inner()[1] + 1
+
+        self.assertEqual(_outer(), (ViewCache.VALUE_OK, 2))
+        self.assertEqual(threads[0], threads[1])
@@ -14,6 +14,7 @@ from distutils.util import strtobool
 import fnmatch
 import time
 import threading
+import weakref
 import six
 from six.moves import urllib
 import cherrypy
@@ -132,13 +133,32 @@ class RequestLoggingTool(cherrypy.Tool):
 
 # pylint: disable=too-many-instance-attributes
 class ViewCache(object):
+    """
+    Caches the values returned by a function, per distinct arguments, and
+    gets them again in the background once they're older than
+    STALE_PERIOD.
+
+    The values of at most `max_size` distinct arguments are kept per view,
+    the least recently used ones are evicted first. Those unused for `ttl`
+    seconds are evicted, too. The values of each view are fetched by its own
+    pool of at most MAX_WORKERS threads, so that a slow view does not delay
+    the others. Views called while fetching the value of another view are
+    fetched in the calling thread.
+    """
     VALUE_OK = 0
     VALUE_STALE = 1
     VALUE_NONE = 2
 
-    class GetterThread(threading.Thread):
+    MAX_SIZE = 128
+    TTL = 600
+    MAX_WORKERS = 8
+
+    # views created on the fly are dropped with their wrappers
+    _views = weakref.WeakSet()  # type: weakref.WeakSet
+    _views_lock = threading.Lock()
+
+    class Getter(object):
         def __init__(self, view, fn, args, kwargs):
-            super(ViewCache.GetterThread, self).__init__()
             self._view = view
             self.event = threading.Event()
             self.fn = fn
@@ -160,28 +180,126 @@ class ViewCache(object):
                                                 str(ex))
                     self._view.value = None
                     self._view.value_when = None
-                    self._view.getter_thread = None
+                    self._view.getter = None
                     self._view.exception = ex
             else:
                 with self._view.lock:
                     self._view.latency = t1 - t0
                     self._view.value = val
                     self._view.value_when = datetime.now()
-                    self._view.getter_thread = None
+                    self._view.getter = None
                     self._view.exception = None
+                self._view.stats.fetched(t1 - t0)
 
             self._view.logger.debug("execution of %s finished in: %s", self.fn,
                                     t1 - t0)
             self.event.set()
 
+    class Executor(object):
+        """
+        Runs the getters, in up to `max_workers` threads started on demand.
+        Threads exit after being idle for IDLE_TIMEOUT seconds.
+        """
+        IDLE_TIMEOUT = 60
+
+        # set in the worker threads of all the executors
+        worker = threading.local()
+
+        def __init__(self, max_workers):
+            self.max_workers = max_workers
+            self.getters = collections.deque()
+            self.cond = threading.Condition()
+            self.workers = 0
+            self.idle = 0
+
+        @classmethod
+        def in_worker(cls):
+            return getattr(cls.worker, 'active', False)
+
+        def submit(self, getter):
+            with self.cond:
+                self.getters.append(getter)
+                self.cond.notify()
+                if len(self.getters) <= self.idle or self.workers >= self.max_workers:
+                    return
+                self.workers += 1
+            worker = threading.Thread(target=self._work, name='viewcache')
+            worker.daemon = True
+            worker.start()
+
+        def _next(self):
+            with self.cond:
+                self.idle += 1
+                deadline = time.time() + self.IDLE_TIMEOUT
+                while not self.getters:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.idle -= 1
+                        self.workers -= 1
+                        return None
+                    self.cond.wait(remaining)
+                self.idle -= 1
+                return self.getters.popleft()
+
+        def _work(self):
+            ViewCache.Executor.worker.active = True
+            while True:
+                getter = self._next()
+                if getter is None:
+                    return
+                getter.run()
+
+    class Stats(object):
+        """
+        How the requests to a view were served, and how long fetching its
+        values took.
+        """
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.hits = 0  # fresh value
+            self.misses = 0  # value fetched in time
+            self.stale = 0  # stale value, fetching timed out
+            self.no_data = 0  # no value, fetching timed out
+            self.errors = 0  # fetching failed
+            self.evictions = 0
+            self.fetches = 0
+            self.fetch_time = 0.0
+            self.max_fetch_time = 0.0
+
+        def add(self, counter, count=1):
+            with self.lock:
+                setattr(self, counter, getattr(self, counter) + count)
+
+        def fetched(self, latency):
+            with self.lock:
+                self.fetches += 1
+                self.fetch_time += latency
+                self.max_fetch_time = max(self.max_fetch_time, latency)
+
+        def json(self):
+            with self.lock:
+                return {
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'stale': self.stale,
+                    'no_data': self.no_data,
+                    'errors': self.errors,
+                    'evictions': self.evictions,
+                    'fetches': self.fetches,
+                    'avg_fetch_time': self.fetch_time / self.fetches if self.fetches else 0.0,
+                    'max_fetch_time': self.max_fetch_time,
+                }
+
     class RemoteViewCache(object):
         # Return stale data if
         STALE_PERIOD = 1.0
 
-        def __init__(self, timeout):
-            self.getter_thread = None
+        def __init__(self, timeout, stats, executor):
+            self.getter = None
             # Consider data within 1s old to be sufficiently fresh
             self.timeout = timeout
+            self.stats = stats
+            self.executor = executor
             self.event = threading.Event()
             self.value_when = None
             self.value = None
@@ -189,6 +307,7 @@ class ViewCache(object):
             self.exception = None
             self.lock = threading.Lock()
             self.logger = logging.getLogger('viewcache')
+            self.last_used = time.time()
 
         def reset(self):
             with self.lock:
@@ -213,16 +332,23 @@ class ViewCache(object):
                 now = datetime.now()
                 if self.value_when and now - self.value_when < timedelta(
                         seconds=self.STALE_PERIOD):
+                    self.stats.add('hits')
                     return ViewCache.VALUE_OK, self.value
 
-                if self.getter_thread is None:
-                    self.getter_thread = ViewCache.GetterThread(self, fn, args,
-                                                                kwargs)
-                    self.getter_thread.start()
+                getter = None
+                if self.getter is None:
+                    getter = self.getter = ViewCache.Getter(self, fn, args, kwargs)
                 else:
-                    self.logger.debug("getter_thread still alive for: %s", fn)
+                    self.logger.debug("getter still running for: %s", fn)
+
+                ev = self.getter.event
 
-                ev = self.getter_thread.event
+            if getter is not None:
+                if ViewCache.Executor.in_worker():
+                    # don't hold up a worker waiting for another one
+                    getter.run()
+                else:
+                    self.executor.submit(getter)
 
             success = ev.wait(timeout=self.timeout)
 
@@ -231,33 +357,88 @@ class ViewCache(object):
                     # We fetched the data within the timeout
                     if self.exception:
                         # execution raised an exception
+                        self.stats.add('errors')
                         # pylint: disable=raising-bad-type
                         raise self.exception
+                    self.stats.add('misses')
                     return ViewCache.VALUE_OK, self.value
                 if self.value_when is not None:
                     # We have some data, but it doesn't meet freshness requirements
+                    self.stats.add('stale')
                     return ViewCache.VALUE_STALE, self.value
                 # We have no data, not even stale data
+                self.stats.add('no_data')
                 raise ViewCacheNoDataException()
 
-    def __init__(self, timeout=5):
+    def __init__(self, timeout=5, max_size=None, ttl=None):
         self.timeout = timeout
-        self.cache_by_args = {}
+        self.max_size = max_size if max_size is not None else self.MAX_SIZE
+        self.ttl = ttl if ttl is not None else self.TTL
+        self.name = None
+        self.stats = ViewCache.Stats()
+        self.executor = ViewCache.Executor(self.MAX_WORKERS)
+        self.lock = threading.Lock()
+        # least recently used first
+        self.cache_by_args = collections.OrderedDict()
+        with ViewCache._views_lock:
+            ViewCache._views.add(self)
 
     def __call__(self, fn):
+        self.name = '{}.{}'.format(fn.__module__, fn.__name__)
+
         def wrapper(*args, **kwargs):
-            rvc = self.cache_by_args.get(args, None)
-            if not rvc:
-                rvc = ViewCache.RemoteViewCache(self.timeout)
-                self.cache_by_args[args] = rvc
-            return rvc.run(fn, args, kwargs)
+            return self._get(args).run(fn, args, kwargs)
         wrapper.reset = self.reset
         return wrapper
 
+    def _get(self, args):
+        now = time.time()
+        with self.lock:
+            rvc = self.cache_by_args.pop(args, None)
+            if rvc is None:
+                rvc = ViewCache.RemoteViewCache(self.timeout, self.stats, self.executor)
+            rvc.last_used = now
+            self.cache_by_args[args] = rvc
+            self._evict(now)
+        return rvc
+
+    def _evict(self, now):
+        evicted = 0
+        while len(self.cache_by_args) > self.max_size:
+            self.cache_by_args.popitem(last=False)
+            evicted += 1
+        while self.cache_by_args:
+            args, rvc = next(six.iteritems(self.cache_by_args))
+            if now - rvc.last_used < self.ttl:
+                break
+            del self.cache_by_args[args]
+            evicted += 1
+        if evicted:
+            self.stats.add('evictions', evicted)
+
     def reset(self):
-        for _, rvc in self.cache_by_args.items():
+        with self.lock:
+            rvcs = list(self.cache_by_args.values())
+        for rvc in rvcs:
             rvc.reset()
 
+    @classmethod
+    def views_stats(cls):
+        """
+        :return: the statistics of the views, by name
+        """
+        with cls._views_lock:
+            views = list(cls._views)
+        result = {}
+        for view in views:
+            if view.name is None:
+                continue
+            stats = view.stats.json()
+            with view.lock:
+                stats['size'] = len(view.cache_by_args)
+            result[view.name] = stats
+        return result
+
 
 class NotificationQueue(threading.Thread):
     _ALL_TYPES_ = '__ALL__'
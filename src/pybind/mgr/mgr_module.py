@@ -140,6 +140,19 @@ class OSDMap(ceph_module.BasePyOSDMap):
     def map_pool_pgs_up(self, poolid):
         return self._map_pool_pgs_up(poolid)
 
+    def map_pgs_acting_diff(self, other, osd=-1):
+        """
+        Map every PG of this map's pools on both this map and other,
+        and return the PGs whose acting sets differ.
+
+        :param other: the OSDMap to compare with, e.g. a newer epoch
+        :param int osd: if not negative, only return the PGs that have
+            this OSD in their old or new acting set
+        :return: dict of pgid to a dict with the "pool", "ps",
+            "old_acting" and "new_acting" of the PG
+        """
+        return self._map_pgs_acting_diff(other, osd)
+
     def pg_to_up_acting_osds(self, pool_id, ps):
         return self._pg_to_up_acting_osds(pool_id, ps)
 
@@ -1260,6 +1273,26 @@ class MgrModule(ceph_module.BaseMgrModule, MgrModuleLoggingMixin):
         """
         return self._ceph_get_osdmap()
 
+    def get_pg_stats(self, pgids=None, since_epoch=0):
+        """
+        Fetch the recovery related stats of a set of PGs, without
+        dumping the whole PGMap like ``get("pg_dump")`` does.
+
+        The result has the PGMap "version" and "last_osdmap_epoch", a
+        "pg_stats" dict mapping each pgid to its "state",
+        "reported_epoch", "num_bytes" and "num_bytes_recovered", and a
+        "missing" list of the requested pgids that are not in the PGMap.
+
+        :param pgids: iterable of pgid strings, or None for all PGs
+        :param int since_epoch: only include PGs that reported their
+            stats in this OSDMap epoch or later, e.g. the
+            "last_osdmap_epoch" of a previous call
+        :rtype: dict
+        """
+        if pgids is not None:
+            pgids = list(pgids)
+        return self._ceph_get_pg_stats(pgids, since_epoch)
+
     def get_latest(self, daemon_type, daemon_name, counter):
         data = self.get_latest_counter(
             daemon_type, daemon_name, counter)[counter]
@@ -1276,6 +1309,25 @@ class MgrModule(ceph_module.BaseMgrModule, MgrModuleLoggingMixin):
         else:
             return 0, 0
 
+    def get_perf_counters(self, services, prio_limit=PRIO_USEFUL):
+        """
+        Fetch the schema and the latest value of every perf counter of
+        the given daemon types in a single call.
+
+        The result is columnar: it maps each daemon (like "osd.123") to
+        a dict of equally long lists, one entry per counter, under the
+        keys "path", "description", "nick", "type", "priority", "units",
+        "value" and "count".  "nick" is an empty string for counters
+        without a nick, and "count" is 0 for counters that are not long
+        running averages.
+
+        :param services: iterable of daemon types, e.g. ("osd", "mds")
+        :param int prio_limit: only include counters with a priority
+            equal to or greater than this
+        :rtype: dict
+        """
+        return self._ceph_get_perf_counters(list(services), prio_limit)
+
     def get_all_perf_counters(self, prio_limit=PRIO_USEFUL,
                               services=("mds", "mon", "osd",
                                         "rbd-mirror", "rgw", "tcmu-runner")):
@@ -1293,51 +1345,27 @@ class MgrModule(ceph_module.BaseMgrModule, MgrModuleLoggingMixin):
 
         result = defaultdict(dict)  # type: Dict[str, dict]
 
-        for server in self.list_servers():
-            for service in server['services']:
-                if service['type'] not in services:
-                    continue
-
-                schema = self.get_perf_schema(service['type'], service['id'])
-                if not schema:
-                    self.log.warn("No perf counter schema for {0}.{1}".format(
-                        service['type'], service['id']
-                    ))
-                    continue
-
-                # Value is returned in a potentially-multi-service format,
-                # get just the service we're asking about
-                svc_full_name = "{0}.{1}".format(
-                    service['type'], service['id'])
-                schema = schema[svc_full_name]
-
-                # Populate latest values
-                for counter_path, counter_schema in schema.items():
-                    # self.log.debug("{0}: {1}".format(
-                    #     counter_path, json.dumps(counter_schema)
-                    # ))
-                    if counter_schema['priority'] < prio_limit:
-                        continue
-
-                    counter_info = dict(counter_schema)
-
-                    # Also populate count for the long running avgs
-                    if counter_schema['type'] & self.PERFCOUNTER_LONGRUNAVG:
-                        v, c = self.get_latest_avg(
-                            service['type'],
-                            service['id'],
-                            counter_path
-                        )
-                        counter_info['value'], counter_info['count'] = v, c
-                        result[svc_full_name][counter_path] = counter_info
-                    else:
-                        counter_info['value'] = self.get_latest(
-                            service['type'],
-                            service['id'],
-                            counter_path
-                        )
-
-                    result[svc_full_name][counter_path] = counter_info
+        counters = self.get_perf_counters(services, prio_limit)
+        for svc_full_name, columns in counters.items():
+            for path, description, nick, type_, priority, units, value, count \
+                    in zip(columns['path'], columns['description'],
+                           columns['nick'], columns['type'],
+                           columns['priority'], columns['units'],
+                           columns['value'], columns['count']):
+                counter_info = {
+                    'description': description,
+                    'type': type_,
+                    'priority': priority,
+                    'units': units,
+                    'value': value,
+                }
+                if nick:
+                    counter_info['nick'] = nick
+                # Also populate count for the long running avgs
+                if type_ & self.PERFCOUNTER_LONGRUNAVG:
+                    counter_info['count'] = count
+
+                result[svc_full_name][path] = counter_info
 
         self.log.debug("returning {0} counter".format(len(result)))
 
@@ -1487,33 +1515,109 @@ class MgrModule(ceph_module.BaseMgrModule, MgrModuleLoggingMixin):
 
 
 class PersistentStoreDict(object):
-    def __init__(self, mgr, prefix):
-        # type: (MgrModule, str) -> None
+    """
+    A dict-like view of the values (serialized as JSON) stored in the
+    mgr's KV store under a prefix.
+
+    With ``cached=True``, the decoded values are kept in memory: they are
+    loaded from the store once, by the first access, and the writes are
+    written through to the store. With ``write_back=True`` the writes are
+    kept in memory, too, until ``flush()`` is called. In both modes this
+    instance must be the only writer of the prefix, and the values it
+    returns must not be modified in place.
+    """
+    def __init__(self, mgr, prefix, cached=False, write_back=False):
+        # type: (MgrModule, str, bool, bool) -> None
         self.mgr = mgr
         self.prefix = prefix + '.'
+        self.cached = cached or write_back
+        self.write_back = write_back
+        self._lock = threading.Lock()
+        self._cache = None  # type: Optional[Dict[str, Any]]
+        # keys changed, but not yet written to the store
+        self._dirty = set()  # type: Set[str]
 
     def _mk_store_key(self, key):
         return self.prefix + key
 
+    def _decode(self, val):
+        # type: (str) -> Any
+        return json.loads(val)
+
+    def _encode(self, value):
+        # type: (Any) -> str
+        return json.dumps(value)
+
     def __missing__(self, key):
         # KeyError won't work for the `in` operator.
         # https://docs.python.org/3/reference/expressions.html#membership-test-details
         raise IndexError('PersistentStoreDict: "{}" not found'.format(key))
 
-    def clear(self):
+    def _load(self):
+        # type: () -> Dict[str, Any]
+        with self._lock:
+            if self._cache is None:
+                self._cache = dict(self._load_items())
+            return self._cache
+
+    def _load_items(self):
+        # type: () -> Iterator[Tuple[str, Any]]
+        prefix_len = len(self.prefix)
+        try:
+            for k, v in list(six.iteritems(self.mgr.get_store_prefix(self.prefix))):
+                yield k[prefix_len:], self._decode(v)
+        except (KeyError, AttributeError, IndexError, ValueError, TypeError):
+            logging.getLogger(__name__).exception('failed to deserialize')
+            self._clear_store()
+
+    def reload(self):
+        # type: () -> None
+        """
+        Drop the cached values (and pending writes), to be loaded again
+        from the store.
+        """
+        with self._lock:
+            self._cache = None
+            self._dirty = set()
+
+    def flush(self):
+        # type: () -> None
+        """
+        Write the pending changes to the store.
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            updates = [(k, (self._cache or {}).get(k)) for k in dirty]
+        for item, value in updates:
+            self.mgr.set_store(self._mk_store_key(item),
+                               self._encode(value) if value is not None else None)
+
+    def _clear_store(self):
         # Don't make any assumptions about the content of the values.
         for item in six.iteritems(self.mgr.get_store_prefix(self.prefix)):
             k, _ = item
             self.mgr.set_store(k, None)
 
+    def clear(self):
+        if self.cached:
+            with self._lock:
+                self._cache = {}
+                self._dirty = set()
+        self._clear_store()
+
     def __getitem__(self, item):
         # type: (str) -> Any
+        if self.cached:
+            try:
+                return self._load()[item]
+            except KeyError:
+                self.__missing__(self._mk_store_key(item))
         key = self._mk_store_key(item)
         try:
             val = self.mgr.get_store(key)
             if val is None:
                 self.__missing__(key)
-            return json.loads(val)
+            return self._decode(val)
         except (KeyError, AttributeError, IndexError, ValueError, TypeError):
             logging.getLogger(__name__).exception('failed to deserialize')
             self.mgr.set_store(key, None)
@@ -1524,8 +1628,18 @@ class PersistentStoreDict(object):
         """
         value=None is not allowed, as it will remove the key.
         """
+        if self.cached:
+            cache = self._load()
+            with self._lock:
+                if value is None:
+                    cache.pop(item, None)
+                else:
+                    cache[item] = value
+                if self.write_back:
+                    self._dirty.add(item)
+                    return
         key = self._mk_store_key(item)
-        self.mgr.set_store(key, json.dumps(value) if value is not None else None)
+        self.mgr.set_store(key, self._encode(value) if value is not None else None)
 
     def __delitem__(self, item):
         self[item] = None
@@ -1535,17 +1649,14 @@ class PersistentStoreDict(object):
 
     def items(self):
         # type: () -> Iterator[Tuple[str, Any]]
-        prefix_len = len(self.prefix)
-        try:
-            for item in six.iteritems(self.mgr.get_store_prefix(self.prefix)):
-                k, v = item
-                yield k[prefix_len:], json.loads(v)
-        except (KeyError, AttributeError, IndexError, ValueError, TypeError):
-            logging.getLogger(__name__).exception('failed to deserialize')
-            self.clear()
+        if self.cached:
+            return iter(list(self._load().items()))
+        return self._load_items()
 
     def keys(self):
         # type: () -> Set[str]
+        if self.cached:
+            return set(self._load().keys())
         return {item[0] for item in self.items()}
 
     def __iter__(self):
@@ -7,6 +7,7 @@ Please see the ceph-mgr module developer's guide for more information.
 import functools
 import logging
 import sys
+import threading
 import time
 from collections import namedtuple
 from functools import wraps
@@ -18,6 +19,7 @@ import copy
 import re
 import six
 import errno
+import json
 
 from ceph.deployment import inventory
 
@@ -27,7 +29,7 @@ from mgr_util import format_bytes
 try:
     from ceph.deployment.drive_group import DriveGroupSpec
     from typing import TypeVar, Generic, List, Optional, Union, Tuple, Iterator, Callable, Any, \
-        Type, Sequence
+        Type, Sequence, Dict
 except ImportError:
     pass
 
@@ -180,6 +182,10 @@ class _Promise(object):
     NO_RESULT = _no_result()  # type: None
     ASYNC_RESULT = object()
 
+    #: Notified whenever a promise finishes. Shared by all promises, as
+    #: chains of promises are joined and extended while they are evaluated.
+    _finished = threading.Condition()
+
     def __init__(self,
                  _first_promise=None,  # type: Optional["_Promise"]
                  value=NO_RESULT,  # type: Optional[Any]
@@ -318,9 +324,14 @@ class _Promise(object):
     def propagate_to_next(self):
         self._state = self.FINISHED
         logger.debug('finalized {}'.format(repr(self)))
+        self._notify_finished()
         if self._next_promise:
             self._next_promise._finalize()
 
+    def _notify_finished(self):
+        with self._finished:
+            self._finished.notify_all()
+
     def fail(self, e):
         # type: (Exception) -> None
         """
@@ -337,6 +348,7 @@ class _Promise(object):
         if self._next_promise:
             self._next_promise.fail(e)
         self._state = self.FINISHED
+        self._notify_finished()
 
     def __contains__(self, item):
         return any(item is p for p in iter(self._first_promise))
@@ -612,6 +624,17 @@ class Completion(_Promise):
         """
         return self.is_errored or (self.has_result)
 
+    def wait(self, timeout=None):
+        # type: (Optional[float]) -> bool
+        """
+        Wait for this completion to finish, without processing it.
+
+        :param timeout: in seconds, or None to wait forever
+        :return: whether the completion is finished
+        """
+        finished, _ = wait_completions([self], timeout)
+        return bool(finished)
+
     def pretty_print(self):
 
         reprs = '\n'.join(p.pretty_print_1() for p in iter(self._first_promise))
@@ -623,6 +646,59 @@ def pretty_print(completions):
     return ', '.join(c.pretty_print() for c in completions)
 
 
+ALL_COMPLETED = 'ALL_COMPLETED'
+FIRST_COMPLETED = 'FIRST_COMPLETED'
+
+
+def wait_completions(completions, timeout=None, return_when=ALL_COMPLETED):
+    # type: (Sequence[Completion], Optional[float], str) -> Tuple[List[Completion], List[Completion]]
+    """
+    Wait for completions to finish, like :func:`concurrent.futures.wait`.
+
+    This does not process the completions: it is meant for completions that
+    are evaluated elsewhere, e.g. in a thread of the orchestrator module. Use
+    :func:`OrchestratorClientMixin._orchestrator_wait` otherwise.
+
+    :param timeout: in seconds, or None to wait forever
+    :param return_when: ``ALL_COMPLETED`` or ``FIRST_COMPLETED``
+    :return: the finished and the pending completions
+    """
+    assert return_when in (ALL_COMPLETED, FIRST_COMPLETED)
+
+    def split():
+        # type: () -> Tuple[List[Completion], List[Completion]]
+        finished = [c for c in completions if c.is_finished]
+        pending = [c for c in completions if not c.is_finished]
+        return finished, pending
+
+    def done(finished, pending):
+        if return_when == FIRST_COMPLETED:
+            return bool(finished) or not pending
+        return not pending
+
+    finished, pending = split()
+    if done(finished, pending):
+        return finished, pending
+
+    # The completions may belong to another module (sub interpreter), so
+    # wait on the condition of their class.
+    cond = pending[0]._finished
+    end_time = None if timeout is None else time.time() + timeout
+    with cond:
+        while True:
+            finished, pending = split()
+            if done(finished, pending):
+                break
+            if end_time is None:
+                cond.wait()
+            else:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    break
+                cond.wait(remaining)
+    return finished, pending
+
+
 def raise_if_exception(c):
     # type: (Completion) -> None
     """
@@ -729,6 +805,19 @@ class Orchestrator(object):
         """
         raise NotImplementedError()
 
+    def get_host_latency(self):
+        # type: () -> Dict[str, Dict[str, Any]]
+        """
+        Report the latency of talking to each managed host, e.g. the
+        average and latest command round-trip times over its connection.
+
+        Like :func:`available`, this is called by ``orchestrator status``
+        and must not block on the hosts: report the latest measurements.
+
+        :return: dict of host name -> dict of latency statistics
+        """
+        raise NotImplementedError()
+
     @_hide_in_features
     def process(self, completions):
         # type: (List[Completion]) -> None
@@ -1504,8 +1593,13 @@ class OrchestratorClientMixin(Orchestrator):
         mgr.log.debug("_oremote {} -> {}.{}(*{}, **{})".format(mgr.module_name, o, meth, args, kwargs))
         return mgr.remote(o, meth, *args, **kwargs)
 
-    def _orchestrator_wait(self, completions):
-        # type: (List[Completion]) -> None
+    #: Seconds between calls to ``process()`` while waiting for completions.
+    #: Finished completions wake up the waiters right away, but some
+    #: orchestrators only make progress in ``process()``.
+    PROCESS_INTERVAL = 1.0
+
+    def _orchestrator_wait(self, completions, timeout=None, return_when=ALL_COMPLETED):
+        # type: (List[Completion], Optional[float], str) -> Tuple[List[Completion], List[Completion]]
         """
         Wait for completions to complete (reads) or
         become persistent (writes).
@@ -1513,18 +1607,29 @@ class OrchestratorClientMixin(Orchestrator):
         Waits for writes to be *persistent* but not *effective*.
 
         :param completions: List of Completions
+        :param timeout: in seconds, or None to wait forever
+        :param return_when: ``ALL_COMPLETED`` or ``FIRST_COMPLETED``
+        :return: the finished and the pending completions
         :raises NoOrchestrator:
         :raises RuntimeError: something went wrong while calling the process method.
         :raises ImportError: no `orchestrator_cli` module or backend not found.
         """
-        while any(not c.has_result for c in completions):
-            self.process(completions)
+        end_time = None if timeout is None else time.time() + timeout
+        finished = [c for c in completions if c.is_finished]
+        pending = [c for c in completions if not c.is_finished]
+        while pending and not (finished and return_when == FIRST_COMPLETED):
+            self.process(pending)
             self.__get_mgr().log.info("Operations pending: %s",
-                                      sum(1 for c in completions if not c.has_result))
-            if any(c.needs_result for c in completions):
-                time.sleep(1)
-            else:
+                                      sum(1 for c in pending if not c.has_result))
+            interval = self.PROCESS_INTERVAL
+            if end_time is not None:
+                interval = min(interval, end_time - time.time())
+            finished, pending = wait_completions(pending, max(interval, 0), return_when)
+            if end_time is not None and time.time() >= end_time:
                 break
+        finished = [c for c in completions if c.is_finished]
+        pending = [c for c in completions if not c.is_finished]
+        return finished, pending
 
 
 class OutdatableData(object):
@@ -1624,8 +1729,19 @@ class OutdatableDictMixin(object):
                                    datetime.datetime.fromtimestamp(0))
 
 
-class OutdatablePersistentDict(OutdatableDictMixin, PersistentStoreDict):
-    pass
+class OutdatablePersistentDict(PersistentStoreDict, OutdatableDictMixin):
+    """
+    The values are stored as JSON, but decoded into OutdatableData by
+    PersistentStoreDict itself, so that the cached mode keeps the decoded
+    OutdatableData objects.
+    """
+    def _decode(self, val):
+        # type: (str) -> OutdatableData
+        return OutdatableData.from_json(json.loads(val))
+
+    def _encode(self, value):
+        # type: (OutdatableData) -> str
+        return json.dumps(value.json())
 
 
 class OutdatableDict(OutdatableDictMixin, dict):
@@ -712,12 +712,31 @@ Usage:
         avail, why = self.available()
         if avail is None:
             # The module does not report its availability
-            return HandleCommandResult(stdout="Backend: {0}".format(o))
+            output = "Backend: {0}".format(o)
         else:
-            return HandleCommandResult(stdout="Backend: {0}\nAvailable: {1}{2}".format(
-                                           o, avail,
-                                           " ({0})".format(why) if not avail else ""
-                                       ))
+            output = "Backend: {0}\nAvailable: {1}{2}".format(
+                o, avail, " ({0})".format(why) if not avail else "")
+
+        if avail and self.get_feature_set().get('get_host_latency', {}).get('available'):
+            table = PrettyTable(
+                ['HOST', 'CONNECTED', 'COMMANDS', 'LAST LATENCY', 'AVG LATENCY'],
+                border=False)
+            table.align = 'l'
+            table.left_padding_width = 0
+            table.right_padding_width = 1
+
+            def ms(latency):
+                return '-' if latency is None else '{0:.0f}ms'.format(latency * 1000)
+
+            for host, latency in sorted(self.get_host_latency().items()):
+                table.add_row((
+                    host,
+                    'yes' if latency.get('connected') else 'no',
+                    latency.get('commands', 0),
+                    ms(latency.get('last_latency')),
+                    ms(latency.get('avg_latency'))))
+            output += "\n\n" + table.get_string()
+        return HandleCommandResult(stdout=output)
 
     def self_test(self):
         old_orch = self._select_orchestrator()
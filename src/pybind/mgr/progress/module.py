@@ -1,4 +1,5 @@
 from mgr_module import MgrModule
+import logging
 import os
 import threading
 import datetime
@@ -241,25 +242,23 @@ class PgRecoveryEvent(Event):
     def which_osds(self):
         return self. _which_osds
 
-    def pg_update(self, pg_dump, log):
-        # FIXME: O(pg_num) in python
-        # FIXME: far more fields getting pythonized than we really care about
-        # Sanity check to see if there are any missing PGs and to assign
-        # empty array and dictionary if there hasn't been any recovery
-        pg_to_state = dict([(p['pgid'], p) for p in pg_dump['pg_stats']])
+    @property
+    def pgids(self):
+        """
+        The pgids of the PGs that have not finished recovering yet.
+        """
+        return [str(pg) for pg in self._pgs]
+
+    def pg_update(self, pg_index, log):
+        # Assign an empty dictionary if there hasn't been any recovery;
+        # PGs that are not in the index yet are treated as gone below
         if self._original_bytes_recovered is None:
             self._original_bytes_recovered = {}
-            missing_pgs = []
             for pg in self._pgs:
-                pg_str = str(pg)
-                if pg_str in pg_to_state:
+                info = pg_index.get(str(pg))
+                if info is not None:
                     self._original_bytes_recovered[pg] = \
-                        pg_to_state[pg_str]['stat_sum']['num_bytes_recovered']
-                else:
-                    missing_pgs.append(pg)
-            if pg_dump.get('pg_ready', False):
-                for pg in missing_pgs:
-                    self._pgs.remove(pg)
+                        info['num_bytes_recovered']
 
         complete_accumulate = 0.0
 
@@ -274,9 +273,8 @@ class PgRecoveryEvent(Event):
         complete = set()
         for pg in self._pgs:
             pg_str = str(pg)
-            try:
-                info = pg_to_state[pg_str]
-            except KeyError:
+            info = pg_index.get(pg_str)
+            if info is None:
                 # The PG is gone!  Probably a pool was deleted. Drop it.
                 complete.add(pg)
                 continue
@@ -291,13 +289,13 @@ class PgRecoveryEvent(Event):
             if "active" in states and "clean" in states:
                 complete.add(pg)
             else:
-                if info['stat_sum']['num_bytes'] == 0:
+                if info['num_bytes'] == 0:
                     # Empty PGs are considered 0% done until they are
                     # in the correct state.
                     pass
                 else:
-                    recovered = info['stat_sum']['num_bytes_recovered']
-                    total_bytes = info['stat_sum']['num_bytes']
+                    recovered = info['num_bytes_recovered']
+                    total_bytes = info['num_bytes']
                     if total_bytes > 0:
                         ratio = float(recovered -
                                       self._original_bytes_recovered[pg]) / \
@@ -327,6 +325,64 @@ class PgRecoveryEvent(Event):
         return self._progress
 
 
+class PgStateIndex(object):
+    """
+    The latest recovery stats of the PGs that PgRecoveryEvents are
+    waiting on, shared by all of the events.
+
+    refresh() is called once per pg_summary notify with the PGs still
+    outstanding.  Rather than dumping the whole PGMap, it only fetches
+    the PGs it has not seen yet, and of the others only those that
+    reported since the previous refresh.  Every FULL_REFRESH_INTERVAL
+    refreshes all of them are fetched again, in case a PG reported with
+    an OSDMap epoch older than the one we last saw.
+    """
+
+    FULL_REFRESH_INTERVAL = 10
+
+    def __init__(self):
+        self._stats = {}
+        self._epoch = None
+        self._refreshes = 0
+
+    def get(self, pgid):
+        """
+        :return: the stats of the PG, or None if it is not in the PGMap
+        """
+        return self._stats.get(pgid)
+
+    def refresh(self, module, pgids):
+        pgids = set(pgids)
+        for pgid in set(self._stats) - pgids:
+            del self._stats[pgid]
+        known = set(self._stats)
+        new = pgids - known
+
+        self._refreshes += 1
+        if self._refreshes % self.FULL_REFRESH_INTERVAL == 0:
+            self._epoch = None
+        epoch = None
+        if known:
+            if self._epoch is None:
+                result = module.get_pg_stats(known)
+            else:
+                result = module.get_pg_stats(known, since_epoch=self._epoch)
+            self._stats.update(result['pg_stats'])
+            for pgid in result['missing']:
+                del self._stats[pgid]
+            epoch = result['last_osdmap_epoch']
+        if new:
+            result = module.get_pg_stats(new)
+            self._stats.update(result['pg_stats'])
+            if epoch is None:
+                epoch = result['last_osdmap_epoch']
+        if epoch is not None:
+            self._epoch = epoch
+
+        module.log.debug("refreshed stats of {0} PGs ({1} new)".format(
+            len(pgids), len(new)))
+
+
 class PgId(object):
     def __init__(self, pool_id, ps):
         self.pool_id = pool_id
@@ -385,6 +441,8 @@ class Module(MgrModule):
 
         self._latest_osdmap = None
 
+        self._pg_index = PgStateIndex()
+
         self._dirty = False
 
         global _module
@@ -397,55 +455,37 @@ class Module(MgrModule):
                     self.get_module_option(opt['name']))
             self.log.debug(' %s = %s', opt['name'], getattr(self, opt['name']))
 
-    def _osd_in_out(self, old_map, old_dump, new_map, osd_id, marked):
+    def _osd_in_out(self, old_map, new_map, osd_id, marked):
         # A function that will create or complete an event when an
         # OSD is marked in or out according to the affected PGs
         affected_pgs = []
         unmoved_pgs = []
-        for pool in old_dump['pools']:
-            pool_id = pool['pool']
-            for ps in range(0, pool['pg_num']):
-
-                # Was this OSD affected by the OSD coming in/out?
-                # Compare old and new osds using
-                # data from the json dump
-                old_up_acting = old_map.pg_to_up_acting_osds(pool['pool'], ps)
-                old_osds = set(old_up_acting['acting'])
-                new_up_acting = new_map.pg_to_up_acting_osds(pool['pool'], ps)
-                new_osds = set(new_up_acting['acting'])
-
-                # Check the osd_id being in the acting set for both old
-                # and new maps to cover both out and in cases
-                was_on_out_or_in_osd = osd_id in old_osds or osd_id in new_osds
-                if not was_on_out_or_in_osd:
-                    continue
-
-                self.log.debug("pool_id, ps = {0}, {1}".format(
-                    pool_id, ps
-                ))
-
-                self.log.debug(
-                    "old_up_acting: {0}".format(json.dumps(old_up_acting, indent=4, sort_keys=True)))
-
-                # Has this OSD been assigned a new location?
-                # (it might not be if there is no suitable place to move
-                #  after an OSD is marked in/out)
-                if marked == "in":
-                    is_relocated = len(old_osds - new_osds) > 0
-                else:
-                    is_relocated = len(new_osds - old_osds) > 0
-
-                self.log.debug(
-                    "new_up_acting: {0}".format(json.dumps(new_up_acting,
-                                                           indent=4,
-                                                           sort_keys=True)))
+        # Only the PGs whose acting set changed and that had or have
+        # this OSD in it, covering both out and in cases
+        diff = old_map.map_pgs_acting_diff(new_map, osd_id)
+        debug = self.log.isEnabledFor(logging.DEBUG)
+        for pgid, pg in diff.items():
+            old_osds = set(pg['old_acting'])
+            new_osds = set(pg['new_acting'])
+
+            if debug:
+                self.log.debug("{0}: old_acting {1} new_acting {2}".format(
+                    pgid, pg['old_acting'], pg['new_acting']))
+
+            # Has this OSD been assigned a new location?
+            # (it might not be if there is no suitable place to move
+            #  after an OSD is marked in/out)
+            if marked == "in":
+                is_relocated = len(old_osds - new_osds) > 0
+            else:
+                is_relocated = len(new_osds - old_osds) > 0
 
-                if was_on_out_or_in_osd and is_relocated:
-                    # This PG is now in motion, track its progress
-                    affected_pgs.append(PgId(pool_id, ps))
-                elif not is_relocated:
-                    # This PG didn't get a new location, we'll log it
-                    unmoved_pgs.append(PgId(pool_id, ps))
+            if is_relocated:
+                # This PG is now in motion, track its progress
+                affected_pgs.append(PgId(pg['pool'], pg['ps']))
+            else:
+                # This PG didn't get a new location, we'll log it
+                unmoved_pgs.append(PgId(pg['pool'], pg['ps']))
 
         # In the case that we ignored some PGs, log the reason why (we may
         # not end up creating a progress event)
@@ -476,8 +516,10 @@ class Module(MgrModule):
                     which_osds=[osd_id],
                     start_epoch=self.get_osdmap().get_epoch()
                     )
-            ev.pg_update(self.get("pg_dump"), self.log)
+            # register the event first, so that its PGs get fetched
             self._events[ev.id] = ev
+            self._pg_index.refresh(self, self._outstanding_pgids())
+            ev.pg_update(self._pg_index, self.log)
 
     def _osdmap_changed(self, old_osdmap, new_osdmap):
         old_dump = old_osdmap.dump()
@@ -493,13 +535,13 @@ class Module(MgrModule):
 
                 if new_weight == 0.0 and old_weight > new_weight:
                     self.log.warn("osd.{0} marked out".format(osd_id))
-                    self._osd_in_out(old_osdmap, old_dump, new_osdmap, osd_id, "out")
+                    self._osd_in_out(old_osdmap, new_osdmap, osd_id, "out")
                 elif new_weight >= 1.0 and old_weight == 0.0:
                     # Only consider weight>=1.0 as "in" to avoid spawning
                     # individual recovery events on every adjustment
                     # in a gradual weight-in
                     self.log.warn("osd.{0} marked in".format(osd_id))
-                    self._osd_in_out(old_osdmap, old_dump, new_osdmap, osd_id, "in")
+                    self._osd_in_out(old_osdmap, new_osdmap, osd_id, "in")
 
     def notify(self, notify_type, notify_data):
         self._ready.wait()
@@ -513,12 +555,21 @@ class Module(MgrModule):
             ))
             self._osdmap_changed(old_osdmap, self._latest_osdmap)
         elif notify_type == "pg_summary":
-            data = self.get("pg_dump")
-            for ev_id in list(self._events):
-                ev = self._events[ev_id]
-                if isinstance(ev, PgRecoveryEvent):
-                    ev.pg_update(data, self.log)
-                    self.maybe_complete(ev)
+            events = [ev for ev in self._events.values()
+                      if isinstance(ev, PgRecoveryEvent)]
+            if not events:
+                return
+            self._pg_index.refresh(self, self._outstanding_pgids())
+            for ev in events:
+                ev.pg_update(self._pg_index, self.log)
+                self.maybe_complete(ev)
+
+    def _outstanding_pgids(self):
+        pgids = set()
+        for ev in self._events.values():
+            if isinstance(ev, PgRecoveryEvent):
+                pgids.update(ev.pgids)
+        return pgids
 
     def maybe_complete(self, event):
         if event.progress >= 1.0:
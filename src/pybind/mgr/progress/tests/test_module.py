@@ -0,0 +1,140 @@
+from tests import mock
+
+from ..module import Module, PgRecoveryEvent, PgStateIndex
+
+
+def pg_stat(state, reported_epoch=10, num_bytes=100, num_bytes_recovered=0):
+    return {
+        'state': state,
+        'reported_epoch': reported_epoch,
+        'num_bytes': num_bytes,
+        'num_bytes_recovered': num_bytes_recovered,
+    }
+
+
+class FakePGMap(object):
+    """
+    Serves get_pg_stats() from a dict of pgid -> stats, and records the
+    calls.
+    """
+    def __init__(self, stats, epoch=10):
+        self.stats = stats
+        self.epoch = epoch
+        self.calls = []
+        self.log = mock.MagicMock()
+
+    def get_pg_stats(self, pgids=None, since_epoch=0):
+        pgids = sorted(pgids)
+        self.calls.append((pgids, since_epoch))
+        return {
+            'version': 1,
+            'last_osdmap_epoch': self.epoch,
+            'pg_stats': {p: self.stats[p] for p in pgids
+                         if p in self.stats and
+                         self.stats[p]['reported_epoch'] >= since_epoch},
+            'missing': [p for p in pgids if p not in self.stats],
+        }
+
+
+class TestPgStateIndex(object):
+
+    def test_refresh_fetches_new_pgs(self):
+        pgmap = FakePGMap({'1.0': pg_stat('active+clean'),
+                           '1.1': pg_stat('active+recovering')})
+        index = PgStateIndex()
+        index.refresh(pgmap, ['1.0', '1.1'])
+        assert pgmap.calls == [(['1.0', '1.1'], 0)]
+        assert index.get('1.0')['state'] == 'active+clean'
+        assert index.get('1.2') is None
+
+    def test_refresh_since_last_epoch(self):
+        pgmap = FakePGMap({'1.0': pg_stat('active+recovering'),
+                           '1.1': pg_stat('active+recovering')})
+        index = PgStateIndex()
+        index.refresh(pgmap, ['1.0'])
+        pgmap.stats['1.0'] = pg_stat('active+clean', reported_epoch=11)
+        pgmap.epoch = 11
+        index.refresh(pgmap, ['1.0', '1.1'])
+        assert pgmap.calls[1:] == [(['1.0'], 10), (['1.1'], 0)]
+        assert index.get('1.0')['state'] == 'active+clean'
+        assert index.get('1.1')['state'] == 'active+recovering'
+
+    def test_refresh_drops_missing_and_unwanted_pgs(self):
+        pgmap = FakePGMap({'1.0': pg_stat('active+clean'),
+                           '1.1': pg_stat('active+clean')})
+        index = PgStateIndex()
+        index.refresh(pgmap, ['1.0', '1.1'])
+        del pgmap.stats['1.0']
+        index.refresh(pgmap, ['1.0'])
+        assert index.get('1.0') is None
+        assert index.get('1.1') is None
+
+    def test_full_refresh(self):
+        pgmap = FakePGMap({'1.0': pg_stat('active+recovering')})
+        index = PgStateIndex()
+        for _ in range(PgStateIndex.FULL_REFRESH_INTERVAL):
+            index.refresh(pgmap, ['1.0'])
+        assert pgmap.calls[-1] == (['1.0'], 0)
+
+
+class FakeOSDMap(object):
+    def __init__(self, epoch, diff):
+        self.epoch = epoch
+        self.diff = diff
+
+    def get_epoch(self):
+        return self.epoch
+
+    def map_pgs_acting_diff(self, new_map, osd_id):
+        return self.diff
+
+
+class TestOsdInOut(object):
+
+    def _module(self, stats):
+        pgmap = FakePGMap(stats)
+        m = Module()
+        m.log = pgmap.log
+        m.get_pg_stats = pgmap.get_pg_stats
+        m.update_progress_event = mock.MagicMock()
+        m.complete_progress_event = mock.MagicMock()
+        m.max_completed_events = 50
+        return m, pgmap
+
+    def test_osd_out_tracks_recovery(self):
+        m, pgmap = self._module({'1.0': pg_stat('active+recovering'),
+                                 '1.1': pg_stat('active+clean')})
+        diff = {
+            '1.0': {'pool': 1, 'ps': 0, 'old_acting': [0, 1], 'new_acting': [1, 2]},
+            '1.1': {'pool': 1, 'ps': 1, 'old_acting': [0, 1], 'new_acting': [1, 3]},
+        }
+        old_map = FakeOSDMap(9, diff)
+        m.get_osdmap = lambda: FakeOSDMap(10, {})
+        m._osd_in_out(old_map, None, 0, "out")
+
+        events = list(m._events.values())
+        assert len(events) == 1
+        ev = events[0]
+        assert isinstance(ev, PgRecoveryEvent)
+        assert pgmap.calls == [(['1.0', '1.1'], 0)]
+        assert ev.pgids == ['1.0']
+        assert ev.progress == 0.5
+
+        pgmap.stats['1.0'] = pg_stat('active+clean', reported_epoch=11)
+        m._ready.set()
+        m.notify('pg_summary', None)
+        assert ev.progress == 1.0
+        assert ev.id not in m._events
+
+    def test_osd_in_cancels_out_event(self):
+        m, _ = self._module({'1.0': pg_stat('active+recovering')})
+        diff = {'1.0': {'pool': 1, 'ps': 0, 'old_acting': [0, 1], 'new_acting': [1, 2]}}
+        m.get_osdmap = lambda: FakeOSDMap(10, {})
+        m._osd_in_out(FakeOSDMap(9, diff), None, 0, "out")
+        out_ev = list(m._events)[0]
+
+        back = {'1.0': {'pool': 1, 'ps': 0, 'old_acting': [1, 2], 'new_acting': [0, 1]}}
+        m._osd_in_out(FakeOSDMap(10, back), None, 0, "in")
+        assert out_ev not in m._events
+        assert len(m._events) == 1
+        m.complete_progress_event.assert_called_once_with(out_ev)
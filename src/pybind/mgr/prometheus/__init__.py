@@ -1,2 +1,6 @@
-from .module import Module, StandbyModule
+import os
+
+if 'UNITTEST' in os.environ:
+    import tests
 
+from .module import Module, StandbyModule
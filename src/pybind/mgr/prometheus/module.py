@@ -8,6 +8,7 @@ import re
 import socket
 import threading
 import time
+import zlib
 from mgr_module import MgrModule, MgrStandbyModule, CommandResult, PG_STATES
 from mgr_util import get_default_addr
 from rbd import RBD
@@ -108,6 +109,52 @@ DISK_OCCUPATION = ('ceph_daemon', 'device', 'db_device',
 
 NUM_OBJECTS = ['degraded', 'misplaced', 'unfound']
 
+# (collector name, Module method) of the stages of a collection, in the
+# order they run
+COLLECTORS = (
+    ('health', 'get_health'),
+    ('df', 'get_df'),
+    ('pool_stats', 'get_pool_stats'),
+    ('fs', 'get_fs'),
+    ('osd_stats', 'get_osd_stats'),
+    ('quorum_status', 'get_quorum_status'),
+    ('mgr_status', 'get_mgr_status'),
+    ('metadata_and_osd_status', 'get_metadata_and_osd_status'),
+    ('pg_status', 'get_pg_status'),
+    ('num_objects', 'get_num_objects'),
+    ('perf_counters', 'get_perf_counter_metrics'),
+    ('rbd_stats', 'get_rbd_stats'),
+)
+
+CONTENT_TYPE_TEXT = 'text/plain; version=0.0.4; charset=utf-8'
+CONTENT_TYPE_OPENMETRICS = \
+    'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def promethize(path):
+    ''' replace illegal metric name characters '''
+    result = re.sub(r'[./\s]|::', '_', path).replace('+', '_plus')
+
+    # Hyphens usually turn into underscores, unless they are
+    # trailing
+    if result.endswith("-"):
+        result = result[0:-1] + "_minus"
+    else:
+        result = result.replace("-", "_")
+
+    return "ceph_{0}".format(result)
+
+
+def floatstr(value):
+    ''' represent as Go-compatible float '''
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    if math.isnan(value):
+        return 'NaN'
+    return repr(float(value))
+
 
 class Metric(object):
     def __init__(self, mtype, name, desc, labels=None):
@@ -117,6 +164,33 @@ class Metric(object):
         self.labelnames = labels    # tuple if present
         self.value = {}             # indexed by label values
 
+        # The sanitized name, the HELP/TYPE header and the rendered
+        # '\nname{labels} ' prefix of each label tuple don't change
+        # between scrapes, so render them once and keep them around.
+        self._name = promethize(name)
+        self._header = '\n# HELP {name} {desc}\n# TYPE {name} {mtype}'.format(
+            name=self._name,
+            desc=desc,
+            mtype=mtype,
+        )
+        self._prefixes = {}         # indexed by label values
+
+        # OpenMetrics names counter families without the '_total'
+        # suffix their samples carry, and has no 'untyped'
+        om_family = self._name
+        om_sample = self._name
+        if mtype == 'counter':
+            if om_family.endswith('_total'):
+                om_family = om_family[:-len('_total')]
+            om_sample = om_family + '_total'
+        self._om_sample = om_sample
+        self._om_header = '\n# HELP {name} {desc}\n# TYPE {name} {mtype}'.format(
+            name=om_family,
+            desc=desc.replace('\\', r'\\').replace('\n', r'\n'),
+            mtype='unknown' if mtype == 'untyped' else mtype,
+        )
+        self._om_prefixes = {}      # indexed by label values
+
     def clear(self):
         self.value = {}
 
@@ -125,56 +199,199 @@ class Metric(object):
         labelvalues = labelvalues or ('',)
         self.value[labelvalues] = value
 
+    def _prefix(self, name, labelvalues):
+        if self.labelnames:
+            labels = ','.join('%s="%s"' % (k, v) for k, v in
+                              zip(self.labelnames, labelvalues))
+        else:
+            labels = ''
+        if labels:
+            return '\n{name}{{{labels}}} '.format(name=name, labels=labels)
+        return '\n{name} '.format(name=name)
+
+    def expfmt_chunks(self, openmetrics=False, values=None):
+        """
+        Render the metric as a list of string chunks, to be joined by
+        the caller.  Every line, the first included, starts with a
+        newline.
+
+        :param openmetrics: render in the OpenMetrics format instead of
+            the Prometheus text exposition format
+        :param values: render these values, indexed by label values,
+            instead of the current ones
+        """
+        if values is None:
+            values = self.value
+        if openmetrics:
+            name = self._om_sample
+            header = self._om_header
+            prefixes = self._om_prefixes
+        else:
+            name = self._name
+            header = self._header
+            prefixes = self._prefixes
+
+        chunks = [header]
+        for labelvalues, value in values.items():
+            prefix = prefixes.get(labelvalues)
+            if prefix is None:
+                prefix = prefixes[labelvalues] = self._prefix(name,
+                                                              labelvalues)
+            chunks.append(prefix)
+            chunks.append(floatstr(value))
+
+        # forget the label sets of daemons, pools and images that
+        # went away
+        if len(prefixes) > 2 * len(values) + 16:
+            prefixes = {k: v for k, v in prefixes.items() if k in values}
+            if openmetrics:
+                self._om_prefixes = prefixes
+            else:
+                self._prefixes = prefixes
+        return chunks
+
     def str_expfmt(self):
+        return ''.join(self.expfmt_chunks())
+
+
+def gzip_compressor():
+    return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def negotiate_format():
+    """
+    Pick the exposition format and content encoding of the response to
+    the current request from its Accept and Accept-Encoding headers.
+
+    :return: (openmetrics, gzip) tuple of bools
+    """
+    openmetrics = False
+    # elements() sorts by quality, highest first
+    for accept in cherrypy.request.headers.elements('Accept'):
+        if accept.qvalue <= 0:
+            continue
+        if accept.value == 'application/openmetrics-text':
+            openmetrics = True
+            break
+        if accept.value in ('text/plain', 'text/*', '*/*'):
+            break
+    gzip = any(
+        encoding.value in ('gzip', '*') and encoding.qvalue > 0
+        for encoding in cherrypy.request.headers.elements('Accept-Encoding'))
+    return openmetrics, gzip
+
+
+def set_response_headers(openmetrics, gzip):
+    headers = cherrypy.response.headers
+    if openmetrics:
+        headers['Content-Type'] = CONTENT_TYPE_OPENMETRICS
+    else:
+        headers['Content-Type'] = CONTENT_TYPE_TEXT
+    if gzip:
+        headers['Content-Encoding'] = 'gzip'
+    headers['Vary'] = 'Accept, Accept-Encoding'
+
+
+class Exposition(object):
+    """
+    The rendered result of one collection, in the text exposition
+    format and, once the first scrape asks for it, in the OpenMetrics
+    format.  Each body is compressed once, and the compressor state is
+    kept so that scrapes only have to compress the short, per-request
+    tail appended to it.
+    """
+
+    def __init__(self, text, metrics):
+        """
+        :param text: the body in the text exposition format
+        :param metrics: (Metric, values) pairs to render the OpenMetrics
+            body from
+        """
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.bodies = {}
+        self.compressed = {}
+        self._add_body(False, text)
+
+    def _add_body(self, openmetrics, body):
+        body = body.encode('utf-8')
+        compressor = gzip_compressor()
+        self.compressed[openmetrics] = (compressor.compress(body), compressor)
+        self.bodies[openmetrics] = body
+
+    def _render_openmetrics(self):
+        with self.lock:
+            if True in self.bodies:
+                return
+            chunks = []
+            for metric, values in self.metrics:
+                chunks.extend(metric.expfmt_chunks(openmetrics=True,
+                                                   values=values))
+            # no empty lines allowed in OpenMetrics
+            self._add_body(True, ''.join(chunks)[1:])
+            self.metrics = None
+
+    def render(self, openmetrics, gzip, tail):
+        if openmetrics not in self.bodies:
+            self._render_openmetrics()
+        tail = tail.encode('utf-8')
+        if not gzip:
+            return self.bodies[openmetrics] + tail
+        prefix, compressor = self.compressed[openmetrics]
+        compressor = compressor.copy()
+        return prefix + compressor.compress(tail) + compressor.flush()
+
+
+class MetricCollectionThread(threading.Thread):
+    """
+    Rebuild the exposition text in the background, once per
+    ``scrape_interval``, so that ``/metrics`` never has to run a
+    collection itself.  The new text is built off to the side and
+    swapped into ``collect_cache`` under ``collect_lock`` once complete.
+    """
+
+    def __init__(self, module):
+        super(MetricCollectionThread, self).__init__(name='prometheus-collect')
+        self.daemon = True
+        self.mod = module
+        self.event = threading.Event()
+        self.active = True
+
+    def run(self):
+        self.mod.log.info('starting metric collection thread')
+        while self.active:
+            if not self.mod.have_mon_connection():
+                self.mod.log.debug('No MON connection, skipping collection')
+                self.event.wait(self.mod.collect_timeout)
+                continue
 
-        def promethize(path):
-            ''' replace illegal metric name characters '''
-            result = re.sub(r'[./\s]|::', '_', path).replace('+', '_plus')
+            start = time.time()
+            try:
+                data = self.mod.collect()
+            except Exception:
+                self.mod.log.exception('failed to collect metrics:')
+                self.event.wait(self.mod.collect_timeout)
+                continue
+            duration = time.time() - start
 
-            # Hyphens usually turn into underscores, unless they are
-            # trailing
-            if result.endswith("-"):
-                result = result[0:-1] + "_minus"
-            else:
-                result = result.replace("-", "_")
-
-            return "ceph_{0}".format(result)
-
-        def floatstr(value):
-            ''' represent as Go-compatible float '''
-            if value == float('inf'):
-                return '+Inf'
-            if value == float('-inf'):
-                return '-Inf'
-            if math.isnan(value):
-                return 'NaN'
-            return repr(float(value))
-
-        name = promethize(self.name)
-        expfmt = '''
-# HELP {name} {desc}
-# TYPE {name} {mtype}'''.format(
-            name=name,
-            desc=self.desc,
-            mtype=self.mtype,
-        )
+            with self.mod.collect_lock:
+                self.mod.collect_cache = data
+                self.mod.collect_time = time.time()
+                self.mod.collect_duration = duration
 
-        for labelvalues, value in self.value.items():
-            if self.labelnames:
-                labels = zip(self.labelnames, labelvalues)
-                labels = ','.join('%s="%s"' % (k, v) for k, v in labels)
-            else:
-                labels = ''
-            if labels:
-                fmtstr = '\n{name}{{{labels}}} {value}'
-            else:
-                fmtstr = '\n{name} {value}'
-            expfmt += fmtstr.format(
-                name=name,
-                labels=labels,
-                value=floatstr(value),
-            )
-        return expfmt
+            sleep_time = self.mod.collect_timeout - duration
+            if sleep_time < 0:
+                self.mod.log.warning(
+                    'Collecting metrics took {:.2f}s, longer than the '
+                    'configured scrape_interval of {:.2f}s'.format(
+                        duration, self.mod.collect_timeout))
+                sleep_time = 0
+            self.event.wait(sleep_time)
+        self.mod.log.info('metric collection thread stopped')
+
+    def stop(self):
+        self.active = False
+        self.event.set()
 
 
 class Module(MgrModule):
@@ -192,6 +409,8 @@ class Module(MgrModule):
         {'name': 'scrape_interval'},
         {'name': 'rbd_stats_pools'},
         {'name': 'rbd_stats_pools_refresh_interval'},
+        {'name': 'disabled_collectors'},
+        {'name': 'collector_intervals'},
     ]
 
     def __init__(self, *args, **kwargs):
@@ -201,7 +420,30 @@ class Module(MgrModule):
         self.collect_lock = threading.RLock()
         self.collect_time = 0
         self.collect_timeout = 5.0
+        self.collect_duration = 0.0
         self.collect_cache = None
+        self.collect_thread = None
+        # Lookups that only change along with the cluster maps, so that
+        # a collection does not have to redo them for every OSD
+        self.osd_index = {
+            'epoch': None,      # osdmap epoch dev_class was built from
+            'dev_class': {},    # osd id -> crush device class
+            'metadata': {},     # osd id -> (up_from, daemon metadata)
+        }
+        # (service id, service type) -> (hostname, ceph version), and
+        # the generation of the daemon/map changes it was built from
+        self.servers_cache = None
+        self.servers_gen = 0
+        # per collector: when it last ran, how long that took, the
+        # metrics it filled in and how often its results were reused
+        self.collectors = {
+            name: {
+                'last_run': 0,
+                'duration': 0.0,
+                'metrics': set(),
+                'cache_hits': 0,
+            } for name, _ in COLLECTORS
+        }
         self.rbd_stats = {
             'pools': {},
             'pools_refresh_time': 0,
@@ -382,6 +624,26 @@ class Module(MgrModule):
                 'Number of {} objects'.format(state),
             )
 
+        metrics['mgr_prometheus_collector_duration_seconds'] = Metric(
+            'gauge',
+            'mgr_prometheus_collector_duration_seconds',
+            'Time spent in the last run of each collector',
+            ('collector',)
+        )
+        metrics['mgr_prometheus_collector_series'] = Metric(
+            'gauge',
+            'mgr_prometheus_collector_series',
+            'Number of series exported by each collector',
+            ('collector',)
+        )
+        metrics['mgr_prometheus_collector_cache_hits'] = Metric(
+            'counter',
+            'mgr_prometheus_collector_cache_hits',
+            'Number of collections that reused the previous results of '
+            'each collector',
+            ('collector',)
+        )
+
         return metrics
 
     def get_health(self):
@@ -548,14 +810,47 @@ class Module(MgrModule):
                 ))
 
     def get_service_list(self):
+        gen = self.servers_gen
+        if self.servers_cache is not None and self.servers_cache[0] == gen:
+            return self.servers_cache[1]
+
         ret = {}
         for server in self.list_servers():
             version = server.get('ceph_version', '')
             host = server.get('hostname', '')
             for service in server.get('services', []):
                 ret.update({(service['id'], service['type']): (host, version)})
+        self.servers_cache = (gen, ret)
         return ret
 
+    def get_osd_dev_class(self, osd_map, id_):
+        index = self.osd_index
+        if index['epoch'] != osd_map['epoch']:
+            index['dev_class'] = {
+                osd_device['id']: osd_device.get('class', '')
+                for osd_device in self.get('osd_map_crush')['devices']
+            }
+            index['epoch'] = osd_map['epoch']
+        return index['dev_class'].get(id_)
+
+    def get_osd_metadata(self, osd):
+        # daemon metadata only changes when the OSD restarts, and that
+        # shows up as a new up_from
+        id_ = osd['osd']
+        cached = self.osd_index['metadata'].get(id_)
+        if cached is not None and cached[0] == osd['up_from']:
+            return cached[1]
+        osd_metadata = self.get_metadata("osd", str(id_))
+        if osd_metadata is not None:
+            self.osd_index['metadata'][id_] = (osd['up_from'], osd_metadata)
+        return osd_metadata
+
+    def prune_osd_index(self, osd_map):
+        osd_ids = set(osd['osd'] for osd in osd_map['osds'])
+        metadata = self.osd_index['metadata']
+        for id_ in [i for i in metadata if i not in osd_ids]:
+            del metadata[id_]
+
     def get_metadata_and_osd_status(self):
         osd_map = self.get('osd_map')
         osd_flags = osd_map['flags'].split(',')
@@ -564,7 +859,6 @@ class Module(MgrModule):
                 int(flag in osd_flags)
             )
 
-        osd_devices = self.get('osd_map_crush')['devices']
         servers = self.get_service_list()
         for osd in osd_map['osds']:
             # id can be used to link osd metrics and metadata
@@ -579,12 +873,7 @@ class Module(MgrModule):
                 )
                 continue
 
-            dev_class = None
-            for osd_device in osd_devices:
-                if osd_device['id'] == id_:
-                    dev_class = osd_device.get('class', '')
-                    break
-
+            dev_class = self.get_osd_dev_class(osd_map, id_)
             if dev_class is None:
                 self.log.info("OSD {0} is missing from CRUSH map, "
                               "skipping output".format(id_))
@@ -593,7 +882,7 @@ class Module(MgrModule):
             host_version = servers.get((str(id_), 'osd'), ('', ''))
 
             # collect disk occupation metadata
-            osd_metadata = self.get_metadata("osd", str(id_))
+            osd_metadata = self.get_osd_metadata(osd)
             if osd_metadata is None:
                 continue
 
@@ -654,6 +943,9 @@ class Module(MgrModule):
                 self.log.info("Missing dev node metadata for osd {0}, skipping "
                               "occupation record for this osd".format(id_))
 
+        if len(self.osd_index['metadata']) > len(osd_map['osds']):
+            self.prune_osd_index(osd_map)
+
         for pool in osd_map['pools']:
             self.metrics['pool_metadata'].set(
                 1, (pool['pool'], pool['pool_name']))
@@ -675,8 +967,8 @@ class Module(MgrModule):
                 mirror_metadata['ceph_daemon'] = '{}.{}'.format(service_type,
                                                                 service_id)
                 self.metrics['rbd_mirror_metadata'].set(
-                    1, (mirror_metadata.get(k, '')
-                        for k in RBD_MIRROR_METADATA)
+                    1, tuple(mirror_metadata.get(k, '')
+                             for k in RBD_MIRROR_METADATA)
                 )
 
     def get_num_objects(self):
@@ -907,22 +1199,7 @@ class Module(MgrModule):
             del self.rbd_stats['query']
         self.rbd_stats['pools'].clear()
 
-    def collect(self):
-        # Clear the metrics before scraping
-        for k in self.metrics.keys():
-            self.metrics[k].clear()
-
-        self.get_health()
-        self.get_df()
-        self.get_pool_stats()
-        self.get_fs()
-        self.get_osd_stats()
-        self.get_quorum_status()
-        self.get_mgr_status()
-        self.get_metadata_and_osd_status()
-        self.get_pg_status()
-        self.get_num_objects()
-
+    def get_perf_counter_metrics(self):
         for daemon, counters in self.get_all_perf_counters().items():
             for path, counter_info in counters.items():
                 # Skip histograms, they are represented by long running avgs
@@ -969,14 +1246,151 @@ class Module(MgrModule):
                         )
                     self.metrics[path].set(value, labels)
 
-        self.get_rbd_stats()
+    def get_collector_options(self):
+        """
+        Parse the disabled_collectors option, a comma or space separated
+        list of collector names, and the collector_intervals option, a
+        comma or space separated list of collector=seconds entries for
+        collectors that should run less often than every collection.
+
+        :return: (set of disabled collectors, dict of collector intervals)
+        """
+        disabled = set()
+        disabled_string = self.get_localized_module_option(
+            'disabled_collectors', '')
+        for name in [x for x in re.split(r'[\s,]+', disabled_string) if x]:
+            if name not in self.collectors:
+                self.log.warning('unknown collector %s in disabled_collectors'
+                                 % name)
+                continue
+            disabled.add(name)
 
-        # Return formatted metrics and clear no longer used data
-        _metrics = [m.str_expfmt() for m in self.metrics.values()]
-        for k in self.metrics.keys():
-            self.metrics[k].clear()
+        intervals = {}
+        intervals_string = self.get_localized_module_option(
+            'collector_intervals', '')
+        for entry in [x for x in re.split(r'[\s,]+', intervals_string) if x]:
+            name, _, interval = entry.partition('=')
+            try:
+                interval = float(interval)
+            except ValueError:
+                self.log.warning('invalid interval %s in collector_intervals'
+                                 % entry)
+                continue
+            if name not in self.collectors:
+                self.log.warning('unknown collector %s in collector_intervals'
+                                 % name)
+                continue
+            intervals[name] = interval
+        return disabled, intervals
+
+    def collect(self):
+        """
+        Collect all metrics and render them in the text exposition
+        format.  The OpenMetrics format is rendered from the same values
+        when a scrape first asks for it.
+
+        :rtype: Exposition
+        """
+        disabled, intervals = self.get_collector_options()
+        if 'rbd_stats' in disabled and 'query_id' in self.rbd_stats:
+            self.shutdown_rbd_stats()
+
+        # Collectors with an interval that are not due yet keep the
+        # series of their last run
+        now = time.time()
+        due = []
+        keep = set()
+        for name, method in COLLECTORS:
+            if name in disabled:
+                continue
+            collector = self.collectors[name]
+            if name in intervals and \
+               now - collector['last_run'] < intervals[name]:
+                collector['cache_hits'] += 1
+                keep.update(collector['metrics'])
+            else:
+                due.append((name, method))
 
-        return ''.join(_metrics) + '\n'
+        # Clear the metrics before scraping
+        for k in self.metrics.keys():
+            if k not in keep:
+                self.metrics[k].clear()
+
+        for name, method in due:
+            collector = self.collectors[name]
+            before = set(k for k, m in self.metrics.items() if m.value)
+            start = time.time()
+            getattr(self, method)()
+            collector['duration'] = time.time() - start
+            collector['last_run'] = start
+            collector['metrics'] = set(
+                k for k, m in self.metrics.items() if m.value) - before
+
+        for name, _ in COLLECTORS:
+            if name in disabled:
+                continue
+            collector = self.collectors[name]
+            self.metrics['mgr_prometheus_collector_duration_seconds'].set(
+                collector['duration'], (name,))
+            self.metrics['mgr_prometheus_collector_series'].set(
+                sum(len(self.metrics[k].value) for k in collector['metrics']),
+                (name,))
+            self.metrics['mgr_prometheus_collector_cache_hits'].set(
+                collector['cache_hits'], (name,))
+
+        # Return formatted metrics and clear no longer used data.  The
+        # rendered bodies leave out the final newline (and '# EOF') so
+        # that get_cached_metrics() can append to them.
+        # Series kept for collectors that run less often stay around,
+        # so the OpenMetrics body gets a copy of their values.
+        _metrics = []
+        _om_metrics = []
+        keep = set()
+        for name in intervals:
+            keep.update(self.collectors[name]['metrics'])
+        for k, m in self.metrics.items():
+            _metrics.extend(m.expfmt_chunks())
+            if k in keep:
+                _om_metrics.append((m, dict(m.value)))
+            else:
+                _om_metrics.append((m, m.value))
+                m.clear()
+
+        return Exposition(''.join(_metrics), _om_metrics)
+
+    def get_cached_metrics(self, openmetrics=False, gzip=False):
+        """
+        Return the last complete exposition, followed by the age of that
+        snapshot, or None if no collection has finished yet.
+
+        :param openmetrics: return the OpenMetrics format instead of the
+            text exposition format
+        :param gzip: gzip-compress the returned body
+        :return: the body, or None
+        """
+        with self.collect_lock:
+            data = self.collect_cache
+            collect_time = self.collect_time
+            duration = self.collect_duration
+        if data is None:
+            return None
+
+        age = Metric(
+            'gauge',
+            'mgr_prometheus_metrics_age_seconds',
+            'Seconds since the served metrics were collected'
+        )
+        age.set(time.time() - collect_time)
+        collect_duration = Metric(
+            'gauge',
+            'mgr_prometheus_collect_duration_seconds',
+            'Time spent collecting the served metrics'
+        )
+        collect_duration.set(duration)
+        tail = age.expfmt_chunks(openmetrics) + \
+            collect_duration.expfmt_chunks(openmetrics)
+        tail.append('\n# EOF\n' if openmetrics else '\n')
+        return data.render(openmetrics, gzip, ''.join(tail))
 
     def get_file_sd_config(self):
         servers = self.list_servers()
@@ -1014,8 +1428,14 @@ class Module(MgrModule):
         ]
         return 0, json.dumps(ret), ""
 
+    def notify(self, notify_type, notify_id):
+        if notify_type in ('osd_map', 'mon_map', 'fs_map', 'service_map',
+                           'perf_schema_update'):
+            # daemons were added, removed or restarted
+            self.servers_gen += 1
+
     def self_test(self):
-        self.collect()
+        self.collect().render(True, False, '')
         self.get_file_sd_config()
 
     def handle_command(self, inbuf, cmd):
@@ -1048,33 +1468,22 @@ class Module(MgrModule):
             @cherrypy.expose
             def metrics(self):
                 instance = global_instance()
-                # Lock the function execution
-                try:
-                    instance.collect_lock.acquire()
-                    return self._metrics(instance)
-                finally:
-                    instance.collect_lock.release()
-
-            @staticmethod
-            def _metrics(instance):
-                # Return cached data if available and collected before the
-                # cache times out
-                if instance.collect_cache and time.time() - instance.collect_time < instance.collect_timeout:
-                    cherrypy.response.headers['Content-Type'] = 'text/plain'
-                    return instance.collect_cache
-
-                if instance.have_mon_connection():
-                    instance.collect_cache = None
-                    instance.collect_time = time.time()
-                    instance.collect_cache = instance.collect()
-                    cherrypy.response.headers['Content-Type'] = 'text/plain'
-                    return instance.collect_cache
-                else:
+                if not instance.have_mon_connection():
                     raise cherrypy.HTTPError(503, 'No MON connection')
 
-        # Make the cache timeout for collecting configurable
+                # Serve the last snapshot built by the collection thread
+                openmetrics, gzip = negotiate_format()
+                body = instance.get_cached_metrics(openmetrics, gzip)
+                if body is None:
+                    raise cherrypy.HTTPError(503, 'No metrics collected yet')
+                set_response_headers(openmetrics, gzip)
+                return body
+
+        # The collection thread rebuilds the metrics once per scrape_interval
         self.collect_timeout = float(self.get_localized_module_option(
             'scrape_interval', 5.0))
+        self.collect_thread = MetricCollectionThread(self)
+        self.collect_thread.start()
 
         server_addr = self.get_localized_module_option(
             'server_addr', get_default_addr())
@@ -1106,6 +1515,8 @@ class Module(MgrModule):
         self.shutdown_event.clear()
         cherrypy.engine.stop()
         self.log.info('Engine stopped.')
+        self.collect_thread.stop()
+        self.collect_thread.join()
         self.shutdown_rbd_stats()
 
     def shutdown(self):
@@ -1148,8 +1559,13 @@ class StandbyModule(MgrStandbyModule):
 
             @cherrypy.expose
             def metrics(self):
-                cherrypy.response.headers['Content-Type'] = 'text/plain'
-                return ''
+                openmetrics, gzip = negotiate_format()
+                set_response_headers(openmetrics, gzip)
+                body = b'# EOF\n' if openmetrics else b''
+                if gzip:
+                    compressor = gzip_compressor()
+                    body = compressor.compress(body) + compressor.flush()
+                return body
 
         cherrypy.tree.mount(Root(), '/', {})
         self.log.info('Starting engine...')
@@ -0,0 +1,42 @@
+"""
+Benchmark rendering the exposition format of 5000 OSDs x 50 counters,
+against the straightforward str.format/+= rendering.
+
+    UNITTEST=true python -m prometheus.tests.bench_expfmt [rounds]
+
+(from src/pybind/mgr)
+"""
+from __future__ import print_function
+
+import sys
+import time
+
+from .test_module import osd_counter_metrics, reference_expfmt
+
+
+def bench_5000_osds(rounds=3):
+    metrics = osd_counter_metrics(5000)
+    for m in metrics:
+        m.str_expfmt()  # warm the label cache, as after the first scrape
+
+    def best_of(render):
+        best = float('inf')
+        for _ in range(rounds):
+            start = time.time()
+            render()
+            best = min(best, time.time() - start)
+        return best
+
+    reference = best_of(
+        lambda: ''.join(reference_expfmt(m) for m in metrics))
+    chunked = best_of(
+        lambda: ''.join(c for m in metrics for c in m.expfmt_chunks()))
+    return reference, chunked
+
+
+if __name__ == '__main__':
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    reference, chunked = bench_5000_osds(rounds)
+    print('5000 OSDs x 50 counters: reference {:.3f}s, '
+          'chunked {:.3f}s ({:.1f}x)'.format(reference, chunked,
+                                            reference / chunked))
@@ -0,0 +1,416 @@
+import gzip
+import threading
+import time
+
+import cherrypy
+from cherrypy.lib.httputil import HeaderMap
+import pytest
+
+from tests import mock  # noqa: F401
+
+from ..module import COLLECTORS, Module, Metric, Exposition, promethize, floatstr, \
+    negotiate_format, set_response_headers
+
+
+@pytest.fixture()
+def prometheus_module():
+    with mock.patch("prometheus.module.Module.get_ceph_option",
+                    lambda *args: ''), \
+            mock.patch("prometheus.module.Module._configure_logging",
+                       lambda *args: None):
+        Module._register_commands('')
+        m = Module.__new__(Module)
+        m._root_logger = mock.MagicMock()
+        m.__init__('prometheus', 0, 0)
+        yield m
+
+
+def reference_expfmt(metric):
+    # the straightforward str.format/+= rendering, as a reference for
+    # what Metric.str_expfmt() must produce
+    name = promethize(metric.name)
+    expfmt = '\n# HELP {name} {desc}\n# TYPE {name} {mtype}'.format(
+        name=name, desc=metric.desc, mtype=metric.mtype)
+    for labelvalues, value in metric.value.items():
+        if metric.labelnames:
+            labels = ','.join('%s="%s"' % (k, v) for k, v in
+                              zip(metric.labelnames, labelvalues))
+        else:
+            labels = ''
+        if labels:
+            expfmt += '\n{name}{{{labels}}} {value}'.format(
+                name=name, labels=labels, value=floatstr(value))
+        else:
+            expfmt += '\n{name} {value}'.format(name=name,
+                                                value=floatstr(value))
+    return expfmt
+
+
+def osd_counter_metrics(num_osds, num_counters=50):
+    metrics = []
+    for c in range(num_counters):
+        m = Metric('counter', 'osd.op_{}-r::lat'.format(c),
+                   'counter {}'.format(c), ('ceph_daemon',))
+        for osd in range(num_osds):
+            m.set(osd * c, ('osd.{}'.format(osd),))
+        metrics.append(m)
+    return metrics
+
+
+class TestMetric(object):
+
+    def test_promethize(self):
+        assert promethize('osd.op_r') == 'ceph_osd_op_r'
+        assert promethize('rocksdb::get lat') == 'ceph_rocksdb_get_lat'
+        assert promethize('osd.numpg+') == 'ceph_osd_numpg_plus'
+        assert promethize('paxos.begin-') == 'ceph_paxos_begin_minus'
+        assert promethize('mds-cache.inodes') == 'ceph_mds_cache_inodes'
+
+    def test_floatstr(self):
+        assert floatstr(1) == '1.0'
+        assert floatstr(float('inf')) == '+Inf'
+        assert floatstr(float('-inf')) == '-Inf'
+        assert floatstr(float('nan')) == 'NaN'
+
+    def test_no_labels(self):
+        m = Metric('gauge', 'pg_total', 'PG Total Count')
+        m.set(42)
+        assert m.str_expfmt() == (
+            '\n# HELP ceph_pg_total PG Total Count'
+            '\n# TYPE ceph_pg_total gauge'
+            '\nceph_pg_total 42.0')
+
+    def test_labels(self):
+        m = Metric('untyped', 'pool_metadata', 'POOL Metadata',
+                   ('pool_id', 'name'))
+        m.set(1, (1, 'rbd'))
+        m.set(1, (2, 'cephfs.a.data'))
+        assert m.str_expfmt() == (
+            '\n# HELP ceph_pool_metadata POOL Metadata'
+            '\n# TYPE ceph_pool_metadata untyped'
+            '\nceph_pool_metadata{pool_id="1",name="rbd"} 1.0'
+            '\nceph_pool_metadata{pool_id="2",name="cephfs.a.data"} 1.0')
+
+    def test_rerender_after_clear(self):
+        m = Metric('gauge', 'osd_up', 'OSD status up', ('ceph_daemon',))
+        m.set(1, ('osd.0',))
+        m.set(1, ('osd.1',))
+        first = m.str_expfmt()
+        m.clear()
+        m.set(1, ('osd.0',))
+        m.set(0, ('osd.1',))
+        assert m.str_expfmt() == first.replace(
+            'ceph_osd_up{ceph_daemon="osd.1"} 1.0',
+            'ceph_osd_up{ceph_daemon="osd.1"} 0.0')
+
+    def test_prune_label_cache(self):
+        m = Metric('gauge', 'osd_up', 'OSD status up', ('ceph_daemon',))
+        for osd in range(100):
+            m.set(1, ('osd.{}'.format(osd),))
+        m.str_expfmt()
+        m.clear()
+        m.set(1, ('osd.0',))
+        assert m.str_expfmt() == reference_expfmt(m)
+        assert list(m._prefixes) == [('osd.0',)]
+
+    def test_matches_reference(self):
+        for m in osd_counter_metrics(50, 5):
+            assert m.str_expfmt() == reference_expfmt(m)
+            # and again, from the label cache
+            assert m.str_expfmt() == reference_expfmt(m)
+
+    def test_openmetrics(self):
+        m = Metric('counter', 'osd.op_r', 'Client read operations',
+                   ('ceph_daemon',))
+        m.set(3, ('osd.0',))
+        assert ''.join(m.expfmt_chunks(openmetrics=True)) == (
+            '\n# HELP ceph_osd_op_r Client read operations'
+            '\n# TYPE ceph_osd_op_r counter'
+            '\nceph_osd_op_r_total{ceph_daemon="osd.0"} 3.0')
+        # the text format is unaffected
+        assert m.str_expfmt() == reference_expfmt(m)
+
+        m = Metric('counter', 'requests_total', 'Requests')
+        m.set(1)
+        assert ''.join(m.expfmt_chunks(openmetrics=True)) == (
+            '\n# HELP ceph_requests Requests'
+            '\n# TYPE ceph_requests counter'
+            '\nceph_requests_total 1.0')
+
+        m = Metric('untyped', 'health_status', 'Cluster health status')
+        m.set(0)
+        assert ''.join(m.expfmt_chunks(openmetrics=True)) == (
+            '\n# HELP ceph_health_status Cluster health status'
+            '\n# TYPE ceph_health_status unknown'
+            '\nceph_health_status 0.0')
+
+
+class TestExposition(object):
+
+    @staticmethod
+    def exposition(metrics):
+        return Exposition(''.join(c for m in metrics for c in m.expfmt_chunks()),
+                          [(m, m.value) for m in metrics])
+
+    @pytest.mark.parametrize("openmetrics", [False, True])
+    def test_render(self, openmetrics):
+        metrics = osd_counter_metrics(20, 50)
+        exposition = self.exposition(metrics)
+        body = ''.join(c for m in metrics for c in m.expfmt_chunks(openmetrics))
+        if openmetrics:
+            body = body[1:]
+        tail = '\nceph_b 2.0\n'
+        assert exposition.render(openmetrics, False, tail) == \
+            (body + tail).encode('utf-8')
+        compressed = exposition.render(openmetrics, True, tail)
+        assert gzip.decompress(compressed) == (body + tail).encode('utf-8')
+        # the cached compressor state is not consumed by a scrape
+        assert exposition.render(openmetrics, True, tail) == compressed
+
+    def test_openmetrics_on_demand(self):
+        metrics = osd_counter_metrics(2, 2)
+        exposition = self.exposition(metrics)
+        assert list(exposition.bodies) == [False]
+        # later collections don't change the values of this one
+        expected = ''.join(c for m in metrics for c in m.expfmt_chunks(True))[1:]
+        for m in metrics:
+            m.clear()
+
+        barrier = threading.Barrier(4)
+        bodies = []
+
+        def scrape():
+            barrier.wait()
+            bodies.append(exposition.render(True, False, ''))
+        with mock.patch.object(Metric, 'expfmt_chunks', autospec=True,
+                               side_effect=Metric.expfmt_chunks) as expfmt_chunks:
+            threads = [threading.Thread(target=scrape) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        # rendered once, by the first of the scrapes
+        assert expfmt_chunks.call_count == len(metrics)
+        assert bodies == [expected.encode('utf-8')] * 4
+        assert exposition.metrics is None
+
+    @pytest.mark.parametrize("openmetrics", [False, True])
+    def test_cached_metrics(self, prometheus_module, openmetrics):
+        m = prometheus_module
+        assert m.get_cached_metrics(openmetrics) is None
+        metric = Metric('counter', 'osd.op_r', 'Client read operations')
+        metric.set(1)
+        # served in the requested format from the first scrape on
+        m.collect_cache = Exposition(metric.str_expfmt(),
+                                     [(metric, metric.value)])
+        m.collect_time = time.time()
+        body = m.get_cached_metrics(openmetrics).decode('utf-8')
+        if openmetrics:
+            assert body.startswith('# HELP ceph_osd_op_r Client read operations'
+                                   '\n# TYPE ceph_osd_op_r counter'
+                                   '\nceph_osd_op_r_total 1.0\n')
+            assert body.endswith('\n# EOF\n')
+        else:
+            assert body.startswith('\n# HELP ceph_osd_op_r Client read operations'
+                                   '\n# TYPE ceph_osd_op_r counter'
+                                   '\nceph_osd_op_r 1.0\n')
+            assert '# EOF' not in body
+
+
+class TestNegotiateFormat(object):
+
+    @pytest.mark.parametrize("headers,expected", [
+        ({}, (False, False)),
+        ({'Accept-Encoding': 'gzip, deflate'}, (False, True)),
+        ({'Accept-Encoding': 'gzip;q=0'}, (False, False)),
+        ({'Accept': 'text/plain;version=0.0.4;q=1,*/*;q=0.1'},
+         (False, False)),
+        ({'Accept': 'application/openmetrics-text; version=0.0.1,'
+                    'text/plain;version=0.0.4;q=0.5,*/*;q=0.1',
+          'Accept-Encoding': 'gzip'}, (True, True)),
+        ({'Accept': 'text/plain,application/openmetrics-text;q=0.5'},
+         (False, False)),
+    ])
+    def test_negotiate(self, headers, expected):
+        request = cherrypy.serving.request
+        old_headers = request.headers
+        request.headers = HeaderMap(headers)
+        try:
+            assert negotiate_format() == expected
+        finally:
+            request.headers = old_headers
+
+
+    @pytest.mark.parametrize("openmetrics,content_type", [
+        (False, 'text/plain; version=0.0.4; charset=utf-8'),
+        (True, 'application/openmetrics-text; version=1.0.0; charset=utf-8'),
+    ])
+    def test_response_headers(self, openmetrics, content_type):
+        response = cherrypy.serving.response
+        old_headers = response.headers
+        response.headers = HeaderMap()
+        try:
+            set_response_headers(openmetrics, True)
+            assert response.headers['Content-Type'] == content_type
+            assert response.headers['Content-Encoding'] == 'gzip'
+        finally:
+            response.headers = old_headers
+
+
+class TestOSDIndex(object):
+
+    @staticmethod
+    def osd_map(epoch, up_from=5):
+        return {
+            'epoch': epoch,
+            'flags': 'sortbitwise',
+            'pools': [],
+            'osds': [{
+                'osd': id_, 'up': 1, 'in': 1, 'weight': 1.0,
+                'up_from': up_from,
+                'public_addr': '10.0.0.{}:6800/1'.format(id_),
+                'cluster_addr': '10.0.1.{}:6800/1'.format(id_),
+            } for id_ in range(3)],
+        }
+
+    @staticmethod
+    def mock_cluster(m, osd_map):
+        maps = {
+            'osd_map': osd_map,
+            'osd_map_crush': {'devices': [
+                {'id': 0, 'class': 'hdd'},
+                {'id': 1, 'class': 'ssd'},
+                {'id': 2, 'class': 'hdd'},
+            ]},
+        }
+        m.get = mock.MagicMock(side_effect=lambda what: maps[what])
+        m.get_metadata = mock.MagicMock(
+            side_effect=lambda svc_type, svc_id: {
+                'osd_objectstore': 'bluestore', 'hostname': 'host1',
+                'bluestore_bdev_dev_node': '/dev/sd' + svc_id})
+        m.list_servers = mock.MagicMock(return_value=[{
+            'hostname': 'host1', 'ceph_version': 'ceph version 15',
+            'services': [{'type': 'osd', 'id': str(i)} for i in range(3)]}])
+
+    def test_cached_between_collections(self, prometheus_module):
+        m = prometheus_module
+        self.mock_cluster(m, self.osd_map(10))
+        m.get_metadata_and_osd_status()
+        assert m.metrics['osd_metadata'].value[
+            ('', 'osd.1', '10.0.1.1', 'ssd', '', 'host1', 'bluestore',
+             '10.0.0.1', 'ceph version 15')] == 1
+        assert m.get_metadata.call_count == 3
+        assert m.list_servers.call_count == 1
+
+        m.metrics['osd_metadata'].clear()
+        m.get_metadata_and_osd_status()
+        assert len(m.metrics['osd_metadata'].value) == 3
+        assert m.get_metadata.call_count == 3
+        assert m.list_servers.call_count == 1
+        crush_gets = [c for c in m.get.call_args_list
+                      if c == mock.call('osd_map_crush')]
+        assert len(crush_gets) == 1
+
+    def test_invalidation(self, prometheus_module):
+        m = prometheus_module
+        self.mock_cluster(m, self.osd_map(10))
+        m.get_metadata_and_osd_status()
+
+        # restarted OSDs are looked up again
+        self.mock_cluster(m, self.osd_map(11, up_from=11))
+        m.get_metadata_and_osd_status()
+        assert m.get_metadata.call_count == 3
+        crush_gets = [c for c in m.get.call_args_list
+                      if c == mock.call('osd_map_crush')]
+        assert len(crush_gets) == 1
+        assert m.list_servers.call_count == 0
+
+        m.notify('service_map', '')
+        m.get_metadata_and_osd_status()
+        assert m.list_servers.call_count == 1
+
+
+class TestCollectors(object):
+
+    @staticmethod
+    def mock_collectors(m):
+        for name, method in COLLECTORS:
+            setattr(m, method, mock.MagicMock())
+        m.get_health.side_effect = \
+            lambda: m.metrics['health_status'].set(0)
+        m.get_pg_status.side_effect = \
+            lambda: m.metrics['pg_total'].set(128)
+
+        def rbd_stats():
+            if 'rbd_read_ops' not in m.metrics:
+                m.metrics['rbd_read_ops'] = Metric(
+                    'counter', 'rbd_read_ops', 'RBD image reads count',
+                    ('pool', 'namespace', 'image'))
+            m.metrics['rbd_read_ops'].set(
+                m.get_rbd_stats.call_count, ('rbd', '', 'img1'))
+            m.metrics['rbd_read_ops'].set(
+                m.get_rbd_stats.call_count, ('rbd', '', 'img2'))
+        m.get_rbd_stats.side_effect = rbd_stats
+
+    @staticmethod
+    def options(m, **options):
+        m.get_localized_module_option = mock.MagicMock(
+            side_effect=lambda key, default=None: options.get(key, default))
+
+    def test_collector_metrics(self, prometheus_module):
+        m = prometheus_module
+        self.mock_collectors(m)
+        self.options(m)
+        text = m.collect().bodies[False].decode('utf-8')
+        for name, method in COLLECTORS:
+            assert getattr(m, method).call_count == 1
+            assert 'ceph_mgr_prometheus_collector_duration_seconds' \
+                '{{collector="{}"}}'.format(name) in text
+        assert 'ceph_mgr_prometheus_collector_series' \
+            '{collector="rbd_stats"} 2.0' in text
+        assert 'ceph_mgr_prometheus_collector_series' \
+            '{collector="health"} 1.0' in text
+        assert 'ceph_mgr_prometheus_collector_series' \
+            '{collector="df"} 0.0' in text
+
+    def test_disabled_collectors(self, prometheus_module):
+        m = prometheus_module
+        self.mock_collectors(m)
+        self.options(m, disabled_collectors='rbd_stats, pg_status bogus')
+        text = m.collect().bodies[False].decode('utf-8')
+        assert m.get_rbd_stats.call_count == 0
+        assert m.get_pg_status.call_count == 0
+        assert m.get_health.call_count == 1
+        assert 'collector="rbd_stats"' not in text
+        assert 'ceph_pg_total 128.0' not in text
+
+    def test_collector_intervals(self, prometheus_module):
+        m = prometheus_module
+        self.mock_collectors(m)
+        self.options(m, collector_intervals='rbd_stats=3600')
+        m.collect()
+        data = m.collect()
+        text = data.bodies[False].decode('utf-8')
+        assert m.get_rbd_stats.call_count == 1
+        assert m.get_health.call_count == 2
+        # the series of the first run are still exported
+        assert 'ceph_rbd_read_ops{pool="rbd",namespace="",image="img1"} 1.0' \
+            in text
+        assert 'ceph_mgr_prometheus_collector_cache_hits' \
+            '{collector="rbd_stats"} 1.0' in text
+        assert 'ceph_mgr_prometheus_collector_cache_hits' \
+            '{collector="health"} 0.0' in text
+
+        m.collectors['rbd_stats']['last_run'] = 0
+        text = m.collect().bodies[False].decode('utf-8')
+        assert m.get_rbd_stats.call_count == 2
+        assert 'ceph_rbd_read_ops{pool="rbd",namespace="",image="img1"} 2.0' \
+            in text
+        # the OpenMetrics body of a collection has its values, even if
+        # rendered after the next one
+        assert list(data.bodies) == [False]
+        text = data.render(True, False, '').decode('utf-8')
+        assert 'ceph_rbd_read_ops_total{pool="rbd",namespace="",image="img1"} 1.0' \
+            in text
+        assert 'ceph_mgr_prometheus_collector_cache_hits_total' \
+            '{collector="rbd_stats"} 1.0' in text
@@ -1,20 +1,31 @@
 import errno
+import hashlib
+import heapq
+import itertools
 import json
 import rados
 import rbd
 import re
 import traceback
 
+from collections import deque
 from datetime import datetime, timedelta, time
 from threading import Condition, Lock, Thread
 
 from .common import get_rbd_pools
 
 SCHEDULE_OID = "rbd_mirror_snapshot_schedule"
+RBD_MIRRORING_OID = "rbd_mirroring"
+RBD_DIRECTORY_OID = "rbd_directory"
+MIRROR_IMAGE_KEY_PREFIX = "image_"
+MIRROR_IMAGE_MAP_KEY_PREFIX = "image_map_"
 
 SCHEDULE_INTERVAL = "interval"
 SCHEDULE_START_TIME = "start_time"
 
+# number of recent snapshot creations the due time lag is averaged over
+LAG_SAMPLES = 100
+
 
 class Interval:
 
@@ -281,6 +292,39 @@ class Schedule:
             raise ValueError("Invalid schedule format ({})".format(str(e)))
 
 
+class ImageListCache:
+    """
+    The snapshot mirrored images of a pool namespace, as last listed,
+    with the change signal they were listed at and discovery stats.
+    """
+
+    def __init__(self, pool_name, namespace):
+        self.pool_name = pool_name
+        self.namespace = namespace
+        self.signal = None
+        self.images = {}
+        self.listed = datetime(1970, 1, 1)
+        self.lists = 0
+        self.hits = 0
+        self.last_list_duration = 0.0
+        self.total_list_duration = 0.0
+
+    def is_fresh(self, signal, now, full_rescan_interval):
+        return self.signal is not None and self.signal == signal and \
+            now - self.listed < full_rescan_interval
+
+    def to_dict(self, now):
+        return {
+            'images': len(self.images),
+            'lists': self.lists,
+            'cache_hits': self.hits,
+            'last_list_duration': self.last_list_duration,
+            'total_list_duration': self.total_list_duration,
+            # seconds since the images were last listed
+            'staleness': (now - self.listed).total_seconds(),
+        }
+
+
 class MirrorSnapshotScheduleHandler:
     lock = Lock()
     condition = Condition(lock)
@@ -290,32 +334,138 @@ class MirrorSnapshotScheduleHandler:
         self.module = module
         self.log = module.log
         self.last_refresh_images = datetime(1970, 1, 1)
-
+        self.last_refresh_duration = 0.0
+        self.refresh_interval = timedelta(seconds=60)
+        self.full_rescan_interval = timedelta(hours=1)
+
+        # pool id -> namespace -> ImageListCache
+        self.image_lists = {}
+
+        # images dequeued for a snapshot, and those of them that are
+        # waiting for a worker
+        self.in_flight = set()
+        self.work_queue = deque()
+        self.workers = {}
+        self.max_concurrent_snapshot_creates = 1
+
+        self.snapshots_created = 0
+        self.snapshot_create_failures = 0
+        self.lags = deque(maxlen=LAG_SAMPLES)
+        self.max_lag = 0.0
+
+        self.config_notify()
         self.init_schedule_queue()
 
         self.thread = Thread(target=self.run)
         self.thread.start()
 
+    def config_notify(self):
+        with self.lock:
+            self.max_concurrent_snapshot_creates = max(1, int(
+                self.module.get_module_option(
+                    'max_concurrent_snapshot_creates')))
+            self.refresh_interval = timedelta(seconds=int(
+                self.module.get_module_option(
+                    'mirror_snapshot_schedule_refresh_interval')))
+            self.full_rescan_interval = timedelta(seconds=int(
+                self.module.get_module_option(
+                    'mirror_snapshot_schedule_full_rescan_interval')))
+            self.log.debug("max_concurrent_snapshot_creates={}, "
+                           "refresh_interval={}, full_rescan_interval={}".format(
+                               self.max_concurrent_snapshot_creates,
+                               self.refresh_interval,
+                               self.full_rescan_interval))
+
+            # surplus workers exit once they are woken up
+            for worker_id in range(self.max_concurrent_snapshot_creates):
+                if worker_id not in self.workers:
+                    thread = Thread(target=self.run_worker, args=(worker_id,))
+                    self.workers[worker_id] = thread
+                    thread.start()
+            self.condition.notify_all()
+
     def run(self):
         try:
             self.log.info("MirrorSnapshotScheduleHandler: starting")
             while True:
                 self.refresh_images()
                 with self.lock:
-                    (image_spec, wait_time) = self.dequeue()
-                    if not image_spec:
+                    wait_time = self.dispatch()
+                    if wait_time:
                         self.condition.wait(min(wait_time, 60))
+
+        except Exception as ex:
+            self.log.fatal("Fatal runtime error: {}\n{}".format(
+                ex, traceback.format_exc()))
+
+    def dispatch(self):
+        """
+        Hand the next due image over to the workers.
+
+        :return: the time (in seconds) to wait for an image to be due or
+            for a worker to be free, or 0 if there may be more to do
+        """
+        if len(self.in_flight) >= self.max_concurrent_snapshot_creates:
+            return 60
+        (image_spec, schedule_time, wait_time) = self.dequeue()
+        if not image_spec:
+            return wait_time
+        if image_spec in self.in_flight:
+            # it is re-queued when its current snapshot is done
+            return 0
+        lag = (datetime.now() - schedule_time).total_seconds()
+        self.lags.append(lag)
+        self.max_lag = max(self.max_lag, lag)
+        self.in_flight.add(image_spec)
+        self.work_queue.append(image_spec)
+        self.condition.notify_all()
+        return 0
+
+    def run_worker(self, worker_id):
+        try:
+            self.log.info(
+                "MirrorSnapshotScheduleHandler: starting worker {}".format(
+                    worker_id))
+            with self.lock:
+                while worker_id < self.max_concurrent_snapshot_creates:
+                    if not self.work_queue:
+                        self.condition.wait(60)
                         continue
-                pool_id, namespace, image_id = image_spec
-                self.create_snapshot(pool_id, namespace, image_id)
-                with self.lock:
-                    self.enqueue(datetime.now(), pool_id, namespace, image_id)
+                    image_spec = self.work_queue.popleft()
+                    pool_id, namespace, image_id = image_spec
+
+                    self.lock.release()
+                    try:
+                        created = self.create_snapshot(pool_id, namespace,
+                                                       image_id)
+                    finally:
+                        self.lock.acquire()
+
+                    if created:
+                        self.snapshots_created += 1
+                    elif created is not None:
+                        self.snapshot_create_failures += 1
+                    self.in_flight.discard(image_spec)
+                    if image_id in self.images.get(pool_id, {}).get(
+                            namespace, {}):
+                        self.enqueue(datetime.now(), pool_id, namespace,
+                                     image_id)
+                    self.condition.notify_all()
+
+                del self.workers[worker_id]
+                self.log.info(
+                    "MirrorSnapshotScheduleHandler: stopping worker {}".format(
+                        worker_id))
 
         except Exception as ex:
             self.log.fatal("Fatal runtime error: {}\n{}".format(
                 ex, traceback.format_exc()))
 
     def create_snapshot(self, pool_id, namespace, image_id):
+        """
+        :return: True if a snapshot was created, False if it failed, or
+            None if the image is not a primary snapshot mirrored image
+        """
         try:
             with self.module.rados.open_ioctx2(int(pool_id)) as ioctx:
                 ioctx.set_namespace(namespace)
@@ -332,10 +482,12 @@ class MirrorSnapshotScheduleHandler:
                         "create_snapshot: {}/{}/{}: snap_id={}".format(
                             ioctx.get_pool_name(), namespace, image.get_name(),
                             snap_id))
+                    return True
         except Exception as e:
             self.log.error(
                 "exception when creating snapshot for {}/{}/{}: {}".format(
                     pool_id, namespace, image_id, e))
+            return False
 
 
     @classmethod
@@ -348,7 +500,7 @@ class MirrorSnapshotScheduleHandler:
         return image
 
     def init_schedule_queue(self):
-        self.queue = {}
+        self.clear_queue()
         self.images = {}
         self.refresh_images()
         self.log.debug("scheduler queue is initialized")
@@ -425,66 +577,139 @@ class MirrorSnapshotScheduleHandler:
                 ioctx.operate_write_op(write_op, SCHEDULE_OID)
 
     def refresh_images(self):
-        if (datetime.now() - self.last_refresh_images).seconds < 60:
+        if datetime.now() - self.last_refresh_images < self.refresh_interval:
             return
 
         self.log.debug("MirrorSnapshotScheduleHandler: refresh_images")
+        start = datetime.now()
 
         self.load_schedules()
 
         with self.lock:
             if not self.schedules:
                 self.images = {}
-                self.queue = {}
+                self.clear_queue()
                 self.last_refresh_images = datetime.now()
                 return
 
         images = {}
+        image_lists = {}
 
         for pool_id, pool_name in get_rbd_pools(self.module).items():
             with self.module.rados.open_ioctx2(int(pool_id)) as ioctx:
-                self.load_pool_images(ioctx, images)
+                self.load_pool_images(ioctx, images, image_lists)
 
         with self.lock:
             self.refresh_queue(images)
             self.images = images
+            self.image_lists = image_lists
 
         self.last_refresh_images = datetime.now()
+        self.last_refresh_duration = \
+            (self.last_refresh_images - start).total_seconds()
+
+    def get_image_list_signal(self, ioctx):
+        # The version of the directory, updated whenever an image is
+        # created, renamed or removed, and a digest of the mirroring
+        # entries of the images, updated whenever an image has its
+        # mirroring enabled, disabled or its mode changed.  Not the
+        # version of the mirroring object: rbd-mirror keeps updating the
+        # mirroring status of the images there.
+        try:
+            ioctx.stat(RBD_DIRECTORY_OID)
+            directory_version = ioctx.get_last_version()
+        except rados.ObjectNotFound:
+            directory_version = None
+
+        digest = hashlib.sha1()
+        start_after = ''
+        try:
+            while True:
+                with rados.ReadOpCtx() as read_op:
+                    it, ret = ioctx.get_omap_vals(read_op, start_after,
+                                                  MIRROR_IMAGE_KEY_PREFIX, 1024)
+                    ioctx.operate_read_op(read_op, RBD_MIRRORING_OID)
+
+                    it = list(it)
+                    for k, v in it:
+                        start_after = k
+                        # the images mapped to the rbd-mirror instances
+                        if k.startswith(MIRROR_IMAGE_MAP_KEY_PREFIX):
+                            continue
+                        digest.update(k.encode())
+                        digest.update(v)
 
-    def load_pool_images(self, ioctx, images):
+                    if not it:
+                        break
+
+        except rados.ObjectNotFound:
+            # rbd_mirroring DNE
+            pass
+        return (directory_version, digest.hexdigest())
+
+    def load_pool_images(self, ioctx, images, image_lists):
         pool_id = str(ioctx.get_pool_id())
         pool_name = ioctx.get_pool_name()
         images[pool_id] = {}
+        image_lists[pool_id] = {}
+        cached_lists = self.image_lists.get(pool_id, {})
 
         try:
             namespaces = [''] + rbd.RBD().namespace_list(ioctx)
             for namespace in namespaces:
-                images[pool_id][namespace] = {}
                 ioctx.set_namespace(namespace)
-                mirror_images = dict(rbd.RBD().mirror_image_info_list(
-                    ioctx, rbd.RBD_MIRROR_IMAGE_MODE_SNAPSHOT))
-                if not mirror_images:
+                image_list = cached_lists.get(namespace) or \
+                    ImageListCache(pool_name, namespace)
+                image_lists[pool_id][namespace] = image_list
+
+                now = datetime.now()
+                signal = self.get_image_list_signal(ioctx)
+                if image_list.is_fresh(signal, now,
+                                       self.full_rescan_interval):
+                    image_list.hits += 1
+                    images[pool_id][namespace] = image_list.images
                     continue
-                image_names = dict(
-                    [(x['id'], x['name']) for x in filter(
-                        lambda x: x['id'] in mirror_images,
-                        rbd.RBD().list2(ioctx))])
-                for image_id in mirror_images:
-                    image_name = image_names.get(image_id)
-                    if not image_name:
-                        continue
-                    if namespace:
-                        name = "{}/{}/{}".format(pool_name, namespace,
-                                                 image_name)
-                    else:
-                        name = "{}/{}".format(pool_name, image_name)
-                    self.log.debug("Adding image {}".format(name))
-                    images[pool_id][namespace][image_id] = name
+
+                self.log.debug("listing images of {}/{}".format(pool_name,
+                                                               namespace))
+                image_list.images = self.list_namespace_images(
+                    ioctx, pool_name, namespace)
+                image_list.signal = signal
+                image_list.listed = now
+                image_list.lists += 1
+                image_list.last_list_duration = \
+                    (datetime.now() - now).total_seconds()
+                image_list.total_list_duration += \
+                    image_list.last_list_duration
+                images[pool_id][namespace] = image_list.images
         except Exception as e:
             self.log.error("exception when scanning pool {}: {}".format(
                 pool_name, e))
             pass
 
+    def list_namespace_images(self, ioctx, pool_name, namespace):
+        images = {}
+        mirror_images = dict(rbd.RBD().mirror_image_info_list(
+            ioctx, rbd.RBD_MIRROR_IMAGE_MODE_SNAPSHOT))
+        if not mirror_images:
+            return images
+        image_names = dict(
+            [(x['id'], x['name']) for x in filter(
+                lambda x: x['id'] in mirror_images,
+                rbd.RBD().list2(ioctx))])
+        for image_id in mirror_images:
+            image_name = image_names.get(image_id)
+            if not image_name:
+                continue
+            if namespace:
+                name = "{}/{}/{}".format(pool_name, namespace,
+                                         image_name)
+            else:
+                name = "{}/{}".format(pool_name, image_name)
+            self.log.debug("Adding image {}".format(name))
+            images[image_id] = name
+        return images
+
     def find_schedule(self, pool_id, namespace, image_id):
         levels = [None, pool_id, namespace, image_id]
         while levels:
@@ -505,18 +730,18 @@ class MirrorSnapshotScheduleHandler:
                 (int((now - start_time) / period) + 1) * period
             if schedule_time is None or time < schedule_time:
                 schedule_time = time
-        return datetime.strftime(schedule_time, "%Y-%m-%d %H:%M:00")
+        return schedule_time
 
     def rebuild_queue(self):
         with self.lock:
             now = datetime.now()
 
             # don't remove from queue "due" images
-            now_string = datetime.strftime(now, "%Y-%m-%d %H:%M:00")
+            now = now.replace(second=0, microsecond=0)
 
-            for schedule_time in list(self.queue):
-                if schedule_time > now_string:
-                    del self.queue[schedule_time]
+            for schedule_time, _, image_spec in list(self.queue_index.values()):
+                if schedule_time > now:
+                    self.remove_from_queue(*image_spec)
 
             if not self.schedules:
                 return
@@ -549,6 +774,16 @@ class MirrorSnapshotScheduleHandler:
 
         self.condition.notify()
 
+    def clear_queue(self):
+        # A heap of [schedule time, sequence, image spec] entries, and the
+        # entry of each queued image.  Removed entries are only marked,
+        # by clearing their image spec, and skipped once they reach the
+        # top of the heap.
+        self.queue = []
+        self.queue_index = {}
+        self.queue_removed = 0
+        self.queue_sequence = itertools.count()
+
     def enqueue(self, now, pool_id, namespace, image_id):
 
         schedule = self.find_schedule(pool_id, namespace, image_id)
@@ -556,42 +791,49 @@ class MirrorSnapshotScheduleHandler:
             return
 
         schedule_time = self.calc_schedule_time(schedule, now)
-        if schedule_time not in self.queue:
-            self.queue[schedule_time] = []
+        image_spec = (pool_id, namespace, image_id)
+        entry = self.queue_index.get(image_spec)
+        if entry:
+            if entry[0] <= schedule_time:
+                return
+            self.remove_from_queue(pool_id, namespace, image_id)
+
         self.log.debug("schedule image {}/{}/{} at {}".format(
             pool_id, namespace, image_id, schedule_time))
-        image_spec = (pool_id, namespace, image_id)
-        if image_spec not in self.queue[schedule_time]:
-            self.queue[schedule_time].append((pool_id, namespace, image_id))
+        entry = [schedule_time, next(self.queue_sequence), image_spec]
+        heapq.heappush(self.queue, entry)
+        self.queue_index[image_spec] = entry
 
     def dequeue(self):
+        while self.queue and self.queue[0][2] is None:
+            heapq.heappop(self.queue)
+            self.queue_removed -= 1
+
         if not self.queue:
-            return None, 1000
+            return None, None, 1000
 
         now = datetime.now()
-        schedule_time = sorted(self.queue)[0]
+        schedule_time = self.queue[0][0]
 
-        if datetime.strftime(now, "%Y-%m-%d %H:%M:%S") < schedule_time:
-            wait_time = (datetime.strptime(schedule_time,
-                                           "%Y-%m-%d %H:%M:%S") - now)
-            return None, wait_time.total_seconds()
+        if now < schedule_time:
+            wait_time = schedule_time - now
+            return None, None, wait_time.total_seconds()
 
-        images = self.queue[schedule_time]
-        image = images[0]
-        image = images.pop(0)
-        if not images:
-            del self.queue[schedule_time]
-        return image, 0
+        _, _, image_spec = heapq.heappop(self.queue)
+        del self.queue_index[image_spec]
+        return image_spec, schedule_time, 0
 
     def remove_from_queue(self, pool_id, namespace, image_id):
-        empty_slots = []
-        for schedule_time, images in self.queue.items():
-            if (pool_id, namespace, image_id) in images:
-                images.remove((pool_id, namespace, image_id))
-                if not images:
-                    empty_slots.append(schedule_time)
-        for schedule_time in empty_slots:
-            del self.queue[schedule_time]
+        entry = self.queue_index.pop((pool_id, namespace, image_id), None)
+        if not entry:
+            return
+
+        entry[2] = None
+        self.queue_removed += 1
+        if self.queue_removed > len(self.queue) // 2:
+            self.queue = [e for e in self.queue if e[2] is not None]
+            heapq.heapify(self.queue)
+            self.queue_removed = 0
 
     def save_schedule(self, level_spec, schedule):
         if level_spec.is_global():
@@ -696,14 +938,60 @@ class MirrorSnapshotScheduleHandler:
 
         result = ""
         with self.lock:
-            for schedule_time in sorted(self.queue):
-                for pool_id, namespace, image_id in self.queue[schedule_time]:
-                    if not level_spec.matches(pool_id, namespace, image_id):
-                        continue
-                    image_name = self.images[pool_id][namespace][image_id]
-                    result += "{} {}\n".format(schedule_time, image_name)
+            for schedule_time, _, image_spec in sorted(
+                    self.queue_index.values()):
+                pool_id, namespace, image_id = image_spec
+                if not level_spec.matches(pool_id, namespace, image_id):
+                    continue
+                image_name = self.images[pool_id][namespace][image_id]
+                result += "{} {}\n".format(
+                    datetime.strftime(schedule_time, "%Y-%m-%d %H:%M:00"),
+                    image_name)
         return 0, result, ""
 
+    def stats(self):
+        self.log.debug("stats")
+
+        with self.lock:
+            now = datetime.now()
+            next_entry = min(self.queue_index.values(), default=None)
+            lags = list(self.lags)
+            discovery = {}
+            for pool_id, image_lists in self.image_lists.items():
+                for namespace, image_list in image_lists.items():
+                    name = image_list.pool_name
+                    if namespace:
+                        name += "/" + namespace
+                    discovery[name] = image_list.to_dict(now)
+            result = {
+                'max_concurrent_snapshot_creates':
+                    self.max_concurrent_snapshot_creates,
+                'discovery': {
+                    'refresh_interval':
+                        self.refresh_interval.total_seconds(),
+                    'full_rescan_interval':
+                        self.full_rescan_interval.total_seconds(),
+                    'last_refresh': self.last_refresh_images.isoformat(),
+                    'last_refresh_duration': self.last_refresh_duration,
+                    'namespaces': discovery,
+                },
+                'scheduled_images': len(self.queue_index),
+                'due_images': sum(1 for e in self.queue_index.values()
+                                  if e[0] <= now),
+                'in_flight': len(self.in_flight),
+                'snapshots_created': self.snapshots_created,
+                'snapshot_create_failures': self.snapshot_create_failures,
+                'next_due': next_entry and next_entry[0].isoformat(),
+                # seconds between the time a snapshot was due and the
+                # time its creation was started
+                'due_time_lag': {
+                    'last': lags[-1] if lags else 0.0,
+                    'avg': sum(lags) / len(lags) if lags else 0.0,
+                    'max': self.max_lag,
+                },
+            }
+        return 0, json.dumps(result, indent=4, sort_keys=True), ""
+
     def handle_command(self, inbuf, prefix, cmd):
         if prefix == 'add':
             return self.add_schedule(cmd['level_spec'], cmd['interval'],
@@ -717,5 +1005,7 @@ class MirrorSnapshotScheduleHandler:
             return self.dump()
         elif prefix == 'status':
             return self.status(cmd.get('level_spec', None))
+        elif prefix == 'stats':
+            return self.stats()
 
         raise NotImplementedError(cmd['prefix'])
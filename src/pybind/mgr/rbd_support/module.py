@@ -50,6 +50,11 @@ class Module(MgrModule):
             "desc": "Show rbd mirror snapshot schedule status",
             "perm": "r"
         },
+        {
+            "cmd": "rbd mirror snapshot schedule stats",
+            "desc": "Show rbd mirror snapshot scheduler statistics",
+            "perm": "r"
+        },
         {
             "cmd": "rbd perf image stats "
                    "name=pool_spec,type=CephString,req=false "
@@ -117,10 +122,44 @@ class Module(MgrModule):
                    "name=task_id,type=CephString,req=false ",
             "desc": "List pending or running asynchronous tasks",
             "perm": "r"
+        },
+        {
+            "cmd": "rbd task stats",
+            "desc": "Show asynchronous task queue depth and throughput",
+            "perm": "r"
         }
     ]
     MODULE_OPTIONS = [
         {'name': 'mirror_snapshot_schedule'},
+        {'name': 'max_concurrent_snapshot_creates',
+         'type': 'int',
+         'default': 10,
+         'desc': 'maximum number of scheduled mirror snapshots to create '
+                 'concurrently',
+         'runtime': True},
+        {'name': 'mirror_snapshot_schedule_refresh_interval',
+         'type': 'secs',
+         'default': 60,
+         'desc': 'how frequently to check pools for changes to their '
+                 'snapshot mirrored images',
+         'runtime': True},
+        {'name': 'mirror_snapshot_schedule_full_rescan_interval',
+         'type': 'secs',
+         'default': 3600,
+         'desc': 'how frequently to list the snapshot mirrored images of '
+                 'pools that did not signal any change',
+         'runtime': True},
+        {'name': 'max_concurrent_tasks',
+         'type': 'int',
+         'default': 4,
+         'desc': 'maximum number of asynchronous tasks to execute concurrently',
+         'runtime': True},
+        {'name': 'max_concurrent_tasks_per_pool',
+         'type': 'int',
+         'default': 2,
+         'desc': 'maximum number of asynchronous tasks to execute '
+                 'concurrently against the images of a pool',
+         'runtime': True},
     ]
 
     mirror_snapshot_schedule = None
@@ -133,6 +172,12 @@ class Module(MgrModule):
         self.perf = PerfHandler(self)
         self.task = TaskHandler(self)
 
+    def config_notify(self):
+        if self.mirror_snapshot_schedule:
+            self.mirror_snapshot_schedule.config_notify()
+        if self.task:
+            self.task.config_notify()
+
     def handle_command(self, inbuf, cmd):
         prefix = cmd['prefix']
         try:
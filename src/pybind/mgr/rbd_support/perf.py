@@ -1,10 +1,13 @@
 import errno
+import heapq
 import json
+import operator
 import rados
 import rbd
 import time
 import traceback
 
+from array import array
 from datetime import datetime, timedelta
 from threading import Condition, Lock, Thread
 
@@ -14,8 +17,7 @@ from .common import (GLOBAL_POOL_KEY, authorize_request, extract_pool_key,
 QUERY_POOL_ID = "pool_id"
 QUERY_POOL_ID_MAP = "pool_id_map"
 QUERY_IDS = "query_ids"
-QUERY_SUM_POOL_COUNTERS = "pool_counters"
-QUERY_RAW_POOL_COUNTERS = "raw_pool_counters"
+QUERY_IMAGE_COUNTERS = "image_counters"
 QUERY_LAST_REQUEST = "last_request"
 
 OSD_PERF_QUERY_REGEX_MATCH_ALL = '^(.*)$'
@@ -29,6 +31,11 @@ OSD_PERF_QUERY_COUNTERS_INDICES = {
     OSD_PERF_QUERY_COUNTERS[i]: i for i in range(len(OSD_PERF_QUERY_COUNTERS))}
 
 OSD_PERF_QUERY_LATENCY_COUNTER_INDICES = [4, 5]
+OSD_PERF_QUERY_LATENCY_OPS_INDICES = {
+    OSD_PERF_QUERY_COUNTERS_INDICES['write_latency']:
+        OSD_PERF_QUERY_COUNTERS_INDICES['write_ops'],
+    OSD_PERF_QUERY_COUNTERS_INDICES['read_latency']:
+        OSD_PERF_QUERY_COUNTERS_INDICES['read_ops']}
 OSD_PERF_QUERY_MAX_RESULTS = 256
 
 POOL_REFRESH_INTERVAL = timedelta(minutes=5)
@@ -38,6 +45,119 @@ STATS_RATE_INTERVAL = timedelta(minutes=1)
 REPORT_MAX_RESULTS = 64
 
 
+class ImageCounters:
+    """
+    The perf counters of the images matched by a query: one row per
+    (pool id, namespace, image id) and one array per counter, holding
+    the values reported during the current stats period and their
+    running sums.
+
+    All images share the timestamps of the current and the previous
+    period.  The images that were not reported during a period have
+    zero current values, and those first reported during the current
+    period have no rate yet.
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.rows = {}
+        self.first_ts = array('q')
+        self.updated = bytearray()
+        self.current = [array('q') for _ in OSD_PERF_QUERY_COUNTERS]
+        self.sums = [array('q') for _ in OSD_PERF_QUERY_COUNTERS]
+        self.current_ts = 0
+        self.previous_ts = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def start_period(self, now_ts):
+        self.previous_ts = self.current_ts
+        self.current_ts = now_ts
+        zeros = bytes(len(self.keys) * self.first_ts.itemsize)
+        self.current = [array('q', zeros) for _ in OSD_PERF_QUERY_COUNTERS]
+        self.updated = bytearray(len(self.keys))
+
+    def update(self, key, values):
+        row = self.rows.get(key)
+        if row is None:
+            row = len(self.keys)
+            self.rows[key] = row
+            self.keys.append(key)
+            self.first_ts.append(self.current_ts)
+            self.updated.append(0)
+            for i in range(len(OSD_PERF_QUERY_COUNTERS)):
+                self.current[i].append(0)
+                self.sums[i].append(0)
+        elif self.updated[row]:
+            # only keep the first report of an image per period
+            return
+
+        self.updated[row] = 1
+        for i, value in enumerate(values):
+            self.current[i][row] = value
+
+    def end_period(self):
+        self.sums = [array('q', map(operator.add, sums, current))
+                     for sums, current in zip(self.sums, self.current)]
+
+    def remove(self, key):
+        row = self.rows.pop(key)
+        last = len(self.keys) - 1
+        if row != last:
+            # move the last row into the removed one
+            last_key = self.keys[last]
+            self.keys[row] = last_key
+            self.rows[last_key] = row
+            self.first_ts[row] = self.first_ts[last]
+            self.updated[row] = self.updated[last]
+            for column in self.current + self.sums:
+                column[row] = column[last]
+        self.keys.pop()
+        self.first_ts.pop()
+        self.updated.pop()
+        for column in self.current + self.sums:
+            column.pop()
+
+    def period(self):
+        # require two periods within a fixed time window
+        period = self.current_ts - self.previous_ts
+        if not self.previous_ts or period <= 0 or \
+                period > STATS_RATE_INTERVAL.total_seconds():
+            return None
+        return period
+
+    def rate(self, index, row):
+        period = self.period()
+        if period is None or self.first_ts[row] >= self.current_ts:
+            return 0
+
+        rate = float(self.current[index][row]) / period
+
+        # convert latencies from sum to average per op
+        ops_index = OSD_PERF_QUERY_LATENCY_OPS_INDICES.get(index)
+        if ops_index is not None:
+            rate /= max(1, self.rate(ops_index, row))
+        return rate
+
+    def rates(self, index):
+        period = self.period()
+        if period is None:
+            return [0] * len(self.keys)
+
+        rates = [float(value) / period for value in self.current[index]]
+
+        # convert latencies from sum to average per op
+        ops_index = OSD_PERF_QUERY_LATENCY_OPS_INDICES.get(index)
+        if ops_index is not None:
+            rates = [rate / max(1, ops)
+                     for rate, ops in zip(rates, self.rates(ops_index))]
+
+        current_ts = self.current_ts
+        return [rate if first_ts < current_ts else 0
+                for rate, first_ts in zip(rates, self.first_ts)]
+
+
 class PerfHandler:
     user_queries = {}
     image_cache = {}
@@ -115,7 +235,9 @@ class PerfHandler:
         pool_id_map = query[QUERY_POOL_ID_MAP]
 
         # collect and combine the raw counters from all sort orders
-        raw_pool_counters = query.setdefault(QUERY_RAW_POOL_COUNTERS, {})
+        image_counters = query.setdefault(QUERY_IMAGE_COUNTERS,
+                                          ImageCounters())
+        image_counters.start_period(now_ts)
         for query_id in query[QUERY_IDS]:
             res = self.module.get_osd_perf_counters(query_id)
             for counter in res['counters']:
@@ -139,49 +261,17 @@ class PerfHandler:
 
                 # copy the 'sum' counter values for each image (ignore count)
                 # if we haven't already processed it for this round
-                raw_namespaces = raw_pool_counters.setdefault(pool_id, {})
-                raw_images = raw_namespaces.setdefault(namespace, {})
-                raw_image = raw_images.setdefault(image_id, [None, None])
-
-                # save the last two perf counters for each image
-                if raw_image[0] and raw_image[0][0] < now_ts:
-                    raw_image[1] = raw_image[0]
-                    raw_image[0] = None
-                if not raw_image[0]:
-                    raw_image[0] = [now_ts, [int(x[0]) for x in counter['c']]]
+                image_counters.update((pool_id, namespace, image_id),
+                                      [int(x[0]) for x in counter['c']])
 
-        self.log.debug("merge_raw_osd_perf_counters: {}".format(raw_pool_counters))
-        return raw_pool_counters
+        self.log.debug("merge_raw_osd_perf_counters: {} images".format(
+            len(image_counters)))
+        return image_counters
 
-    def sum_osd_perf_counters(self, query, raw_pool_counters, now_ts):
+    def sum_osd_perf_counters(self, query, image_counters, now_ts):
         # update the cumulative counters for each image
-        sum_pool_counters = query.setdefault(QUERY_SUM_POOL_COUNTERS, {})
-        for pool_id, raw_namespaces in raw_pool_counters.items():
-            sum_namespaces = sum_pool_counters.setdefault(pool_id, {})
-            for namespace, raw_images in raw_namespaces.items():
-                sum_namespace = sum_namespaces.setdefault(namespace, {})
-                for image_id, raw_image in raw_images.items():
-                    # zero-out non-updated raw counters
-                    if not raw_image[0]:
-                        continue
-                    elif raw_image[0][0] < now_ts:
-                        raw_image[1] = raw_image[0]
-                        raw_image[0] = [now_ts, [0 for x in raw_image[1][1]]]
-                        continue
-
-                    counters = raw_image[0][1]
-
-                    # copy raw counters if this is a newly discovered image or
-                    # increment existing counters
-                    sum_image = sum_namespace.setdefault(image_id, None)
-                    if sum_image:
-                        for i in range(len(counters)):
-                            sum_image[i] += counters[i]
-                    else:
-                        sum_namespace[image_id] = [x for x in counters]
-
-        self.log.debug("sum_osd_perf_counters: {}".format(sum_pool_counters))
-        return sum_pool_counters
+        image_counters.end_period()
+        return image_counters
 
     def refresh_image_names(self, resolve_image_names):
         for pool_id, namespace in resolve_image_names:
@@ -191,27 +281,24 @@ class PerfHandler:
                 ioctx.set_namespace(namespace)
                 for image_meta in rbd.RBD().list2(ioctx):
                     images[image_meta['id']] = image_meta['name']
-            self.log.debug("resolve_image_names: {}={}".format(image_key, images))
+            self.log.debug("resolve_image_names: {}: {} images".format(
+                image_key, len(images)))
 
     def scrub_missing_images(self):
         for pool_key, query in self.user_queries.items():
-            raw_pool_counters = query.get(QUERY_RAW_POOL_COUNTERS, {})
-            sum_pool_counters = query.get(QUERY_SUM_POOL_COUNTERS, {})
-            for pool_id, sum_namespaces in sum_pool_counters.items():
-                raw_namespaces = raw_pool_counters.get(pool_id, {})
-                for namespace, sum_images in sum_namespaces.items():
-                    raw_images = raw_namespaces.get(namespace, {})
-
-                    image_key = (pool_id, namespace)
-                    image_names = self.image_name_cache.get(image_key, {})
-                    for image_id in list(sum_images.keys()):
-                        # scrub image counters if we failed to resolve image name
-                        if image_id not in image_names:
-                            self.log.debug("scrub_missing_images: dropping {}/{}".format(
-                                image_key, image_id))
-                            del sum_images[image_id]
-                            if image_id in raw_images:
-                                del raw_images[image_id]
+            image_counters = query.get(QUERY_IMAGE_COUNTERS)
+            if not image_counters:
+                continue
+
+            for key in list(image_counters.keys):
+                pool_id, namespace, image_id = key
+                image_names = self.image_name_cache.get((pool_id, namespace),
+                                                        {})
+                # scrub image counters if we failed to resolve image name
+                if image_id not in image_names:
+                    self.log.debug("scrub_missing_images: dropping {}/{}".format(
+                        (pool_id, namespace), image_id))
+                    image_counters.remove(key)
 
     def process_raw_osd_perf_counters(self):
         now = datetime.now()
@@ -228,9 +315,9 @@ class PerfHandler:
             if not query[QUERY_IDS]:
                 continue
 
-            raw_pool_counters = self.merge_raw_osd_perf_counters(
+            image_counters = self.merge_raw_osd_perf_counters(
                 pool_key, query, now_ts, resolve_image_names)
-            self.sum_osd_perf_counters(query, raw_pool_counters, now_ts)
+            self.sum_osd_perf_counters(query, image_counters, now_ts)
 
         if resolve_image_names:
             self.image_name_refresh_time = now
@@ -319,93 +406,48 @@ class PerfHandler:
 
         return user_query
 
-    def extract_stat(self, index, raw_image, sum_image):
-        # require two raw counters between a fixed time window
-        if not raw_image or not raw_image[0] or not raw_image[1]:
-            return 0
-
-        current_time = raw_image[0][0]
-        previous_time = raw_image[1][0]
-        if current_time <= previous_time or \
-                current_time - previous_time > STATS_RATE_INTERVAL.total_seconds():
-            return 0
-
-        current_value = raw_image[0][1][index]
-        instant_rate = float(current_value) / (current_time - previous_time)
-
-        # convert latencies from sum to average per op
-        ops_index = None
-        if OSD_PERF_QUERY_COUNTERS[index] == 'write_latency':
-            ops_index = OSD_PERF_QUERY_COUNTERS_INDICES['write_ops']
-        elif OSD_PERF_QUERY_COUNTERS[index] == 'read_latency':
-            ops_index = OSD_PERF_QUERY_COUNTERS_INDICES['read_ops']
-
-        if ops_index is not None:
-            ops = max(1, self.extract_stat(ops_index, raw_image, sum_image))
-            instant_rate /= ops
-
-        return instant_rate
+    def extract_stat(self, index, image_counters, row):
+        return image_counters.rate(index, row)
 
-    def extract_counter(self, index, raw_image, sum_image):
-        if sum_image:
-            return sum_image[index]
-        return 0
+    def extract_counter(self, index, image_counters, row):
+        return image_counters.sums[index][row]
 
     def generate_report(self, query, sort_by, extract_data):
         pool_id_map = query[QUERY_POOL_ID_MAP]
-        sum_pool_counters = query.setdefault(QUERY_SUM_POOL_COUNTERS, {})
-        raw_pool_counters = query.setdefault(QUERY_RAW_POOL_COUNTERS, {})
+        image_counters = query.setdefault(QUERY_IMAGE_COUNTERS,
+                                          ImageCounters())
 
         sort_by_index = OSD_PERF_QUERY_COUNTERS.index(sort_by)
 
-        # pre-sort and limit the response
-        results = []
-        for pool_id, sum_namespaces in sum_pool_counters.items():
-            if pool_id not in pool_id_map:
-                continue
-            raw_namespaces = raw_pool_counters.get(pool_id, {})
-            for namespace, sum_images in sum_namespaces.items():
-                raw_images = raw_namespaces.get(namespace, {})
-                for image_id, sum_image in sum_images.items():
-                    raw_image = raw_images.get(image_id, [])
-
-                    # always sort by recent IO activity
-                    results.append([(pool_id, namespace, image_id),
-                                    self.extract_stat(sort_by_index, raw_image,
-                                                      sum_image)])
-        results = sorted(results, key=lambda x: x[1], reverse=True)[:REPORT_MAX_RESULTS]
+        # pre-sort and limit the response, always by recent IO activity
+        keys = image_counters.keys
+        rates = image_counters.rates(sort_by_index)
+        rows = heapq.nlargest(
+            REPORT_MAX_RESULTS,
+            (row for row in range(len(keys)) if keys[row][0] in pool_id_map),
+            key=rates.__getitem__)
 
         # build the report in sorted order
         pool_descriptors = {}
         counters = []
-        for key, _ in results:
-            pool_id = key[0]
+        for row in rows:
+            pool_id, namespace, image_id = keys[row]
             pool_name = pool_id_map[pool_id]
 
-            namespace = key[1]
-            image_id = key[2]
             image_names = self.image_name_cache.get((pool_id, namespace), {})
             image_name = image_names[image_id]
 
-            raw_namespaces = raw_pool_counters.get(pool_id, {})
-            raw_images = raw_namespaces.get(namespace, {})
-            raw_image = raw_images.get(image_id, [])
-
-            sum_namespaces = sum_pool_counters[pool_id]
-            sum_images = sum_namespaces[namespace]
-            sum_image = sum_images.get(image_id, [])
-
             pool_descriptor = pool_name
             if namespace:
                 pool_descriptor += "/{}".format(namespace)
             pool_index = pool_descriptors.setdefault(pool_descriptor,
                                                      len(pool_descriptors))
             image_descriptor = "{}/{}".format(pool_index, image_name)
-            data = [extract_data(i, raw_image, sum_image)
+            data = [extract_data(i, image_counters, row)
                     for i in range(len(OSD_PERF_QUERY_COUNTERS))]
 
             # skip if no data to report
-            if data == [0 for i in range(len(OSD_PERF_QUERY_COUNTERS))]:
+            if not any(data):
                 continue
 
             counters.append({image_descriptor: data})
@@ -1,4 +1,5 @@
 import errno
+import heapq
 import json
 import rados
 import rbd
@@ -6,9 +7,10 @@ import re
 import traceback
 import uuid
 
+from collections import deque
 from contextlib import contextmanager
 from datetime import datetime, timedelta
-from functools import partial, wraps
+from functools import partial
 from threading import Condition, Lock, Thread
 
 from .common import (authorize_request, extract_pool_key, get_rbd_pools,
@@ -25,6 +27,7 @@ TASK_RETRY_TIME = "retry_time"
 TASK_IN_PROGRESS = "in_progress"
 TASK_PROGRESS = "progress"
 TASK_CANCELED = "canceled"
+TASK_PARENT = "parent"
 
 TASK_REF_POOL_NAME = "pool_name"
 TASK_REF_POOL_NAMESPACE = "pool_namespace"
@@ -47,35 +50,24 @@ VALID_TASK_ACTIONS = [TASK_REF_ACTION_FLATTEN,
                       TASK_REF_ACTION_MIGRATION_ABORT]
 
 TASK_RETRY_INTERVAL = timedelta(seconds=30)
+TASK_PROGRESS_INTERVAL = timedelta(seconds=1)
+TASK_THROUGHPUT_WINDOW = timedelta(minutes=5)
 MAX_COMPLETED_TASKS = 50
 
 
-class Throttle:
-    def __init__(self, throttle_period):
-        self.throttle_period = throttle_period
-        self.time_of_last_call = datetime.min
-
-    def __call__(self, fn):
-        @wraps(fn)
-        def wrapper(*args, **kwargs):
-            now = datetime.now()
-            if self.time_of_last_call + self.throttle_period <= now:
-                self.time_of_last_call = now
-                return fn(*args, **kwargs)
-        return wrapper
-
-
 class Task:
-    def __init__(self, sequence, task_id, message, refs):
+    def __init__(self, sequence, task_id, message, refs, parent=None):
         self.sequence = sequence
         self.task_id = task_id
         self.message = message
         self.refs = refs
+        self.parent = parent
         self.retry_time = None
         self.in_progress = False
         self.progress = 0.0
         self.canceled = False
         self.failed = False
+        self.progress_update_time = datetime.min
 
     def __str__(self):
         return self.to_json()
@@ -84,6 +76,22 @@ class Task:
     def sequence_key(self):
         return "{0:016X}".format(self.sequence)
 
+    @property
+    def image_key(self):
+        return (self.refs[TASK_REF_POOL_NAME],
+                self.refs[TASK_REF_POOL_NAMESPACE],
+                self.refs.get(TASK_REF_IMAGE_ID,
+                              self.refs.get(TASK_REF_IMAGE_NAME)))
+
+    @property
+    def image_keys(self):
+        # a flatten runs in order with the tasks of the parent image, too
+        if not self.parent:
+            return [self.image_key]
+        return [self.image_key, (self.parent[TASK_REF_POOL_NAME],
+                                 self.parent[TASK_REF_POOL_NAMESPACE],
+                                 self.parent[TASK_REF_IMAGE_ID])]
+
     def cancel(self):
         self.canceled = True
         self.fail("Operation canceled")
@@ -105,6 +113,8 @@ class Task:
             d[TASK_PROGRESS] = self.progress
         if self.canceled:
             d[TASK_CANCELED] = True
+        if self.parent:
+            d[TASK_PARENT] = self.parent
         return d
 
     def to_json(self):
@@ -118,7 +128,8 @@ class Task:
             if action not in VALID_TASK_ACTIONS:
                 raise ValueError("Invalid task action: {}".format(action))
 
-            return Task(d[TASK_SEQUENCE], d[TASK_ID], d[TASK_MESSAGE], d[TASK_REFS])
+            return Task(d[TASK_SEQUENCE], d[TASK_ID], d[TASK_MESSAGE], d[TASK_REFS],
+                        d.get(TASK_PARENT))
         except json.JSONDecodeError as e:
             raise ValueError("Invalid JSON ({})".format(str(e)))
         except KeyError as e:
@@ -128,9 +139,7 @@ class Task:
 class TaskHandler:
     lock = Lock()
     condition = Condition(lock)
-    thread = None
 
-    in_progress_task = None
     tasks_by_sequence = dict()
     tasks_by_id = dict()
 
@@ -142,11 +151,50 @@ class TaskHandler:
         self.module = module
         self.log = module.log
 
+        # The pending tasks of each image, in sequence order.  A task
+        # is only queued once it is the first task of its image (and of
+        # the parent image it flattens), so that the tasks of an image
+        # run one at a time and in order: by sequence in the ready
+        # queue of its pool, or by retry time in the retry queue until
+        # it may be retried.
+        self.tasks_by_image = {}
+        self.ready_queues = {}
+        self.retry_queue = []
+
+        self.in_progress_by_pool = {}
+        self.workers = {}
+        self.max_concurrent_tasks = 1
+        self.max_concurrent_tasks_per_pool = 1
+
+        self.completed_count = 0
+        self.failed_count = 0
+        self.canceled_count = 0
+        self.retried_count = 0
+        self.completed_times = deque()
+
         with self.lock:
             self.init_task_queue()
 
-        self.thread = Thread(target=self.run)
-        self.thread.start()
+        self.config_notify()
+
+    def config_notify(self):
+        with self.lock:
+            self.max_concurrent_tasks = max(1, int(
+                self.module.get_module_option('max_concurrent_tasks')))
+            self.max_concurrent_tasks_per_pool = max(1, int(
+                self.module.get_module_option('max_concurrent_tasks_per_pool')))
+            self.log.debug("max_concurrent_tasks={}, "
+                           "max_concurrent_tasks_per_pool={}".format(
+                               self.max_concurrent_tasks,
+                               self.max_concurrent_tasks_per_pool))
+
+            # surplus workers exit once they are woken up
+            for worker_id in range(self.max_concurrent_tasks):
+                if worker_id not in self.workers:
+                    thread = Thread(target=self.run, args=(worker_id,))
+                    self.workers[worker_id] = thread
+                    thread.start()
+            self.condition.notify_all()
 
     @property
     def default_pool_name(self):
@@ -166,24 +214,71 @@ class TaskHandler:
         return (match.group(1) or self.default_pool_name, match.group(2) or '',
                 match.group(3))
 
-    def run(self):
+    def run(self, worker_id):
         try:
-            self.log.info("TaskHandler: starting")
-            while True:
-                with self.lock:
-                    now = datetime.now()
-                    for sequence in sorted([sequence for sequence, task
-                                            in self.tasks_by_sequence.items()
-                                            if not task.retry_time or task.retry_time <= now]):
-                        self.execute_task(sequence)
-
-                    self.condition.wait(5)
+            self.log.info("TaskHandler: starting worker {}".format(worker_id))
+            with self.lock:
+                while worker_id < self.max_concurrent_tasks:
+                    task = self.dequeue_task()
+                    if task:
+                        self.execute_task(task)
+                        continue
+
+                    self.condition.wait(self.retry_wait())
                     self.log.debug("TaskHandler: tick")
 
+                del self.workers[worker_id]
+                self.log.info("TaskHandler: stopping worker {}".format(
+                    worker_id))
+
         except Exception as ex:
             self.log.fatal("Fatal runtime error: {}\n{}".format(
                 ex, traceback.format_exc()))
 
+    def enqueue_task(self, task):
+        if task.retry_time and task.retry_time > datetime.now():
+            heapq.heappush(self.retry_queue, (task.retry_time, task.sequence))
+        else:
+            heapq.heappush(self.ready_queues.setdefault(
+                task.refs[TASK_REF_POOL_NAME], []), task.sequence)
+
+    def dequeue_task(self):
+        now = datetime.now()
+        while self.retry_queue and self.retry_queue[0][0] <= now:
+            _, sequence = heapq.heappop(self.retry_queue)
+            task = self.tasks_by_sequence.get(sequence)
+            if task:
+                heapq.heappush(self.ready_queues.setdefault(
+                    task.refs[TASK_REF_POOL_NAME], []), sequence)
+
+        # the ready task with the lowest sequence of the pools that
+        # have not reached their concurrency limit
+        next_pool_name = None
+        for pool_name, queue in list(self.ready_queues.items()):
+            # drop removed (e.g. canceled) tasks
+            while queue and queue[0] not in self.tasks_by_sequence:
+                heapq.heappop(queue)
+            if not queue:
+                del self.ready_queues[pool_name]
+                continue
+            if self.in_progress_by_pool.get(pool_name, 0) >= \
+                    self.max_concurrent_tasks_per_pool:
+                continue
+            if next_pool_name is None or \
+                    queue[0] < self.ready_queues[next_pool_name][0]:
+                next_pool_name = pool_name
+
+        if next_pool_name is None:
+            return None
+        return self.tasks_by_sequence[
+            heapq.heappop(self.ready_queues[next_pool_name])]
+
+    def retry_wait(self):
+        if self.retry_queue:
+            wait = (self.retry_queue[0][0] - datetime.now()).total_seconds()
+            return min(max(wait, 0), 5)
+        return 5
+
     @contextmanager
     def open_ioctx(self, spec):
         try:
@@ -264,10 +359,19 @@ class TaskHandler:
             # rbd_task DNE
             pass
 
+    def is_next_task(self, task):
+        return all(self.tasks_by_image[image_key][0] is task
+                   for image_key in task.image_keys)
+
     def append_task(self, task):
         self.tasks_by_sequence[task.sequence] = task
         self.tasks_by_id[task.task_id] = task
 
+        for image_key in task.image_keys:
+            self.tasks_by_image.setdefault(image_key, deque()).append(task)
+        if self.is_next_task(task):
+            self.enqueue_task(task)
+
     def task_refs_match(self, task_refs, refs):
         if TASK_REF_IMAGE_ID not in refs and TASK_REF_IMAGE_ID in task_refs:
             task_refs = task_refs.copy()
@@ -290,7 +394,7 @@ class TaskHandler:
             if self.task_refs_match(task.refs, refs):
                 return task
 
-    def add_task(self, ioctx, message, refs):
+    def add_task(self, ioctx, message, refs, parent=None):
         self.log.debug("add_task: message={}, refs={}".format(message, refs))
 
         # ensure unique uuid across all pools
@@ -300,7 +404,7 @@ class TaskHandler:
                 break
 
         self.sequence += 1
-        task = Task(self.sequence, task_id, message, refs)
+        task = Task(self.sequence, task_id, message, refs, parent)
 
         # add the task to the rbd_task omap
         task_json = task.to_json()
@@ -338,13 +442,34 @@ class TaskHandler:
                     self.completed_tasks.append(task)
                     self.completed_tasks = self.completed_tasks[-MAX_COMPLETED_TASKS:]
 
-            except KeyError:
-                pass
+                    self.completed_count += 1
+                    self.completed_times.append(datetime.now())
+                elif task.canceled:
+                    self.canceled_count += 1
+                else:
+                    self.failed_count += 1
 
-    def execute_task(self, sequence):
-        task = self.tasks_by_sequence[sequence]
+            except KeyError:
+                return
+
+            # queue the next tasks of the images
+            for image_key in task.image_keys:
+                image_tasks = self.tasks_by_image[image_key]
+                was_next = image_tasks[0] is task
+                image_tasks.remove(task)
+                if not image_tasks:
+                    del self.tasks_by_image[image_key]
+                elif was_next and self.is_next_task(image_tasks[0]):
+                    self.enqueue_task(image_tasks[0])
+                    self.condition.notify()
+
+    def execute_task(self, task):
         self.log.info("execute_task: task={}".format(str(task)))
 
+        pool_name = task.refs[TASK_REF_POOL_NAME]
+        self.in_progress_by_pool[pool_name] = \
+            self.in_progress_by_pool.get(pool_name, 0) + 1
+
         pool_valid = False
         try:
             with self.open_ioctx((task.refs[TASK_REF_POOL_NAME],
@@ -363,7 +488,6 @@ class TaskHandler:
                     self.log.error("Invalid task action: {}".format(action))
                 else:
                     task.in_progress = True
-                    self.in_progress_task = task
                     self.update_progress(task, 0)
 
                     self.lock.release()
@@ -378,7 +502,6 @@ class TaskHandler:
                         self.lock.acquire()
 
                         task.in_progress = False
-                        self.in_progress_task = None
 
                     self.complete_progress(task)
                     self.remove_task(ioctx, task)
@@ -400,6 +523,14 @@ class TaskHandler:
             task.in_progress = False
             task.retry_time = datetime.now() + TASK_RETRY_INTERVAL
 
+            self.in_progress_by_pool[pool_name] -= 1
+            if not self.in_progress_by_pool[pool_name]:
+                del self.in_progress_by_pool[pool_name]
+
+            if task.sequence in self.tasks_by_sequence:
+                self.retried_count += 1
+                self.enqueue_task(task)
+
     def progress_callback(self, task, current, total):
         progress = float(current) / float(total)
         self.log.debug("progress_callback: task={}, progress={}".format(
@@ -410,9 +541,9 @@ class TaskHandler:
             return 0
 
         try:
-            if not self.in_progress_task or self.in_progress_task.canceled:
+            if not task.in_progress or task.canceled:
                 return -rbd.ECANCELED
-            self.in_progress_task.progress = progress
+            task.progress = progress
         finally:
             self.lock.release()
 
@@ -515,9 +646,11 @@ class TaskHandler:
             # progress module is disabled
             pass
 
-    @Throttle(timedelta(seconds=1))
     def throttled_update_progress(self, task, progress):
-        self.update_progress(task, progress)
+        now = datetime.now()
+        if task.progress_update_time + TASK_PROGRESS_INTERVAL <= now:
+            task.progress_update_time = now
+            self.update_progress(task, progress)
 
     def queue_flatten(self, image_spec):
         image_spec = self.extract_image_spec(image_spec)
@@ -537,6 +670,7 @@ class TaskHandler:
 
                     try:
                         parent_image_id = image.parent_id()
+                        parent_spec = image.get_parent_image_spec()
                     except rbd.ImageNotFound:
                         parent_image_id = None
 
@@ -554,10 +688,13 @@ class TaskHandler:
                 raise rbd.ImageNotFound("Image {} does not have a parent".format(
                     self.format_image_spec(image_spec)), errno=errno.ENOENT)
 
+            parent = {TASK_REF_POOL_NAME: parent_spec['pool_name'],
+                      TASK_REF_POOL_NAMESPACE: parent_spec['pool_namespace'],
+                      TASK_REF_IMAGE_ID: parent_image_id}
             return 0, self.add_task(ioctx,
                                     "Flattening image {}".format(
                                         self.format_image_spec(image_spec)),
-                                    refs), ""
+                                    refs, parent), ""
 
     def queue_remove(self, image_spec):
         image_spec = self.extract_image_spec(image_spec)
@@ -742,8 +879,8 @@ class TaskHandler:
         task.cancel()
 
         remove_in_memory = True
-        if self.in_progress_task and self.in_progress_task.task_id == task_id:
-            self.log.info("Attempting to cancel in-progress task: {}".format(str(self.in_progress_task)))
+        if task.in_progress:
+            self.log.info("Attempting to cancel in-progress task: {}".format(str(task)))
             remove_in_memory = False
 
         # complete any associated event in the progress module
@@ -778,6 +915,53 @@ class TaskHandler:
 
         return 0, json.dumps(result, indent=4, sort_keys=True), ""
 
+    def task_stats(self):
+        self.log.info("task_stats")
+
+        now = datetime.now()
+        ready = 0
+        waiting_retry = 0
+        waiting_image = 0
+        in_progress = 0
+        for task in self.tasks_by_sequence.values():
+            if task.in_progress:
+                in_progress += 1
+            elif not self.is_next_task(task):
+                waiting_image += 1
+            elif task.retry_time and task.retry_time > now:
+                waiting_retry += 1
+            else:
+                ready += 1
+
+        while self.completed_times and \
+                self.completed_times[0] + TASK_THROUGHPUT_WINDOW < now:
+            self.completed_times.popleft()
+        window = TASK_THROUGHPUT_WINDOW.total_seconds()
+
+        result = {
+            "max_concurrent_tasks": self.max_concurrent_tasks,
+            "max_concurrent_tasks_per_pool": self.max_concurrent_tasks_per_pool,
+            "queue_depth": {
+                "pending": len(self.tasks_by_sequence),
+                "ready": ready,
+                "waiting_retry": waiting_retry,
+                # queued behind an earlier task of the same image
+                "waiting_image": waiting_image,
+                "in_progress": in_progress,
+                "in_progress_by_pool": self.in_progress_by_pool,
+            },
+            "completed": self.completed_count,
+            "failed": self.failed_count,
+            "canceled": self.canceled_count,
+            "retried": self.retried_count,
+            "throughput": {
+                "window": int(window),
+                "completed": len(self.completed_times),
+                "tasks_per_second": len(self.completed_times) / window,
+            },
+        }
+        return 0, json.dumps(result, indent=4, sort_keys=True), ""
+
     def handle_command(self, inbuf, prefix, cmd):
         with self.lock:
             if prefix == 'add flatten':
@@ -796,5 +980,7 @@ class TaskHandler:
                 return self.task_cancel(cmd['task_id'])
             elif prefix == 'list':
                 return self.task_list(cmd.get('task_id'))
+            elif prefix == 'stats':
+                return self.task_stats()
 
         raise NotImplementedError(cmd['prefix'])
@@ -0,0 +1,416 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from tests import mock
+
+import rados
+import rbd
+
+from ..mirror_snapshot_schedule import (ImageListCache, Interval,
+                                        MirrorSnapshotScheduleHandler,
+                                        Schedule, StartTime)
+
+
+class Clock(datetime):
+    """
+    datetime, with now() returning a time the tests set.
+    """
+    current = None
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.current
+
+    @classmethod
+    def set(cls, hour, minute):
+        cls.current = datetime(2020, 1, 1, hour, minute)
+
+
+@pytest.fixture
+def clock():
+    Clock.set(10, 30)
+    with mock.patch('rbd_support.mirror_snapshot_schedule.datetime', Clock):
+        yield Clock
+
+
+def make_module(max_concurrent_snapshot_creates=2):
+    module = mock.Mock()
+    module.get.return_value = {'pools': []}
+    module.get_localized_module_option.return_value = ''
+    module.options = {
+        'max_concurrent_snapshot_creates': max_concurrent_snapshot_creates,
+        'mirror_snapshot_schedule_refresh_interval': 60,
+        'mirror_snapshot_schedule_full_rescan_interval': 3600,
+    }
+    module.get_module_option.side_effect = lambda name: module.options[name]
+    return module
+
+
+def worker_thread(target, args=()):
+    # only the workers run, the tests drive the scheduler
+    if target.__name__ == 'run_worker':
+        return threading.Thread(target=target, args=args)
+    return mock.Mock()
+
+
+def no_thread(target, args=()):
+    return mock.Mock()
+
+
+def schedule(*items):
+    schedule = Schedule('')
+    for interval, start_time in items:
+        schedule.add(Interval.from_string(interval), StartTime.from_string(start_time))
+    return schedule
+
+
+def make_handler(module, thread=worker_thread):
+    with mock.patch('rbd_support.mirror_snapshot_schedule.Thread', side_effect=thread):
+        handler = MirrorSnapshotScheduleHandler(module)
+    handler.schedules = {'': schedule(('1h', None)),
+                         '1//b': schedule(('15m', None))}
+    handler.images = {'1': {'': {'a': 'rbd/a', 'b': 'rbd/b', 'c': 'rbd/c'}}}
+    return handler
+
+
+def stop(handler):
+    with handler.lock:
+        workers = list(handler.workers.values())
+        handler.max_concurrent_snapshot_creates = 0
+        handler.condition.notify_all()
+    for thread in workers:
+        thread.join(10)
+
+
+@pytest.fixture
+def handler():
+    # no workers: the tests dispatch the images
+    return make_handler(make_module(max_concurrent_snapshot_creates=1), no_thread)
+
+
+def enqueue(handler, *image_ids):
+    for image_id in image_ids:
+        handler.enqueue(Clock.now(), '1', '', image_id)
+
+
+def dispatch(handler):
+    with handler.lock:
+        return handler.dispatch()
+
+
+def dequeue_all(handler):
+    image_ids = []
+    while True:
+        image_spec, _, _ = handler.dequeue()
+        if not image_spec:
+            return image_ids
+        image_ids.append(image_spec[2])
+
+
+def wait_for(condition):
+    for _ in range(100):
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+class TestSchedule(object):
+
+    @pytest.mark.parametrize('items,now,schedule_time', [
+        ([('1h', None)], (10, 30), (1, 11, 0)),
+        # strictly after now
+        ([('1h', None)], (11, 0), (1, 12, 0)),
+        ([('1h', '00:15')], (10, 30), (1, 11, 15)),
+        ([('1d', '02:00')], (10, 30), (2, 2, 0)),
+        # the earliest of the items
+        ([('1h', '00:45'), ('30m', None)], (10, 35), (1, 10, 45)),
+    ])
+    def test_calc_schedule_time(self, handler, items, now, schedule_time):
+        assert handler.calc_schedule_time(schedule(*items), datetime(2020, 1, 1, *now)) == \
+            datetime(2020, 1, *schedule_time)
+
+
+class TestQueue(object):
+
+    def test_dequeue_in_schedule_order(self, handler, clock):
+        enqueue(handler, 'a', 'b', 'c')
+        assert handler.dequeue() == (None, None, 15 * 60)
+
+        clock.set(10, 45)
+        assert handler.dequeue() == (('1', '', 'b'), datetime(2020, 1, 1, 10, 45), 0)
+        assert handler.dequeue() == (None, None, 15 * 60)
+
+        # in the order they were queued, if due at the same time
+        clock.set(11, 5)
+        assert dequeue_all(handler) == ['a', 'c']
+        assert handler.dequeue() == (None, None, 1000)
+        assert handler.queue_index == {}
+
+    def test_enqueue_keeps_earliest_time(self, handler, clock):
+        enqueue(handler, 'a')
+        clock.set(11, 10)
+        enqueue(handler, 'a')
+        assert len(handler.queue) == 1
+        assert handler.queue_index[('1', '', 'a')][0] == datetime(2020, 1, 1, 11, 0)
+
+        # a schedule due earlier replaces the queued one
+        clock.set(10, 30)
+        handler.schedules['1//a'] = schedule(('15m', None))
+        enqueue(handler, 'a')
+        assert handler.queue_index[('1', '', 'a')][0] == datetime(2020, 1, 1, 10, 45)
+        clock.set(11, 0)
+        assert dequeue_all(handler) == ['a']
+        assert handler.queue == []
+
+    def test_remove_and_requeue(self, handler, clock):
+        enqueue(handler, 'a', 'c')
+        handler.remove_from_queue('1', '', 'a')
+        handler.remove_from_queue('1', '', 'a')
+        # only marked removed, while in the heap
+        assert len(handler.queue) == 2
+        assert handler.queue_removed == 1
+        enqueue(handler, 'a')
+
+        clock.set(11, 0)
+        assert dequeue_all(handler) == ['c', 'a']
+        assert handler.queue == []
+        assert handler.queue_removed == 0
+
+    def test_compact_removed(self, handler, clock):
+        handler.schedules = {'': schedule(('1h', None))}
+        handler.images['1'][''].update({'d': 'rbd/d'})
+        enqueue(handler, 'a', 'b', 'c', 'd')
+        for image_id in 'abc':
+            handler.remove_from_queue('1', '', image_id)
+        assert [e[2] for e in handler.queue] == [('1', '', 'd')]
+        assert handler.queue_removed == 0
+
+    def test_no_schedule(self, handler, clock):
+        handler.schedules = {'1//b': schedule(('15m', None))}
+        enqueue(handler, 'a', 'b')
+        assert list(handler.queue_index) == [('1', '', 'b')]
+
+
+class TestDispatch(object):
+
+    def test_in_flight(self, handler, clock):
+        handler.max_concurrent_snapshot_creates = 2
+        enqueue(handler, 'a', 'b')
+        clock.set(11, 0)
+        assert dispatch(handler) == 0
+        assert dispatch(handler) == 0
+        assert list(handler.work_queue) == [('1', '', 'b'), ('1', '', 'a')]
+        assert list(handler.lags) == [15 * 60, 0]
+
+        # the current snapshot of a is still being created
+        handler.work_queue.clear()
+        handler.in_flight.discard(('1', '', 'b'))
+        enqueue(handler, 'a')
+        clock.set(12, 0)
+        assert dispatch(handler) == 0
+        assert not handler.work_queue
+        assert handler.in_flight == {('1', '', 'a')}
+        assert handler.queue_index == {}
+
+    def test_max_in_flight(self, handler, clock):
+        enqueue(handler, 'a', 'c')
+        clock.set(11, 0)
+        assert dispatch(handler) == 0
+        assert dispatch(handler) == 60
+        assert list(handler.queue_index) == [('1', '', 'c')]
+
+
+class TestWorkers(object):
+
+    def test_create_snapshots(self, clock):
+        handler = make_handler(make_module(max_concurrent_snapshot_creates=2))
+        try:
+            created = []
+            release = threading.Event()
+
+            def create_snapshot(pool_id, namespace, image_id):
+                with handler.lock:
+                    created.append(image_id)
+                release.wait(10)
+                return image_id == 'a'
+
+            with mock.patch.object(handler, 'create_snapshot', create_snapshot):
+                with handler.lock:
+                    enqueue(handler, 'a', 'b', 'c')
+                    clock.set(11, 0)
+                    while not handler.dispatch():
+                        pass
+                # two at a time
+                assert wait_for(lambda: len(created) == 2)
+                assert dispatch(handler) == 60
+                release.set()
+                assert wait_for(lambda: not handler.in_flight)
+                with handler.lock:
+                    while not handler.dispatch():
+                        pass
+                assert wait_for(lambda: not handler.in_flight)
+
+            assert sorted(created) == ['a', 'b', 'c']
+            assert handler.snapshots_created == 1
+            assert handler.snapshot_create_failures == 2
+            # re-queued at the next schedule time
+            assert dict((k[2], v[0]) for k, v in handler.queue_index.items()) == {
+                'a': datetime(2020, 1, 1, 12, 0),
+                'b': datetime(2020, 1, 1, 11, 15),
+                'c': datetime(2020, 1, 1, 12, 0),
+            }
+        finally:
+            stop(handler)
+
+    def test_forget_removed_images(self, clock):
+        handler = make_handler(make_module(max_concurrent_snapshot_creates=1))
+        try:
+            with mock.patch.object(handler, 'create_snapshot', return_value=True):
+                with handler.lock:
+                    enqueue(handler, 'a')
+                    del handler.images['1']['']['a']
+                    clock.set(11, 0)
+                    handler.dispatch()
+                assert wait_for(lambda: handler.snapshots_created == 1)
+            with handler.lock:
+                assert handler.queue_index == {}
+        finally:
+            stop(handler)
+
+    def test_config_notify(self):
+        module = make_module(max_concurrent_snapshot_creates=1)
+        handler = make_handler(module)
+        try:
+            assert sorted(handler.workers) == [0]
+            module.options['max_concurrent_snapshot_creates'] = 3
+            with mock.patch('rbd_support.mirror_snapshot_schedule.Thread',
+                            side_effect=worker_thread):
+                handler.config_notify()
+            assert sorted(handler.workers) == [0, 1, 2]
+
+            module.options['max_concurrent_snapshot_creates'] = 1
+            handler.config_notify()
+            assert wait_for(lambda: sorted(handler.workers) == [0])
+        finally:
+            stop(handler)
+
+
+class ObjectNotFound(Exception):
+    pass
+
+
+class FakeIoctx(object):
+    """
+    The objects of a pool the image discovery reads: the version of
+    rbd_directory and the omap of rbd_mirroring.
+    """
+    def __init__(self):
+        self.versions = {'rbd_directory': 1, 'rbd_mirroring': 1}
+        self.mirroring = {'mirror_mode': b'image'}
+        self.last_version = None
+
+    def set_mirroring(self, key, value):
+        self.mirroring[key] = value
+        self.versions['rbd_mirroring'] += 1
+
+    def get_pool_id(self):
+        return 1
+
+    def get_pool_name(self):
+        return 'rbd'
+
+    def set_namespace(self, namespace):
+        pass
+
+    def stat(self, oid):
+        if oid not in self.versions:
+            raise ObjectNotFound(oid)
+        self.last_version = self.versions[oid]
+
+    def get_last_version(self):
+        return self.last_version
+
+    def get_omap_vals(self, read_op, start_after, filter_prefix, max_return):
+        read_op.vals = sorted((k, v) for k, v in self.mirroring.items()
+                              if k > start_after and k.startswith(filter_prefix))
+        return iter(read_op.vals[:max_return]), 0
+
+    def operate_read_op(self, read_op, oid):
+        if oid != 'rbd_mirroring':
+            raise ObjectNotFound(oid)
+
+
+class TestImageDiscovery(object):
+
+    def test_is_fresh(self):
+        now = datetime(2020, 1, 1, 10, 30)
+        interval = timedelta(hours=1)
+        image_list = ImageListCache('rbd', '')
+        assert not image_list.is_fresh(None, now, interval)
+        image_list.signal = (1, 'digest')
+        image_list.listed = now
+        assert image_list.is_fresh((1, 'digest'), now + timedelta(minutes=59), interval)
+        assert not image_list.is_fresh((2, 'digest'), now, interval)
+        assert not image_list.is_fresh((1, 'other'), now, interval)
+        assert not image_list.is_fresh((1, 'digest'), now + interval, interval)
+
+    @pytest.fixture
+    def discovery(self, handler, clock):
+        ioctx = FakeIoctx()
+        handler.module.get.return_value = {
+            'pools': [{'pool': 1, 'pool_name': 'rbd',
+                       'application_metadata': {'rbd': {}}}]}
+        handler.module.rados.open_ioctx2.return_value = mock.MagicMock()
+        handler.module.rados.open_ioctx2.return_value.__enter__.return_value = ioctx
+        handler.images = {}
+
+        def refresh():
+            handler.last_refresh_images = datetime(1970, 1, 1)
+            handler.refresh_images()
+            return list_images.call_count
+
+        with mock.patch.multiple(rados, ObjectNotFound=ObjectNotFound,
+                                 ReadOpCtx=mock.MagicMock), \
+                mock.patch.object(rbd, 'RBD') as RBD, \
+                mock.patch.object(handler, 'load_schedules'), \
+                mock.patch.object(handler, 'list_namespace_images',
+                                  return_value={'a': 'rbd/a'}) as list_images:
+            RBD.return_value.namespace_list.return_value = []
+            yield ioctx, refresh
+
+    def test_list_changed_namespaces(self, handler, clock, discovery):
+        ioctx, refresh = discovery
+        ioctx.set_mirroring(u'image_a', b'snapshot enabled')
+        assert refresh() == 1
+        assert handler.images == {'1': {'': {'a': 'rbd/a'}}}
+        assert list(handler.queue_index) == [('1', '', 'a')]
+
+        # the mirroring status and the instances rbd-mirror maintains
+        ioctx.set_mirroring(u'status_global_a', b'up+replaying')
+        ioctx.set_mirroring(u'image_map_a', b'instance 1')
+        assert refresh() == 1
+        assert handler.image_lists['1'][''].hits == 1
+
+        ioctx.set_mirroring(u'image_a', b'snapshot disabling')
+        assert refresh() == 2
+        ioctx.set_mirroring(u'image_b', b'snapshot enabled')
+        assert refresh() == 3
+        ioctx.versions['rbd_directory'] += 1
+        assert refresh() == 4
+        assert refresh() == 4
+
+        clock.current += handler.full_rescan_interval
+        assert refresh() == 5
+        assert handler.image_lists['1'][''].lists == 5
+
+    def test_no_mirroring(self, handler, clock, discovery):
+        ioctx, refresh = discovery
+        ioctx.versions.clear()
+        ioctx.operate_read_op = mock.Mock(side_effect=ObjectNotFound)
+        assert refresh() == 1
+        assert refresh() == 1
+
@@ -0,0 +1,235 @@
+import random
+
+import pytest
+
+from tests import mock
+
+from ..perf import (OSD_PERF_QUERY_COUNTERS, QUERY_IMAGE_COUNTERS,
+                    QUERY_POOL_ID_MAP, REPORT_MAX_RESULTS, ImageCounters,
+                    PerfHandler)
+
+WRITE_OPS = OSD_PERF_QUERY_COUNTERS.index('write_ops')
+WRITE_BYTES = OSD_PERF_QUERY_COUNTERS.index('write_bytes')
+WRITE_LATENCY = OSD_PERF_QUERY_COUNTERS.index('write_latency')
+
+
+class PerImageCounters(object):
+    """
+    The last two raw counters and the running sums of each image, as
+    they were kept before ImageCounters.
+    """
+    def __init__(self):
+        self.raw = {}
+        self.sums = {}
+
+    def merge(self, now_ts, reports):
+        for key, values in reports:
+            raw = self.raw.setdefault(key, [None, None])
+            if raw[0] and raw[0][0] < now_ts:
+                raw[1] = raw[0]
+                raw[0] = None
+            if not raw[0]:
+                raw[0] = [now_ts, list(values)]
+
+        for key, raw in self.raw.items():
+            if not raw[0]:
+                continue
+            elif raw[0][0] < now_ts:
+                raw[1] = raw[0]
+                raw[0] = [now_ts, [0 for _ in raw[1][1]]]
+                continue
+            if key in self.sums:
+                self.sums[key] = [s + c for s, c in zip(self.sums[key], raw[0][1])]
+            else:
+                self.sums[key] = list(raw[0][1])
+
+    def remove(self, key):
+        del self.sums[key]
+        self.raw.pop(key, None)
+
+    def stat(self, index, key):
+        raw = self.raw.get(key)
+        if not raw or not raw[0] or not raw[1]:
+            return 0
+        period = raw[0][0] - raw[1][0]
+        if period <= 0 or period > 60:
+            return 0
+        rate = float(raw[0][1][index]) / period
+        if index == WRITE_LATENCY:
+            rate /= max(1, self.stat(WRITE_OPS, key))
+        elif index == WRITE_LATENCY + 1:
+            rate /= max(1, self.stat(WRITE_OPS + 1, key))
+        return rate
+
+
+def merge(counters, per_image, now_ts, reports):
+    counters.start_period(now_ts)
+    for key, values in reports:
+        counters.update(key, values)
+    counters.end_period()
+    per_image.merge(now_ts, reports)
+
+
+def assert_same(counters, per_image):
+    assert sorted(counters.keys) == sorted(per_image.sums)
+    assert len(counters.rows) == len(counters)
+    for index in range(len(OSD_PERF_QUERY_COUNTERS)):
+        rates = counters.rates(index)
+        for key, row in counters.rows.items():
+            assert counters.keys[row] == key
+            assert rates[row] == counters.rate(index, row) == \
+                per_image.stat(index, key)
+            assert counters.sums[index][row] == per_image.sums[key][index]
+
+
+def values(*values):
+    return list(values) + [0] * (len(OSD_PERF_QUERY_COUNTERS) - len(values))
+
+
+class TestImageCounters(object):
+
+    def test_rates(self):
+        counters = ImageCounters()
+        per_image = PerImageCounters()
+        a, b = (1, '', 'a'), (1, '', 'b')
+
+        # no rate during the first period of an image
+        merge(counters, per_image, 100, [(a, values(10, 0, 0, 0, 40))])
+        assert counters.rates(WRITE_OPS) == [0]
+        assert_same(counters, per_image)
+
+        merge(counters, per_image, 105, [(a, values(10, 0, 0, 0, 40)),
+                                         (b, values(5))])
+        assert counters.rates(WRITE_OPS) == [2.0, 0]
+        # the latency is averaged per op
+        assert counters.rates(WRITE_LATENCY) == [4.0, 0]
+        assert counters.sums[WRITE_OPS].tolist() == [20, 5]
+        assert_same(counters, per_image)
+
+        # only the first report of an image per period counts
+        merge(counters, per_image, 110, [(b, values(50)), (b, values(10))])
+        assert counters.rates(WRITE_OPS) == [0, 10.0]
+        assert_same(counters, per_image)
+
+        # no rates after a gap longer than the stats rate interval
+        merge(counters, per_image, 200, [(a, values(10)), (b, values(10))])
+        assert counters.rates(WRITE_OPS) == [0, 0]
+        assert_same(counters, per_image)
+
+    def test_remove(self):
+        counters = ImageCounters()
+        per_image = PerImageCounters()
+        keys = [(1, '', image_id) for image_id in 'abcd']
+        for now_ts in (100, 105):
+            merge(counters, per_image, now_ts,
+                  [(key, values(i + 1, 0, 10 * (i + 1))) for i, key in enumerate(keys)])
+
+        # the last row is moved into the removed one
+        counters.remove(keys[1])
+        per_image.remove(keys[1])
+        assert counters.keys == [keys[0], keys[3], keys[2]]
+        assert counters.rows == {keys[0]: 0, keys[3]: 1, keys[2]: 2}
+        assert counters.sums[WRITE_BYTES].tolist() == [20, 80, 60]
+        assert counters.rates(WRITE_OPS) == [0.2, 0.8, 0.6]
+        assert_same(counters, per_image)
+
+        counters.remove(keys[2])
+        per_image.remove(keys[2])
+        assert counters.keys == [keys[0], keys[3]]
+        assert_same(counters, per_image)
+
+        # a re-added image starts over
+        merge(counters, per_image, 110, [(keys[1], values(5))])
+        assert counters.rows[keys[1]] == 2
+        assert counters.rates(WRITE_OPS) == [0, 0, 0]
+        assert_same(counters, per_image)
+
+    def test_random(self):
+        rng = random.Random(0)
+        counters = ImageCounters()
+        per_image = PerImageCounters()
+        keys = [(pool_id, namespace, str(i))
+                for pool_id in (1, 2) for namespace in ('', 'ns') for i in range(8)]
+        now_ts = 1000
+        for _ in range(200):
+            now_ts += rng.choice([5, 5, 5, 30, 61])
+            reports = [(key, [rng.randrange(1000) for _ in OSD_PERF_QUERY_COUNTERS])
+                       for key in rng.sample(keys, rng.randrange(len(keys)))]
+            reports += rng.sample(reports, len(reports) // 4)
+            merge(counters, per_image, now_ts, reports)
+            for key in rng.sample(counters.keys, min(2, len(counters))):
+                counters.remove(key)
+                per_image.remove(key)
+            assert_same(counters, per_image)
+
+
+class TestReport(object):
+
+    @pytest.fixture
+    def handler(self):
+        with mock.patch('rbd_support.perf.Thread'), \
+                mock.patch.multiple(PerfHandler, user_queries={},
+                                    image_name_cache={}):
+            yield PerfHandler(mock.Mock())
+
+    def make_query(self, handler, rng):
+        counters = ImageCounters()
+        per_image = PerImageCounters()
+        keys = [(pool_id, '', str(i)) for pool_id in (1, 2, 3) for i in range(60)]
+        for pool_id in (1, 2, 3):
+            handler.image_name_cache[(pool_id, '')] = {
+                str(i): 'image{}'.format(i) for i in range(60)}
+
+        ops = rng.sample(range(1, 1000), len(keys))
+        for now_ts in (100, 105):
+            # some of the images are idle
+            merge(counters, per_image, now_ts,
+                  [(key, values(ops[i] if i % 5 else 0, 0, i))
+                   for i, key in enumerate(keys)])
+        for key in rng.sample(keys, 30):
+            counters.remove(key)
+            per_image.remove(key)
+
+        query = {QUERY_POOL_ID_MAP: {1: 'rbd', 2: 'other'},
+                 QUERY_IMAGE_COUNTERS: counters}
+        return query, per_image
+
+    def expected(self, handler, query, per_image, sort_by, extract):
+        pool_id_map = query[QUERY_POOL_ID_MAP]
+        keys = sorted((key for key in per_image.sums if key[0] in pool_id_map),
+                      key=lambda key: per_image.stat(sort_by, key), reverse=True)
+        report = []
+        for key in keys[:REPORT_MAX_RESULTS]:
+            data = [extract(i, key) for i in range(len(OSD_PERF_QUERY_COUNTERS))]
+            if any(data):
+                report.append((pool_id_map[key[0]],
+                               handler.image_name_cache[key[:2]][key[2]], data))
+        return report
+
+    def report(self, handler, query, sort_by, extract_data):
+        pool_descriptors, counters = handler.generate_report(
+            query, OSD_PERF_QUERY_COUNTERS[sort_by], extract_data)
+        report = []
+        for counter in counters:
+            [(descriptor, data)] = counter.items()
+            pool_index, image_name = descriptor.split('/')
+            report.append((pool_descriptors[int(pool_index)], image_name, data))
+        return report
+
+    def test_stats(self, handler):
+        query, per_image = self.make_query(handler, random.Random(0))
+        report = self.report(handler, query, WRITE_OPS, handler.extract_stat)
+        assert len(report) == REPORT_MAX_RESULTS
+        assert [data[WRITE_OPS] for _, _, data in report] == \
+            sorted((data[WRITE_OPS] for _, _, data in report), reverse=True)
+        assert report == self.expected(handler, query, per_image, WRITE_OPS,
+                                       per_image.stat)
+
+    def test_counters(self, handler):
+        query, per_image = self.make_query(handler, random.Random(1))
+        report = self.report(handler, query, WRITE_OPS, handler.extract_counter)
+        # still limited to the images with the most recent IO activity
+        assert len(report) == REPORT_MAX_RESULTS
+        assert report == self.expected(
+            handler, query, per_image, WRITE_OPS,
+            lambda index, key: per_image.sums[key][index])
@@ -0,0 +1,302 @@
+import errno
+import threading
+import time
+from datetime import timedelta
+
+import pytest
+
+from tests import mock
+
+import rados
+import rbd
+
+from ..task import (TASK_REF_ACTION, TASK_REF_ACTION_FLATTEN,
+                    TASK_REF_ACTION_REMOVE, TASK_REF_IMAGE_ID,
+                    TASK_REF_IMAGE_NAME, TASK_REF_POOL_NAME,
+                    TASK_REF_POOL_NAMESPACE, Task, TaskHandler)
+
+
+class Error(Exception):
+    def __init__(self, message='', errno=None):
+        super(Error, self).__init__(message)
+        self.errno = errno
+
+
+class ObjectNotFound(Error):
+    pass
+
+
+class ImageNotFound(Error):
+    pass
+
+
+class InvalidArgument(Error):
+    pass
+
+
+class OperationCanceled(Error):
+    pass
+
+
+@pytest.fixture(autouse=True)
+def errors():
+    with mock.patch.multiple(rados, Error=Error, ObjectNotFound=ObjectNotFound,
+                             WriteOpCtx=mock.MagicMock()), \
+            mock.patch.multiple(rbd, Error=Error, ImageNotFound=ImageNotFound,
+                                InvalidArgument=InvalidArgument,
+                                OperationCanceled=OperationCanceled,
+                                ECANCELED=errno.ECANCELED):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def task_state():
+    # the tasks are kept by the class
+    with mock.patch.multiple(TaskHandler, tasks_by_sequence={}, tasks_by_id={},
+                             completed_tasks=[], sequence=0):
+        yield
+
+
+def make_module(max_concurrent_tasks=4, max_concurrent_tasks_per_pool=2):
+    module = mock.Mock()
+    module.get.return_value = {'pools': []}
+    module.options = {
+        'max_concurrent_tasks': max_concurrent_tasks,
+        'max_concurrent_tasks_per_pool': max_concurrent_tasks_per_pool,
+    }
+    module.get_module_option.side_effect = lambda name: module.options[name]
+    module.rados.open_ioctx.return_value = mock.MagicMock()
+    return module
+
+
+def stop(handler):
+    with handler.lock:
+        handler.max_concurrent_tasks = 0
+        handler.condition.notify_all()
+    for thread in list(handler.workers.values()):
+        if isinstance(thread, threading.Thread):
+            thread.join(10)
+
+
+@pytest.fixture
+def handler():
+    # no workers: the tests dequeue and execute the tasks
+    with mock.patch('rbd_support.task.Thread'):
+        yield TaskHandler(make_module())
+
+
+def refs(action, pool_name, image_id):
+    return {TASK_REF_ACTION: action,
+            TASK_REF_POOL_NAME: pool_name,
+            TASK_REF_POOL_NAMESPACE: '',
+            TASK_REF_IMAGE_NAME: 'image_' + image_id,
+            TASK_REF_IMAGE_ID: image_id}
+
+
+def add(handler, action, pool_name, image_id, parent=None):
+    if parent:
+        parent = {TASK_REF_POOL_NAME: parent[0],
+                  TASK_REF_POOL_NAMESPACE: '',
+                  TASK_REF_IMAGE_ID: parent[1]}
+    with handler.lock:
+        handler.add_task(mock.MagicMock(), action, refs(action, pool_name, image_id), parent)
+        return handler.tasks_by_sequence[handler.sequence]
+
+
+def dequeue_all(handler):
+    tasks = []
+    while True:
+        task = handler.dequeue_task()
+        if not task:
+            return tasks
+        tasks.append(task)
+
+
+def execute(handler, task, fn=None):
+    with mock.patch.object(handler, 'execute_' + task.refs[TASK_REF_ACTION],
+                           fn or mock.Mock()), \
+            handler.lock:
+        handler.execute_task(task)
+
+
+class TestTaskQueue(object):
+
+    def test_sequence_order_across_pools(self, handler):
+        tasks = [add(handler, TASK_REF_ACTION_REMOVE, pool_name, image_id)
+                 for pool_name, image_id in [('p2', 'a'), ('p1', 'b'), ('p2', 'c')]]
+        assert dequeue_all(handler) == tasks
+
+    def test_pool_limit(self, handler):
+        a, b, c = [add(handler, TASK_REF_ACTION_REMOVE, pool_name, image_id)
+                   for pool_name, image_id in [('p1', 'a'), ('p1', 'b'), ('p2', 'c')]]
+        assert handler.dequeue_task() is a
+        # the tasks of a pool that reached its limit wait
+        handler.in_progress_by_pool['p1'] = handler.max_concurrent_tasks_per_pool
+        assert handler.dequeue_task() is c
+        assert handler.dequeue_task() is None
+        del handler.in_progress_by_pool['p1']
+        assert handler.dequeue_task() is b
+
+    def test_image_order(self, handler):
+        flatten = add(handler, TASK_REF_ACTION_FLATTEN, 'p1', 'a')
+        remove = add(handler, TASK_REF_ACTION_REMOVE, 'p1', 'a')
+        other = add(handler, TASK_REF_ACTION_REMOVE, 'p1', 'b')
+        assert dequeue_all(handler) == [flatten, other]
+        assert handler.task_stats()[1].count('"waiting_image": 1')
+
+        execute(handler, flatten)
+        assert flatten.task_id not in handler.tasks_by_id
+        assert handler.completed_tasks == [flatten]
+        assert handler.in_progress_by_pool == {}
+        assert dequeue_all(handler) == [remove]
+
+    @pytest.mark.parametrize('parent_pool_name', ['p1', 'p2'])
+    def test_flatten_before_parent_tasks(self, handler, parent_pool_name):
+        flatten = add(handler, TASK_REF_ACTION_FLATTEN, 'p1', 'child',
+                      parent=(parent_pool_name, 'parent'))
+        remove_parent = add(handler, TASK_REF_ACTION_REMOVE, parent_pool_name, 'parent')
+        other = add(handler, TASK_REF_ACTION_REMOVE, 'p1', 'other')
+        assert dequeue_all(handler) == [flatten, other]
+
+        execute(handler, flatten)
+        assert dequeue_all(handler) == [remove_parent]
+
+    def test_flatten_after_parent_tasks(self, handler):
+        remove_child = add(handler, TASK_REF_ACTION_REMOVE, 'p1', 'child')
+        flatten = add(handler, TASK_REF_ACTION_FLATTEN, 'p1', 'other_child',
+                      parent=('p1', 'parent'))
+        remove_parent = add(handler, TASK_REF_ACTION_REMOVE, 'p1', 'parent')
+        assert dequeue_all(handler) == [remove_child, flatten]
+
+        # canceling a flatten lets the tasks of the parent run
+        handler.handle_command(None, 'cancel', {'task_id': flatten.task_id})
+        assert dequeue_all(handler) == [remove_parent]
+
+    def test_queue_flatten_records_parent(self, handler):
+        image = mock.MagicMock()
+        image.id.return_value = 'child_id'
+        image.parent_id.return_value = 'parent_id'
+        image.get_parent_image_spec.return_value = {
+            'pool_name': 'p2', 'pool_namespace': 'ns', 'image_name': 'parent',
+            'snap_name': 'snap'}
+        with mock.patch.object(rbd, 'Image') as Image:
+            Image.return_value.__enter__.return_value = image
+            handler.handle_command(None, 'add flatten', {'image_spec': 'p1/child'})
+        task = handler.tasks_by_sequence[handler.sequence]
+        assert task.image_keys == [('p1', '', 'child_id'), ('p2', 'ns', 'parent_id')]
+
+        # and across restarts
+        task = Task.from_json(task.to_json())
+        assert task.image_keys == [('p1', '', 'child_id'), ('p2', 'ns', 'parent_id')]
+
+    def test_retry(self, handler):
+        task = add(handler, TASK_REF_ACTION_REMOVE, 'p1', 'a')
+        assert handler.dequeue_task() is task
+        with mock.patch('rbd_support.task.TASK_RETRY_INTERVAL',
+                        timedelta(milliseconds=100)):
+            execute(handler, task, mock.Mock(side_effect=Error('busy')))
+        assert handler.tasks_by_id[task.task_id] is task
+        assert handler.retried_count == 1
+        assert handler.in_progress_by_pool == {}
+        assert handler.dequeue_task() is None
+        assert 0 < handler.retry_wait() <= 0.1
+
+        time.sleep(0.1)
+        assert handler.dequeue_task() is task
+
+    def test_cancel_queued(self, handler):
+        remove = add(handler, TASK_REF_ACTION_REMOVE, 'p1', 'a')
+        flatten = add(handler, TASK_REF_ACTION_FLATTEN, 'p1', 'a')
+        handler.handle_command(None, 'cancel', {'task_id': remove.task_id})
+        assert handler.canceled_count == 1
+        assert dequeue_all(handler) == [flatten]
+
+    def test_cancel_during_execution(self, handler):
+        task = add(handler, TASK_REF_ACTION_REMOVE, 'p1', 'a')
+        assert handler.dequeue_task() is task
+        started = threading.Event()
+        canceled = threading.Event()
+        result = []
+
+        def execute_remove(ioctx, task):
+            started.set()
+            canceled.wait(10)
+            result.append(handler.progress_callback(task, 1, 2))
+            raise OperationCanceled()
+
+        thread = threading.Thread(target=execute, args=(handler, task, execute_remove))
+        thread.start()
+        assert started.wait(10)
+        with handler.lock:
+            assert handler.in_progress_by_pool == {'p1': 1}
+            assert handler.task_cancel(task.task_id)[0] == 0
+            # removed once the execution stops
+            assert task.task_id in handler.tasks_by_id
+        canceled.set()
+        thread.join(10)
+
+        assert result == [-errno.ECANCELED]
+        assert task.task_id not in handler.tasks_by_id
+        assert handler.canceled_count == 1
+        assert handler.retried_count == 0
+        assert handler.in_progress_by_pool == {}
+        assert handler.dequeue_task() is None
+
+
+class TestWorkers(object):
+
+    def test_concurrent_execution(self):
+        handler = TaskHandler(make_module(max_concurrent_tasks=3,
+                                          max_concurrent_tasks_per_pool=2))
+        try:
+            running = set()
+            max_running = []
+            release = threading.Event()
+
+            def execute_remove(ioctx, task):
+                with handler.lock:
+                    running.add(task.refs[TASK_REF_IMAGE_ID])
+                    max_running.append(set(running))
+                release.wait(10)
+                with handler.lock:
+                    running.discard(task.refs[TASK_REF_IMAGE_ID])
+
+            with mock.patch.object(handler, 'execute_remove', execute_remove):
+                for pool_name, image_id in [('p1', 'a'), ('p1', 'b'), ('p1', 'c'),
+                                            ('p2', 'd')]:
+                    add(handler, TASK_REF_ACTION_REMOVE, pool_name, image_id)
+                for _ in range(100):
+                    if len(running) == 3:
+                        break
+                    time.sleep(0.05)
+                # at most 2 of the images of p1
+                assert running == {'a', 'b', 'd'}
+                release.set()
+                for _ in range(100):
+                    if not handler.tasks_by_sequence:
+                        break
+                    time.sleep(0.05)
+            assert not handler.tasks_by_sequence
+            assert handler.completed_count == 4
+        finally:
+            stop(handler)
+
+    def test_config_notify(self):
+        module = make_module(max_concurrent_tasks=1)
+        handler = TaskHandler(module)
+        try:
+            assert sorted(handler.workers) == [0]
+            module.options['max_concurrent_tasks'] = 3
+            handler.config_notify()
+            assert sorted(handler.workers) == [0, 1, 2]
+
+            module.options['max_concurrent_tasks'] = 1
+            handler.config_notify()
+            for _ in range(100):
+                with handler.lock:
+                    if sorted(handler.workers) == [0]:
+                        break
+                time.sleep(0.05)
+            assert sorted(handler.workers) == [0]
+        finally:
+            stop(handler)
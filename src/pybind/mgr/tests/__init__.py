@@ -32,3 +32,5 @@ if 'UNITTEST' in os.environ:
     cm.BaseMgrStandbyModule = M
     sys.modules['ceph_module'] = cm
     sys.modules['rados'] = mock.Mock()
+    sys.modules['rbd'] = mock.Mock()
+    sys.modules['cephfs'] = mock.Mock()
@@ -1,5 +1,7 @@
 from __future__ import absolute_import
 import json
+import threading
+import time
 
 from tests import mock
 
@@ -10,6 +12,8 @@ from orchestrator import raise_if_exception, RGWSpec, Completion, ProgressRefere
 from orchestrator import InventoryNode, ServiceDescription
 from orchestrator import OrchestratorValidationError
 from orchestrator import parse_host_specs
+from orchestrator import OutdatableData, OutdatablePersistentDict
+from orchestrator import OrchestratorClientMixin, wait_completions, FIRST_COMPLETED
 
 
 @pytest.mark.parametrize("test_input,expected, require_network",
@@ -162,6 +166,43 @@ def test_side_effect():
     assert foo['x'] == 3
 
 
+def test_wait_completions():
+    a = Completion(on_complete=lambda x: x + 1)
+    b = Completion(on_complete=lambda x: x + 2)
+
+    # nothing processes them
+    assert wait_completions([a, b], timeout=0.1) == ([], [a, b])
+    assert not a.wait(timeout=0.1)
+
+    threading.Timer(0.1, lambda: a.finalize(1)).start()
+    start = time.time()
+    assert wait_completions([a, b], return_when=FIRST_COMPLETED) == ([a], [b])
+    assert time.time() - start < 1
+    assert a.result == 2
+
+    threading.Timer(0.1, lambda: b.finalize(1)).start()
+    assert wait_completions([a, b]) == ([a, b], [])
+    assert b.wait(timeout=0)
+    assert b.result == 3
+
+
+def test_orchestrator_wait():
+    client = OrchestratorClientMixin()
+    client.log = mock.Mock()
+    client.PROCESS_INTERVAL = 10
+    a = Completion(value=1).then(lambda x: Completion.ASYNC_RESULT)
+    b = Completion(value=2)
+    # `a` finishes later, in another thread, `b` when processed.
+    client.process = lambda cs: [c.finalize() for c in cs]
+    threading.Timer(0.1, lambda: a._last_promise()._finalize(3)).start()
+    start = time.time()
+    assert client._orchestrator_wait([a, b], return_when=FIRST_COMPLETED) == ([b], [a])
+    assert client._orchestrator_wait([a, b]) == ([a, b], [])
+    # woken up right away, rather than after PROCESS_INTERVAL
+    assert time.time() - start < 5
+    assert a.result == 3
+
+
 def test_progress():
     c = some_complex_completion()
     mgr = mock.MagicMock()
@@ -273,3 +314,39 @@ def test_pretty_print():
 
     assert p.result == 5
 
+
+
+@pytest.mark.parametrize("cached, write_back", [(False, False), (True, False), (True, True)])
+def test_outdatable_persistent_dict(cached, write_back):
+    store = {}
+    mgr = mock.Mock()
+    mgr.get_store_prefix.side_effect = lambda prefix: {
+        k: v for k, v in store.items() if k.startswith(prefix)}
+    mgr.get_store.side_effect = store.get
+    mgr.set_store.side_effect = lambda k, v: store.pop(k, None) if v is None else store.update({k: v})
+
+    d = OutdatablePersistentDict(mgr, 'test', cached=cached, write_back=write_back)
+    d['a'] = OutdatableData({'x': 1})
+    d['b'] = OutdatableData({'y': 2})
+    del d['b']
+    if write_back:
+        assert store == {}
+        d.flush()
+    assert list(store) == ['test.a']
+    assert d['a'].data == {'x': 1}
+    assert d.keys() == {'a'}
+    assert not d['a'].outdated()
+    with pytest.raises(IndexError):
+        d['b']
+
+    # a fresh instance (e.g. after a failover) loads from the store
+    d = OutdatablePersistentDict(mgr, 'test', cached=cached)
+    assert [(k, v.data) for k, v in d.items()] == [('a', {'x': 1})]
+    if cached:
+        calls = mgr.get_store_prefix.call_count + mgr.get_store.call_count
+        assert d['a'].data == {'x': 1}
+        assert 'a' in d
+        assert mgr.get_store_prefix.call_count + mgr.get_store.call_count == calls
+    d.clear()
+    assert store == {}
+    assert not d.keys()
@@ -1,23 +1,68 @@
+import time
+import logging
 from contextlib import contextmanager
-from threading import Lock
+from threading import Lock, Condition
+
+log = logging.getLogger(__name__)
+
+class RWLock(object):
+    """
+    Reader/writer lock. Writers are preferred: once a writer waits, new
+    readers wait for it, so that a stream of readers cannot starve it.
+    """
+    def __init__(self):
+        self.cond = Condition(Lock())
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+
+    def acquire_read(self):
+        with self.cond:
+            while self.writer or self.writers_waiting:
+                self.cond.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.cond:
+            self.readers -= 1
+            if not self.readers:
+                self.cond.notifyAll()
+
+    def acquire_write(self):
+        with self.cond:
+            self.writers_waiting += 1
+            try:
+                while self.writer or self.readers:
+                    self.cond.wait()
+            finally:
+                self.writers_waiting -= 1
+            self.writer = True
+
+    def release_write(self):
+        with self.cond:
+            self.writer = False
+            self.cond.notifyAll()
 
 # singleton design pattern taken from http://www.aleax.it/5ep.html
 
-class GlobalLock(object):
+class PathLock(object):
     """
-    Global lock to serialize operations in mgr/volumes. This lock
-    is currently held when accessing (opening) a volume to perform
-    group/subvolume operations. Since this is a big lock, it's rather
-    inefficient -- but right now it's ok since mgr/volumes does not
-    expect concurrent operations via its APIs.
-
-    As and when features get added (such as clone, where mgr/volumes
-    would maintain subvolume states in the filesystem), there might
-    be a need to allow concurrent operations. In that case it would
-    be nice to implement an efficient path based locking mechanism.
-
-    See: https://people.eecs.berkeley.edu/~kubitron/courses/cs262a-F14/projects/reports/project6_report.pdf
+    Hierarchical reader/writer locks to serialize operations in mgr/volumes.
+
+    Operations lock a path (volume, volume/group or volume/group/subvolume)
+    for shared or exclusive access. Ancestors of the path are locked for
+    shared access, so that operations on independent subvolumes (or groups)
+    run in parallel while, say, removing a group waits for (and blocks) the
+    operations on its subvolumes. Locks are always acquired from the volume
+    down, hence an operation holding a path lock cannot deadlock another.
+
+    The time spent waiting for locks is recorded per path level and mode.
     """
+    LEVELS = ('volume', 'group', 'subvolume')
+
+    # waits longer than this (in seconds) are logged
+    SLOW_WAIT = 5.0
+
     _shared_state = {
         'lock' : Lock(),
         'init' : False
@@ -26,11 +71,88 @@ class GlobalLock(object):
     def __init__(self):
         with self._shared_state['lock']:
             if not self._shared_state['init']:
+                # path -> [RWLock, number of users]
+                self._shared_state['locks'] = {}
+                self._shared_state['waits'] = {}
                 self._shared_state['init'] = True
         # share this state among all instances
         self.__dict__ = self._shared_state
 
+    def _get(self, path):
+        with self.lock:
+            entry = self.locks.get(path)
+            if entry is None:
+                entry = self.locks[path] = [RWLock(), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def _put(self, path):
+        with self.lock:
+            entry = self.locks[path]
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[path]
+
+    def _record_wait(self, path, exclusive, wait):
+        key = (PathLock.LEVELS[len(path) - 1], 'exclusive' if exclusive else 'shared')
+        with self.lock:
+            stats = self.waits.setdefault(key, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += wait
+            stats[2] = max(stats[2], wait)
+        if wait >= PathLock.SLOW_WAIT:
+            log.info("waited {0:.3f}s for {1} lock on {2}".format(
+                wait, key[1], "/".join(str(p) for p in path)))
+
+    def _acquire(self, path, exclusive):
+        rwlock = self._get(path)
+        start = time.time()
+        if exclusive:
+            rwlock.acquire_write()
+        else:
+            rwlock.acquire_read()
+        self._record_wait(path, exclusive, time.time() - start)
+        return rwlock
+
+    def _release(self, path, rwlock, exclusive):
+        if exclusive:
+            rwlock.release_write()
+        else:
+            rwlock.release_read()
+        self._put(path)
+
     @contextmanager
-    def lock_op(self):
-        with self._shared_state['lock']:
+    def lock_op(self, path, exclusive=True):
+        """
+        lock a path for the duration of an operation.
+
+        :param path: tuple of (volume[, group[, subvolume]]) names
+        :param exclusive: lock the path for exclusive (or shared) access
+        :return: None
+        """
+        assert 0 < len(path) <= len(PathLock.LEVELS)
+        held = []
+        try:
+            for i in range(1, len(path) + 1):
+                excl = exclusive and i == len(path)
+                held.append((path[:i], self._acquire(path[:i], excl), excl))
             yield
+        finally:
+            for p, rwlock, excl in reversed(held):
+                self._release(p, rwlock, excl)
+
+    def wait_stats(self):
+        """
+        lock wait time statistics.
+
+        :return: dictionary of level -> mode -> {count, total_wait, max_wait}
+        """
+        stats = {}
+        with self.lock:
+            for (level, mode), (count, total, maximum) in self.waits.items():
+                stats.setdefault(level, {})[mode] = {
+                    'count': count,
+                    'total_wait': total,
+                    'max_wait': maximum
+                }
+        return stats
@@ -1,6 +1,11 @@
 import os
+import json
+import time
 import uuid
+import errno
 import logging
+import threading
+from collections import deque
 from contextlib import contextmanager
 
 import cephfs
@@ -11,6 +16,254 @@ from ..exception import VolumeException
 
 log = logging.getLogger(__name__)
 
+class PurgeProgress(object):
+    """
+    Progress of a trash entry purge: entries removed and the removal rate
+    since the purge (re)started. Sizes are not tracked, stat'ing every
+    file would cost an MDS round trip per unlink.
+    """
+    def __init__(self, entries=0, total_entries=0):
+        self.entries = entries
+        self.total_entries = total_entries
+        self.start_time = time.time()
+        self.start_entries = entries
+
+    @property
+    def rate(self):
+        elapsed = time.time() - self.start_time
+        if elapsed <= 0:
+            return 0.0
+        return (self.entries - self.start_entries) / elapsed
+
+    @property
+    def fraction(self):
+        if not self.total_entries:
+            return 0.0
+        return min(1.0, float(self.entries) / self.total_entries)
+
+    def __str__(self):
+        return "{0} entries removed, {1:.1f} entries/s".format(
+            self.entries, self.rate)
+
+class TreePurge(object):
+    """
+    Remove directory trees with a pool of worker threads.
+
+    Workers share a queue of directories to list and batches of files to
+    unlink, so a single deep (or wide) tree keeps all workers busy. Each
+    directory tracks its outstanding work items and is removed by the
+    worker which completes the last of them. The directories still queued
+    are saved periodically as a resume point (in an xattr on the trash
+    entry) so that a restarted purge does not need to walk them again.
+    """
+
+    # files per unlink work item
+    UNLINK_BATCH_SIZE = 512
+
+    # seconds between resume point updates and progress callbacks
+    CHECKPOINT_INTERVAL = 30
+    PROGRESS_INTERVAL = 5
+
+    # resume point: queued directories saved and maximum xattr size
+    STATE_XATTR = 'user.volumes.purge_state'
+    STATE_MAX_DIRS = 64
+    STATE_MAX_SIZE = 16384
+
+    class Dir(object):
+        def __init__(self, path, parent):
+            self.path = path
+            self.parent = parent
+            # listing the directory is the first outstanding item
+            self.pending = 1
+            self.relisted = False
+
+    def __init__(self, fs, root, nr_workers, should_cancel, progress, on_progress=None):
+        self.fs = fs
+        self.root = root
+        self.nr_workers = max(1, nr_workers)
+        self.should_cancel = should_cancel
+        self.progress = progress
+        self.on_progress = on_progress
+
+        self.lock = threading.Lock()
+        self.cv = threading.Condition(self.lock)
+        self.queue = deque()
+        # queued and in-progress work items
+        self.outstanding = 0
+        self.error = None
+        now = time.time()
+        self.checkpoint_time = now
+        self.progress_time = now
+
+    def run(self, roots):
+        """
+        purge the given directories (and the directory trees below them).
+
+        :param roots: directories to purge
+        :return: True if purged, False if cancelled
+        """
+        with self.lock:
+            for path in roots:
+                self._queue(self._list_dir, TreePurge.Dir(path, None))
+
+        thread_name = threading.currentThread().getName()
+        workers = []
+        for i in range(self.nr_workers - 1):
+            workers.append(threading.Thread(target=self._run_worker,
+                                            name="{0}.{1}".format(thread_name, i)))
+            workers[-1].start()
+        self._run_worker()
+        for worker in workers:
+            worker.join()
+
+        if self.error:
+            raise self.error
+        if self.outstanding:
+            # cancelled: save what is left to do for the next attempt
+            self._checkpoint()
+            return False
+        return True
+
+    def _stopped(self):
+        return self.error is not None or self.should_cancel()
+
+    def _queue(self, fn, d, *args):
+        # called with the lock held. listing a directory is outstanding work
+        # for its parent, unlinking files for the directory holding them.
+        owner = d.parent if fn == self._list_dir else d
+        if owner is not None:
+            owner.pending += 1
+        self.outstanding += 1
+        self.queue.append((fn, d, args))
+        self.cv.notify()
+
+    def _run_worker(self):
+        while True:
+            with self.lock:
+                while not self.queue and self.outstanding and not self._stopped():
+                    # wake up periodically to check for cancellation
+                    self.cv.wait(1)
+                if not self.outstanding or self._stopped():
+                    self.cv.notifyAll()
+                    return
+                # depth first: bounds the queue and keeps directories local
+                fn, d, args = self.queue.pop()
+
+            try:
+                fn(d, *args)
+            except Exception as e:
+                with self.lock:
+                    if self.error is None:
+                        self.error = e
+                    self.cv.notifyAll()
+                return
+
+            with self.lock:
+                self.outstanding -= 1
+                if not self.outstanding:
+                    self.cv.notifyAll()
+            self._report()
+
+    def _list_dir(self, d):
+        log.debug("purge: listing {0}".format(d.path))
+        files = []
+        try:
+            with self.fs.opendir(d.path) as dir_handle:
+                entry = self.fs.readdir(dir_handle)
+                while entry and not self._stopped():
+                    if entry.d_name not in (b".", b".."):
+                        path = os.path.join(d.path, entry.d_name)
+                        if entry.is_dir():
+                            with self.lock:
+                                self._queue(self._list_dir, TreePurge.Dir(path, d))
+                        else:
+                            files.append(path)
+                            if len(files) >= TreePurge.UNLINK_BATCH_SIZE:
+                                with self.lock:
+                                    self._queue(self._unlink_files, d, files)
+                                files = []
+                    entry = self.fs.readdir(dir_handle)
+        except cephfs.ObjectNotFound:
+            # removed by an earlier purge attempt
+            pass
+        self._unlink_files(d, files)
+
+    def _unlink_files(self, d, files):
+        entries = 0
+        for path in files:
+            if self._stopped():
+                return
+            try:
+                self.fs.unlink(path)
+            except cephfs.ObjectNotFound:
+                continue
+            entries += 1
+        with self.lock:
+            self.progress.entries += entries
+        self._complete(d)
+
+    def _complete(self, d):
+        while d is not None:
+            with self.lock:
+                d.pending -= 1
+                if d.pending or self._stopped():
+                    return
+            removed = 1
+            try:
+                self.fs.rmdir(d.path)
+            except cephfs.ObjectNotFound:
+                removed = 0
+            except cephfs.OSError as e:
+                # entries missed by the listing (e.g. created during it):
+                # list the directory once more before giving up.
+                if e.errno != errno.ENOTEMPTY or d.relisted:
+                    raise
+                d.relisted = True
+                d.pending = 1
+                self._list_dir(d)
+                return
+            with self.lock:
+                self.progress.entries += removed
+            d = d.parent
+
+    def _report(self):
+        now = time.time()
+        with self.lock:
+            report = now - self.progress_time >= TreePurge.PROGRESS_INTERVAL
+            if report:
+                self.progress_time = now
+            checkpoint = now - self.checkpoint_time >= TreePurge.CHECKPOINT_INTERVAL
+            if checkpoint:
+                self.checkpoint_time = now
+        if report and self.on_progress:
+            self.on_progress(self.progress)
+        if checkpoint:
+            self._checkpoint()
+
+    def _checkpoint(self):
+        dirs = []
+        with self.lock:
+            # the oldest queued directories are the shallowest ones
+            for fn, d, args in self.queue:
+                if len(dirs) >= TreePurge.STATE_MAX_DIRS:
+                    break
+                if fn == self._list_dir:
+                    dirs.append(os.path.relpath(d.path, self.root).decode(
+                        'utf-8', 'surrogateescape'))
+            state = {'entries': self.progress.entries,
+                     'total_entries': self.progress.total_entries}
+        while True:
+            state['dirs'] = dirs
+            value = json.dumps(state).encode('utf-8')
+            if len(value) <= TreePurge.STATE_MAX_SIZE or not dirs:
+                break
+            dirs = dirs[:len(dirs) // 2]
+        try:
+            self.fs.setxattr(self.root, TreePurge.STATE_XATTR, value, 0)
+        except cephfs.Error as e:
+            # not fatal: a restarted purge walks the whole entry again
+            log.warning("failed to save purge state of {0}: {1}".format(self.root, e))
+
 class Trash(GroupTemplate):
     GROUP_NAME = "_deleting"
 
@@ -52,42 +305,56 @@ class Trash(GroupTemplate):
         """
         return self._get_single_dir_entry(exclude_list)
 
-    def purge(self, trash_entry, should_cancel):
+    def _load_purge_state(self, trashpath):
+        try:
+            state = self.fs.getxattr(trashpath, TreePurge.STATE_XATTR,
+                                     TreePurge.STATE_MAX_SIZE)
+            return json.loads(state.decode('utf-8'))
+        except (cephfs.NoData, ValueError):
+            return {}
+        except cephfs.Error as e:
+            raise VolumeException(-e.args[0], e.args[1])
+
+    def purge(self, trash_entry, should_cancel, nr_workers=1, on_progress=None):
         """
         purge a trash entry.
 
         :praram trash_entry: the trash entry to purge
         :praram should_cancel: callback to check if the purge should be aborted
-        :return: None
+        :praram nr_workers: number of threads to purge the trash entry with
+        :praram on_progress: callback invoked periodically with the purge progress
+        :return: True if the trash entry was purged, False if cancelled
         """
-        def rmtree(root_path):
-            log.debug("rmtree {0}".format(root_path))
+        trashpath = os.path.join(self.path, trash_entry)
+        # pick up from where an earlier (interrupted) purge left off
+        state = self._load_purge_state(trashpath)
+        progress = PurgeProgress(state.get('entries', 0), state.get('total_entries', 0))
+        if not progress.total_entries:
             try:
-                with self.fs.opendir(root_path) as dir_handle:
-                    d = self.fs.readdir(dir_handle)
-                    while d and not should_cancel():
-                        if d.d_name not in (b".", b".."):
-                            d_full = os.path.join(root_path, d.d_name)
-                            if d.is_dir():
-                                rmtree(d_full)
-                            else:
-                                self.fs.unlink(d_full)
-                        d = self.fs.readdir(dir_handle)
-            except cephfs.ObjectNotFound:
-                return
-            except cephfs.Error as e:
-                raise VolumeException(-e.args[0], e.args[1])
-            # remove the directory only if we were not asked to cancel
-            # (else we would fail to remove this anyway)
-            if not should_cancel():
-                self.fs.rmdir(root_path)
+                progress.total_entries = int(self.fs.getxattr(
+                    trashpath, 'ceph.dir.rentries').decode('utf-8'))
+            except (cephfs.Error, ValueError):
+                pass
 
-        trashpath = os.path.join(self.path, trash_entry)
-        # catch any unlink errors
+        # directories queued when the last resume point was saved are
+        # disjoint subtrees, so purge them before walking the entry again.
+        resume_dirs = [os.path.join(trashpath, d.encode('utf-8', 'surrogateescape'))
+                       for d in state.get('dirs', [])]
+        if resume_dirs:
+            log.info("resuming purge of {0} from {1} directories ({2} entries " \
+                     "removed)".format(trashpath, len(resume_dirs), progress.entries))
         try:
-            rmtree(trashpath)
+            for roots in (resume_dirs, [trashpath]):
+                if not roots:
+                    continue
+                tree_purge = TreePurge(self.fs, trashpath, nr_workers, should_cancel,
+                                       progress, on_progress)
+                if not tree_purge.run(roots):
+                    return False
         except cephfs.Error as e:
             raise VolumeException(-e.args[0], e.args[1])
+        log.info("purged {0}: {1}".format(trashpath, progress))
+        return True
 
     def dump(self, path):
         """
@@ -113,7 +380,9 @@ def create_trashcan(fs, vol_spec):
     try:
         fs.mkdirs(trashcan.path, 0o700)
     except cephfs.Error as e:
-        raise VolumeException(-e.args[0], e.args[1])
+        # created by a concurrent removal
+        if e.args[0] != errno.EEXIST:
+            raise VolumeException(-e.args[0], e.args[1])
 
 @contextmanager
 def open_trashcan(fs, vol_spec):
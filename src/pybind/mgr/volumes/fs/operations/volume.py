@@ -14,7 +14,8 @@ except ImportError:
 import cephfs
 import orchestrator
 
-from .lock import GlobalLock
+from .lock import PathLock
+from .group import Group
 from ..exception import VolumeException
 from ..fs_util import create_pool, remove_pool, create_filesystem, \
     remove_filesystem, create_mds, volume_exists
@@ -269,21 +270,27 @@ def list_volumes(mgr):
     return result
 
 @contextmanager
-def open_volume(vc, volname):
+def open_volume(vc, volname, lock_path=(), exclusive=True):
     """
-    open a volume for exclusive access. This API is to be used as a context manager.
+    open a volume and lock a path in it. This API is to be used as a context manager.
 
     :param vc: volume client instance
     :param volname: volume name
+    :param lock_path: tuple of (group[, subvolume]) names to lock, the volume if empty
+    :param exclusive: lock the path for exclusive (or shared) access
     :return: yields a volume handle (ceph filesystem handle)
     """
     if vc.is_stopping():
         raise VolumeException(-errno.ESHUTDOWN, "shutdown in progress")
 
-    g_lock = GlobalLock()
+    lock_path = tuple(lock_path)
+    if lock_path and not lock_path[0]:
+        # subvolumes without a group live in the reserved group
+        lock_path = (Group.NO_GROUP_NAME,) + lock_path[1:]
+    p_lock = PathLock()
     fs_handle = vc.connection_pool.get_fs_handle(volname)
     try:
-        with g_lock.lock_op():
+        with p_lock.lock_op((volname,) + lock_path, exclusive):
             yield fs_handle
     finally:
         vc.connection_pool.put_fs_handle(volname)
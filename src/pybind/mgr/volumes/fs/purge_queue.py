@@ -23,6 +23,10 @@ class PurgeQueueBase(object):
     # which a warning is sent to `ceph status`.
     MAX_RETRIES_ON_EXCEPTION = 10
 
+    # number of threads purging a single trash entry (the purge thread
+    # and its helpers, which share the entry's directory work queue).
+    PURGE_WORKERS_PER_ENTRY = 4
+
     class PurgeThread(threading.Thread):
         def __init__(self, volume_client, name, purge_fn):
             self.vc = volume_client
@@ -145,7 +149,7 @@ class PurgeQueueBase(object):
         exclude_entries = [v[0] for v in self.jobs[volname]]
         fs_handle = None
         try:
-            with open_volume(self.vc, volname) as fs_handle:
+            with open_volume(self.vc, volname, exclusive=False) as fs_handle:
                 with open_trashcan(fs_handle, self.vc.volspec) as trashcan:
                     path = trashcan.get_trash_entry(exclude_entries)
                     ret = 0, path
@@ -157,17 +161,60 @@ class PurgeQueueBase(object):
                 ret = ve.errno, None
         return ret
 
+    def update_purge_progress(self, volname, purge_dir, progress):
+        log.info("purging trash entry '{0}' for volume '{1}': {2}".format(
+            purge_dir, volname, progress))
+        try:
+            self.vc.mgr.remote("progress", "update", self.purge_event_id(volname, purge_dir),
+                               "Purging trash entry {0} of volume {1} ({2})".format(
+                                   purge_dir.decode('utf-8'), volname, progress),
+                               progress.fraction, {"origin": "volumes"})
+        except ImportError:
+            # progress module is disabled
+            pass
+
+    def complete_purge_progress(self, volname, purge_dir, ret, cancelled=False):
+        try:
+            ev_id = self.purge_event_id(volname, purge_dir)
+            if ret != 0:
+                self.vc.mgr.remote("progress", "fail", ev_id,
+                                   "failed to purge trash entry ({0})".format(ret))
+            elif cancelled:
+                # the purge resumes from its last checkpoint when retried
+                self.vc.mgr.remote("progress", "fail", ev_id,
+                                   "purge of trash entry cancelled")
+            else:
+                self.vc.mgr.remote("progress", "complete", ev_id)
+        except ImportError:
+            # progress module is disabled
+            pass
+
+    def purge_event_id(self, volname, purge_dir):
+        return "purge-{0}-{1}".format(volname, purge_dir.decode('utf-8'))
+
     def purge_trash_entry_for_volume(self, volname, purge_dir):
         log.debug("purging trash entry '{0}' for volume '{1}'".format(purge_dir, volname))
 
         ret = 0
+        cancelled = False
+        reported = []
+        def on_progress(progress):
+            reported.append(True)
+            self.update_purge_progress(volname, purge_dir, progress)
+
         thread_id = threading.currentThread()
         try:
             with open_volume_lockless(self.vc, volname) as fs_handle:
                 with open_trashcan(fs_handle, self.vc.volspec) as trashcan:
-                    trashcan.purge(purge_dir, should_cancel=lambda: thread_id.should_cancel())
+                    purged = trashcan.purge(purge_dir,
+                                            should_cancel=lambda: thread_id.should_cancel(),
+                                            nr_workers=PurgeQueueBase.PURGE_WORKERS_PER_ENTRY,
+                                            on_progress=on_progress)
+                    cancelled = not purged
         except VolumeException as ve:
             ret = ve.errno
+        if reported:
+            self.complete_purge_progress(volname, purge_dir, ret, cancelled)
         return ret
 
 class ThreadPoolPurgeQueueMixin(PurgeQueueBase):
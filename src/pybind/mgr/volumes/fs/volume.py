@@ -11,6 +11,7 @@ from .operations.volume import ConnectionPool, open_volume, create_volume, \
     delete_volume, list_volumes
 from .operations.group import open_group, create_group, remove_group
 from .operations.subvolume import open_subvol, create_subvol, remove_subvol
+from .operations.lock import PathLock
 
 from .vol_spec import VolSpec
 from .exception import VolumeException
@@ -104,6 +105,9 @@ class VolumeClient(object):
         volumes = list_volumes(self.mgr)
         return 0, json.dumps(volumes, indent=4, sort_keys=True), ""
 
+    def lock_stats(self):
+        return 0, json.dumps(PathLock().wait_stats(), indent=4, sort_keys=True), ""
+
     ### subvolume operations
 
     def _create_subvolume(self, fs_handle, volname, group, subvolname, **kwargs):
@@ -130,7 +134,7 @@ class VolumeClient(object):
         groupname  = kwargs['group_name']
 
         try:
-            with open_volume(self, volname) as fs_handle:
+            with open_volume(self, volname, lock_path=(groupname, subvolname)) as fs_handle:
                 with open_group(fs_handle, self.volspec, groupname) as group:
                     try:
                         with open_subvol(fs_handle, self.volspec, group, subvolname):
@@ -154,7 +158,7 @@ class VolumeClient(object):
         force      = kwargs['force']
 
         try:
-            with open_volume(self, volname) as fs_handle:
+            with open_volume(self, volname, lock_path=(groupname, subvolname)) as fs_handle:
                 with open_group(fs_handle, self.volspec, groupname) as group:
                     remove_subvol(fs_handle, self.volspec, group, subvolname)
                     # kick the purge threads for async removal -- note that this
@@ -176,7 +180,7 @@ class VolumeClient(object):
         groupname  = kwargs['group_name']
 
         try:
-            with open_volume(self, volname) as fs_handle:
+            with open_volume(self, volname, lock_path=(groupname, subvolname)) as fs_handle:
                 with open_group(fs_handle, self.volspec, groupname) as group:
                     with open_subvol(fs_handle, self.volspec, group, subvolname) as subvolume:
                         nsize, usedbytes = subvolume.resize(newsize, noshrink)
@@ -195,7 +199,7 @@ class VolumeClient(object):
         groupname  = kwargs['group_name']
 
         try:
-            with open_volume(self, volname) as fs_handle:
+            with open_volume(self, volname, lock_path=(groupname, subvolname), exclusive=False) as fs_handle:
                 with open_group(fs_handle, self.volspec, groupname) as group:
                     with open_subvol(fs_handle, self.volspec, group, subvolname) as subvolume:
                         subvolpath = subvolume.path
@@ -210,7 +214,7 @@ class VolumeClient(object):
         groupname  = kwargs['group_name']
 
         try:
-            with open_volume(self, volname) as fs_handle:
+            with open_volume(self, volname, lock_path=(groupname,), exclusive=False) as fs_handle:
                 with open_group(fs_handle, self.volspec, groupname) as group:
                     subvolumes = group.list_subvolumes()
                     ret = 0, name_to_json(subvolumes), ""
@@ -228,7 +232,7 @@ class VolumeClient(object):
         groupname  = kwargs['group_name']
 
         try:
-            with open_volume(self, volname) as fs_handle:
+            with open_volume(self, volname, lock_path=(groupname, subvolname)) as fs_handle:
                 with open_group(fs_handle, self.volspec, groupname) as group:
                     with open_subvol(fs_handle, self.volspec, group, subvolname) as subvolume:
                         subvolume.create_snapshot(snapname)
@@ -245,7 +249,7 @@ class VolumeClient(object):
         force      = kwargs['force']
 
         try:
-            with open_volume(self, volname) as fs_handle:
+            with open_volume(self, volname, lock_path=(groupname, subvolname)) as fs_handle:
                 with open_group(fs_handle, self.volspec, groupname) as group:
                     with open_subvol(fs_handle, self.volspec, group, subvolname) as subvolume:
                         subvolume.remove_snapshot(snapname)
@@ -261,7 +265,7 @@ class VolumeClient(object):
         groupname  = kwargs['group_name']
 
         try:
-            with open_volume(self, volname) as fs_handle:
+            with open_volume(self, volname, lock_path=(groupname, subvolname), exclusive=False) as fs_handle:
                 with open_group(fs_handle, self.volspec, groupname) as group:
                     with open_subvol(fs_handle, self.volspec, group, subvolname) as subvolume:
                         snapshots = subvolume.list_snapshots()
@@ -282,7 +286,7 @@ class VolumeClient(object):
         mode      = kwargs['mode']
 
         try:
-            with open_volume(self, volname) as fs_handle:
+            with open_volume(self, volname, lock_path=(groupname,)) as fs_handle:
                 try:
                     with open_group(fs_handle, self.volspec, groupname):
                         # idempotent creation -- valid.
@@ -305,7 +309,7 @@ class VolumeClient(object):
         force     = kwargs['force']
 
         try:
-            with open_volume(self, volname) as fs_handle:
+            with open_volume(self, volname, lock_path=(groupname,)) as fs_handle:
                 remove_group(fs_handle, self.volspec, groupname)
         except VolumeException as ve:
             if not (ve.errno == -errno.ENOENT and force):
@@ -317,7 +321,7 @@ class VolumeClient(object):
         groupname  = kwargs['group_name']
 
         try:
-            with open_volume(self, volname) as fs_handle:
+            with open_volume(self, volname, lock_path=(groupname,), exclusive=False) as fs_handle:
                 with open_group(fs_handle, self.volspec, groupname) as group:
                     return 0, group.path.decode('utf-8'), ""
         except VolumeException as ve:
@@ -327,7 +331,7 @@ class VolumeClient(object):
         volname = kwargs['vol_name']
         ret     = 0, '[]', ""
         try:
-            with open_volume(self, volname) as fs_handle:
+            with open_volume(self, volname, exclusive=False) as fs_handle:
                 groups = listdir(fs_handle, self.volspec.base_dir)
                 ret = 0, name_to_json(groups), ""
         except VolumeException as ve:
@@ -344,7 +348,7 @@ class VolumeClient(object):
         snapname  = kwargs['snap_name']
 
         try:
-            with open_volume(self, volname) as fs_handle:
+            with open_volume(self, volname, lock_path=(groupname,)) as fs_handle:
                 with open_group(fs_handle, self.volspec, groupname) as group:
                     group.create_snapshot(snapname)
         except VolumeException as ve:
@@ -359,7 +363,7 @@ class VolumeClient(object):
         force     = kwargs['force']
 
         try:
-            with open_volume(self, volname) as fs_handle:
+            with open_volume(self, volname, lock_path=(groupname,)) as fs_handle:
                 with open_group(fs_handle, self.volspec, groupname) as group:
                     group.remove_snapshot(snapname)
         except VolumeException as ve:
@@ -373,7 +377,7 @@ class VolumeClient(object):
         groupname = kwargs['group_name']
 
         try:
-            with open_volume(self, volname) as fs_handle:
+            with open_volume(self, volname, lock_path=(groupname,), exclusive=False) as fs_handle:
                 with open_group(fs_handle, self.volspec, groupname) as group:
                     snapshots = group.list_snapshots()
                     ret = 0, name_to_json(snapshots), ""
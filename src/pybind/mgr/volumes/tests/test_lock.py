@@ -0,0 +1,51 @@
+import threading
+
+from tests import mock
+
+from ..fs.operations.lock import PathLock
+from ..fs.operations.volume import open_volume
+
+
+def try_lock(path, exclusive=True):
+    """
+    :return: True if the path could be locked from another thread within
+             a short while
+    """
+    locked = threading.Event()
+    release = threading.Event()
+
+    def _lock():
+        with PathLock().lock_op(path, exclusive):
+            locked.set()
+            release.wait(5)
+    thread = threading.Thread(target=_lock)
+    thread.daemon = True
+    thread.start()
+    result = locked.wait(0.2)
+    release.set()
+    return result
+
+
+class TestPathLock(object):
+
+    def test_shared_ancestors(self):
+        with PathLock().lock_op(('vol', 'group', 'sub1')):
+            assert try_lock(('vol', 'group', 'sub2'))
+            assert try_lock(('vol', 'group'), exclusive=False)
+            assert not try_lock(('vol', 'group'))
+            assert not try_lock(('vol', 'group', 'sub1'), exclusive=False)
+
+    def test_wait_stats(self):
+        p_lock = PathLock()
+        with p_lock.lock_op(('vol', 'group')):
+            pass
+        stats = p_lock.wait_stats()
+        assert stats['volume']['shared']['count'] >= 1
+        assert stats['group']['exclusive']['count'] >= 1
+        assert set(stats['group']['exclusive']) == {'count', 'total_wait', 'max_wait'}
+
+    def test_no_group(self):
+        vc = mock.Mock()
+        vc.is_stopping.return_value = False
+        with open_volume(vc, 'vol', lock_path=(None, 'sub')):
+            assert not try_lock(('vol', '_nogroup', 'sub'))
@@ -0,0 +1,258 @@
+import errno
+import json
+import threading
+from contextlib import contextmanager
+
+import pytest
+
+from tests import mock
+
+import cephfs
+
+from ..fs.exception import VolumeException
+from ..fs.operations.trash import PurgeProgress, Trash, TreePurge, create_trashcan
+from ..fs.purge_queue import PurgeQueueBase
+
+
+class Error(Exception):
+    pass
+
+
+class OSError(Error):
+    def __init__(self, err, strerror):
+        super(OSError, self).__init__(err, strerror)
+        self.errno = err
+
+
+class ObjectNotFound(OSError):
+    pass
+
+
+class NoData(OSError):
+    pass
+
+
+@pytest.fixture(autouse=True)
+def cephfs_errors():
+    with mock.patch.multiple(cephfs, Error=Error, OSError=OSError,
+                             ObjectNotFound=ObjectNotFound, NoData=NoData):
+        yield
+
+
+class DirEntry(object):
+    def __init__(self, name, is_dir):
+        self.d_name = name
+        self._is_dir = is_dir
+
+    def is_dir(self):
+        return self._is_dir
+
+
+class FakeFS(object):
+    """
+    An in-memory tree, with the calls of a cephfs handle that purging
+    makes. Paths are bytes.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dirs = {}
+        self.files = set()
+        self.xattrs = {}
+
+    def _add(self, path):
+        parent, name = path.rsplit(b'/', 1)
+        if parent in self.dirs:
+            self.dirs[parent].append(name)
+
+    def make_tree(self, root, nr_dirs, nr_files):
+        self.dirs[root] = []
+        self._add(root)
+        for i in range(nr_files):
+            path = root + b'/f' + str(i).encode('utf-8')
+            self.files.add(path)
+            self._add(path)
+        for i in range(nr_dirs):
+            self.make_tree(root + b'/d' + str(i).encode('utf-8'), nr_dirs - 1, nr_files)
+
+    @contextmanager
+    def opendir(self, path):
+        with self.lock:
+            if path not in self.dirs:
+                raise ObjectNotFound(errno.ENOENT, 'no such directory')
+            names = [b'.', b'..'] + list(self.dirs[path])
+            entries = [DirEntry(n, path + b'/' + n in self.dirs) for n in names]
+        yield iter(entries)
+
+    def readdir(self, handle):
+        return next(handle, None)
+
+    def _remove(self, path):
+        parent, name = path.rsplit(b'/', 1)
+        if parent in self.dirs:
+            self.dirs[parent].remove(name)
+
+    def unlink(self, path):
+        with self.lock:
+            if path not in self.files:
+                raise ObjectNotFound(errno.ENOENT, 'no such file')
+            self.files.remove(path)
+            self._remove(path)
+
+    def rmdir(self, path):
+        with self.lock:
+            if path not in self.dirs:
+                raise ObjectNotFound(errno.ENOENT, 'no such directory')
+            if self.dirs[path]:
+                raise OSError(errno.ENOTEMPTY, 'directory not empty')
+            del self.dirs[path]
+            self._remove(path)
+
+    def mkdirs(self, path, mode):
+        with self.lock:
+            if path in self.dirs:
+                raise OSError(errno.EEXIST, 'directory exists')
+            self.dirs[path] = []
+            self._add(path)
+
+    def setxattr(self, path, name, value, flags):
+        self.xattrs[(path, name)] = value
+
+    def getxattr(self, path, name, size=255):
+        if name == 'ceph.dir.rentries':
+            with self.lock:
+                return str(sum(1 for p in list(self.dirs) + list(self.files)
+                               if p.startswith(path + b'/'))).encode('utf-8')
+        try:
+            return self.xattrs[(path, name)]
+        except KeyError:
+            raise NoData(errno.ENODATA, 'no data')
+
+    def count(self, root):
+        return sum(1 for p in list(self.dirs) + list(self.files)
+                   if p == root or p.startswith(root + b'/'))
+
+
+class TestPurgeProgress(object):
+
+    def test_fraction(self):
+        assert PurgeProgress().fraction == 0.0
+        assert PurgeProgress(entries=5, total_entries=20).fraction == 0.25
+        # entries created since the total was taken
+        assert PurgeProgress(entries=30, total_entries=20).fraction == 1.0
+
+    def test_rate_counts_entries_since_restart(self):
+        progress = PurgeProgress(entries=100)
+        progress.start_time -= 10
+        progress.entries += 50
+        assert progress.rate == pytest.approx(5.0, rel=0.1)
+        assert str(progress).startswith('150 entries removed, ')
+
+
+class TestTreePurge(object):
+
+    @pytest.mark.parametrize('nr_workers', [1, 4])
+    def test_purge(self, nr_workers):
+        fs = FakeFS()
+        fs.make_tree(b'/trash/e', 3, 5)
+        total = fs.count(b'/trash/e')
+        progress = PurgeProgress()
+        with mock.patch.object(TreePurge, 'UNLINK_BATCH_SIZE', 2):
+            purge = TreePurge(fs, b'/trash/e', nr_workers, lambda: False, progress)
+            assert purge.run([b'/trash/e'])
+        assert fs.count(b'/trash/e') == 0
+        assert progress.entries == total
+
+    def test_cancel_saves_resume_point(self):
+        fs = FakeFS()
+        fs.make_tree(b'/trash/e', 3, 5)
+        fs.dirs[b'/trash'] = [b'e']
+        total = fs.count(b'/trash/e')
+        progress = PurgeProgress()
+        unlinks = []
+        unlink = fs.unlink
+
+        def _unlink(path):
+            unlinks.append(path)
+            unlink(path)
+        fs.unlink = _unlink
+
+        purge = TreePurge(fs, b'/trash/e', 1, lambda: len(unlinks) >= 10, progress)
+        assert not purge.run([b'/trash/e'])
+        state = json.loads(fs.xattrs[(b'/trash/e', TreePurge.STATE_XATTR)].decode('utf-8'))
+        assert state['entries'] == progress.entries
+        assert state['dirs']
+        assert 0 < fs.count(b'/trash/e') < total
+
+        # the next attempt picks up from the resume point
+        fs.unlink = unlink
+        vol_spec = mock.Mock(base_dir='/')
+        with mock.patch.object(Trash, 'GROUP_NAME', 'trash'):
+            assert Trash(fs, vol_spec).purge(b'e', lambda: False)
+        assert fs.count(b'/trash/e') == 0
+
+    def test_relist_non_empty_directory(self):
+        fs = FakeFS()
+        fs.make_tree(b'/trash/e', 0, 3)
+        rmdir = fs.rmdir
+
+        def _rmdir(path):
+            # a file created while the directory was listed
+            if path == b'/trash/e' and not hasattr(_rmdir, 'done'):
+                _rmdir.done = True
+                fs.files.add(b'/trash/e/late')
+                fs.dirs[path].append(b'late')
+            rmdir(path)
+        fs.rmdir = _rmdir
+
+        purge = TreePurge(fs, b'/trash/e', 1, lambda: False, PurgeProgress())
+        assert purge.run([b'/trash/e'])
+        assert fs.count(b'/trash/e') == 0
+
+
+class TestCreateTrashcan(object):
+
+    def test_exists(self):
+        fs = FakeFS()
+        fs.dirs[b'/vol'] = []
+        vol_spec = mock.Mock(base_dir='/vol')
+        create_trashcan(fs, vol_spec)
+        # created by a concurrent removal meanwhile
+        create_trashcan(fs, vol_spec)
+        assert fs.dirs[b'/vol'] == [Trash.GROUP_NAME.encode('utf-8')]
+
+    def test_error(self):
+        fs = mock.Mock()
+        fs.mkdirs.side_effect = OSError(errno.EACCES, 'permission denied')
+        with pytest.raises(VolumeException) as e:
+            create_trashcan(fs, mock.Mock(base_dir='/'))
+        assert e.value.errno == -errno.EACCES
+
+
+class TestPurgeQueue(object):
+
+    @pytest.mark.parametrize('purged,message', [
+        (True, None),
+        (False, 'purge of trash entry cancelled'),
+    ])
+    def test_complete_purge_progress(self, purged, message):
+        vc = mock.Mock()
+        queue = PurgeQueueBase(vc)
+
+        class _Trash(object):
+            def purge(self, trash_entry, should_cancel, nr_workers, on_progress):
+                on_progress(PurgeProgress())
+                return purged
+
+        @contextmanager
+        def _open(*args):
+            yield _Trash()
+
+        with mock.patch('volumes.fs.purge_queue.open_volume_lockless', _open), \
+                mock.patch('volumes.fs.purge_queue.open_trashcan', _open):
+            assert queue.purge_trash_entry_for_volume('vol', b'e') == 0
+        calls = [c[0][:2] for c in vc.mgr.remote.call_args_list]
+        if message is None:
+            assert calls[-1] == ('progress', 'complete')
+        else:
+            assert calls[-1] == ('progress', 'fail')
+            assert vc.mgr.remote.call_args_list[-1][0][3] == message